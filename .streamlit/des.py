@@ -8,8 +8,18 @@ import plotly.express as px
 import plotly.graph_objects as go
 import kaleido
 import io
-
-from des_classes_v5 import g, Trial
+import os
+
+from des_classes_v5 import g, Trial, results_summary
+from des_memory import MemoryBudgetError
+from des_experiments import all_params, b6_mins_cols, b4_mins_cols
+from des_surrogate import Emulator
+from des_stage_cache import StageCache
+from des_compare import compare_scenarios, scenario_params
+from des_arrivals import school_term_profile, profile_from_csv
+from des_calendar import run_bank_holidays
+from des_results import (save_results, list_saved_results, open_results,
+                         results_to_parquet, results_to_arrow)
 #from app_style import global_page_style
 
 ########## Streamlit App ##########
@@ -36,6 +46,20 @@ with st.sidebar:
         referral_input = st.slider("Number of Referrals Per Week", 1, 100, 50)
         referral_reject_input = st.number_input("Referral Rejection Rate (%)",
                         min_value=0.0, max_value=20.0, step=0.25, value=4.25)
+        referral_pattern_input = st.selectbox("Referral Pattern",
+                        ['Constant','School Terms','Historical (CSV)'],
+                        help='How the referrals per week vary over the year')
+        if referral_pattern_input == 'School Terms':
+            holiday_factor_input = st.slider(
+                        "Holiday Referrals (% of term time)", 0, 100, 50)
+            start_week_input = st.slider(
+                        "Week of the Year the Simulation Starts", 1, 52, 1)
+        elif referral_pattern_input == 'Historical (CSV)':
+            history_file_input = st.file_uploader(
+                        "Weekly Referrals CSV", type='csv',
+                        help='One row per week, with the number of referrals '
+                             'in the last column. The pattern is repeated if '
+                             'the simulation is longer.')
            
     with st.expander("Triage"):
         
@@ -74,6 +98,11 @@ with st.sidebar:
                         min_value=0.0, max_value=20.0, step=0.25, value=5.0)
         mdt_target_input = st.slider("Number of Weeks to MDT", 0, 5, 1)
         mdt_resource_input =  st.slider("Number of MDT Slots p/w", 0, 100, 60)
+        mdt_batched_input = st.checkbox("One MDT Meeting a Week",
+                        value=g.mdt_batched,
+                        help='Review the cases together at a weekly meeting '
+                             'that takes up to the number of slots of them, '
+                             'rather than one at a time as slots allow.')
 
     with st.expander("Assessment"):
     
@@ -97,6 +126,13 @@ with st.sidebar:
         b6_prac_hours_input = st.slider(label="Number of B6 Hours per WTE", min_value=0.0, max_value=25.0, value=g.hours_avail_b6_prac)
         b4_prac_avail_input = st.number_input(label="Number of B4 Practitioner WTE",min_value=0.5,max_value=20.0,value = g.number_staff_b4_prac)
         b4_prac_hours_input = st.slider(label="Number of B4 Hours per WTE", min_value=0.0, max_value=25.0, value=g.hours_avail_b4_prac)
+        enforce_job_plans_input = st.checkbox("Limit Work to Job Plan Hours",
+                        value=g.enforce_job_plans,
+                        help='Triage, MDT and assessments wait until there '
+                             'are enough B6/B4 hours left in the week, so a '
+                             'shortage of staff shows up as longer waits. '
+                             'Other work is still done and counted as '
+                             'overtime once the hours run out.')
             
     with st.expander("Simulation Parameters"):
     
@@ -105,8 +141,41 @@ with st.sidebar:
         sim_duration_input =  st.slider("Simulation Duration (weeks)", 1, 520, 52)
         st.write(f"The service is running for {sim_duration_input} weeks")
         number_of_runs_input = st.slider("Number of Simulation Runs", 1, 20, 10)
+        random_seed_input = st.number_input("Random Seed", min_value=0,
+                                            value=42, step=1)
+        variance_reduction_input = st.selectbox(
+            "Variance Reduction", ['None','Antithetic Pairs',
+                                   'Referrals Control Variate',
+                                   'Antithetic Pairs & Control Variate'],
+            help='Antithetic pairs run the runs in pairs with opposite random '
+                 'draws, the control variate adjusts each run for how many '
+                 'referrals it happened to get. Both narrow the confidence '
+                 'intervals for the same number of runs.')
+        memory_budget_input = st.number_input("Memory Budget (MB)",
+                        min_value=0, value=0, step=100,
+                        help='Most memory a trial can use, 0 for no limit. '
+                             'Over the budget only the results of each run '
+                             'are kept (so the trial can\'t be extended), or '
+                             'the trial isn\'t run if it still won\'t fit.')
+        memory_tracking_input = st.checkbox("Measure Memory Use")
+        daily_slots_input = st.checkbox("Release Slots Daily",
+                        value=g.daily_slots,
+                        help='Release each week\'s slots (and spread the '
+                             'referrals) over the working days rather than '
+                             'all at the start of the week. No slots are '
+                             'released on bank holidays in England.')
+        if daily_slots_input:
+            calendar_start_input = st.date_input("Simulation Start Date",
+                        help='Used for the dates of the bank holidays')
 
 g.mean_referrals_pw = referral_input
+if referral_pattern_input == 'School Terms':
+    g.referral_profile = school_term_profile(holiday_factor_input/100,
+                                             start_week_input - 1)
+elif referral_pattern_input == 'Historical (CSV)' and history_file_input:
+    g.referral_profile = profile_from_csv(history_file_input)
+else:
+    g.referral_profile = None
 g.base_waiting_list = 2741
 g.referral_rejection_rate = referral_reject_input/100
 g.triage_rejection_rate = triage_rejection_input/100
@@ -121,6 +190,7 @@ g.obs_rejection_rate = obs_rejection_input/100
 g.mdt_rejection_rate = mdt_rejection_input/100
 g.target_mdt_wait = mdt_target_input
 g.mdt_resource = mdt_resource_input
+g.mdt_batched = mdt_batched_input
 
 g.asst_rejection_rate = asst_rejection_input/100
 g.target_asst_wait = asst_target_input
@@ -132,13 +202,96 @@ g.number_staff_b6_prac = b6_prac_avail_input
 g.number_staff_b4_prac = b4_prac_avail_input
 g.hours_avail_b6_prac = b6_prac_hours_input
 g.hours_avail_b4_prac = b4_prac_hours_input
-
-# calculate total hours for job plans
-total_b6_prac_hours = b6_prac_avail_input*b6_prac_hours_input
-total_b4_prac_hours = b4_prac_avail_input*b4_prac_hours_input
+g.enforce_job_plans = enforce_job_plans_input
 
 g.sim_duration = sim_duration_input
 g.number_of_runs = number_of_runs_input
+g.random_seed = int(random_seed_input)
+g.antithetic_runs = 'Antithetic' in variance_reduction_input
+g.control_variate = 'Control Variate' in variance_reduction_input
+g.memory_budget_mb = memory_budget_input if memory_budget_input > 0 else None
+g.memory_tracking = 'rss' if memory_tracking_input else None
+g.daily_slots = daily_slots_input
+if daily_slots_input:
+    g.bank_holidays = run_bank_holidays(calendar_start_input, g.sim_duration)
+else:
+    g.bank_holidays = []
+
+###########################################################
+# Instant preview of the waiting lists from the emulator  #
+# (trained by running des_surrogate.py)                   #
+###########################################################
+
+# above this uncertainty the emulator is too unsure and the preview only comes
+# with a warning to run the full simulation (0 = at a point it was trained on,
+# 1 = knows nothing)
+emulator_max_uncertainty = 0.5
+
+@st.cache_resource
+def load_emulator(path):
+    if os.path.exists(path):
+        return Emulator.load(path)
+    return None
+
+emulator = load_emulator(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                      'emulator.pkl'))
+
+if emulator is not None:
+    df_preview, df_preview_sd, preview_uncertainty = emulator.predict_current()
+    # inputs the emulator wasn't trained on that are different to its
+    # training runs, so the preview would be of a different set up
+    untrained_changes = emulator.changed_settings()
+
+    # only show the weeks being simulated
+    df_preview = df_preview[df_preview.index < g.sim_duration]
+    df_preview_sd = df_preview_sd[df_preview_sd.index < g.sim_duration]
+
+    with st.expander("Instant Preview (emulated)", expanded=True):
+        # the emulator knows nothing about these inputs, so rather than show a
+        # preview of a different set up there isn't one
+        if untrained_changes is None:
+            st.warning('The emulator was saved without the set up it was '
+                       'trained with, so there is no preview. Retrain it by '
+                       'running des_surrogate.py.')
+        elif untrained_changes:
+            st.warning('The emulator was trained with different values of '
+                       f'{", ".join(untrained_changes)}, so there is no '
+                       'preview for these inputs. Run the simulation to see '
+                       'the results.')
+        else:
+            st.write('This is an estimate of the average waiting lists from '
+                     'an emulator trained on previous simulation runs, the '
+                     'shaded area shows how unsure it is. Run the simulation '
+                     'for the full results. Emulator uncertainty: '
+                     f'{preview_uncertainty:.0%}')
+
+            if preview_uncertainty > emulator_max_uncertainty:
+                st.warning('The emulator is unsure about these inputs, run the '
+                           'simulation for reliable results.')
+
+            preview_cols = st.columns(3)
+
+            for preview_col, list_name in zip(preview_cols,
+                                              ['Triage WL','MDT WL','Asst WL']):
+                upper = df_preview[list_name] + 2 * df_preview_sd[list_name]
+                lower = (df_preview[list_name] - 2 * df_preview_sd[list_name]
+                         ).clip(lower=0)
+
+                fig = go.Figure([
+                    go.Scatter(x=list(df_preview.index) + list(df_preview.index[::-1]),
+                               y=list(upper) + list(lower[::-1]), fill='toself',
+                               fillcolor='rgba(0,0,255,0.2)', line=dict(width=0),
+                               name='Uncertainty'),
+                    go.Scatter(x=df_preview.index, y=df_preview[list_name],
+                               name='Emulated', line=dict(width=3,color='blue')),
+                    ])
+                fig.update_layout(title=f'{list_name} by Week (emulated)',
+                                  title_x=0.3, font=dict(size=10), height=350,
+                                  xaxis_title='Week Number',
+                                  yaxis_title='Waiters')
+
+                with preview_col:
+                    st.plotly_chart(fig, use_container_width=True)
 
 ###########################################################
 # Run a trial using the parameters from the g class and   #
@@ -147,17 +300,141 @@ g.number_of_runs = number_of_runs_input
 
 button_run_pressed = st.button("Run simulation")
 
-if button_run_pressed:
-    with st.spinner('Simulating the system...'):
+# saved results (see des_results.py) are kept in a folder next to this file
+saved_results_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'saved_results')
+
+with st.expander("Open a Saved Result"):
+    saved_result_names = list_saved_results(saved_results_dir)
+    saved_result_input = st.selectbox("Saved Result", saved_result_names,
+                                      help='Results saved from earlier runs, '
+                                           'newest first')
+    button_open_pressed = (st.button("Open Saved Result",
+                                     disabled=not saved_result_names)
+                           and saved_result_input is not None)
+
+# arrivals into each stage of the pathway from previous runs, shared between
+# page reloads so changing e.g. the assessment slots only reruns assessment
+@st.cache_resource
+def load_stage_cache():
+    return StageCache()
+
+# save the results to the saved results folder or download them. This is a
+# fragment so using the buttons doesn't rerun the whole page (and clear the
+# results).
+@st.fragment
+def export_results(df_trial_results, df_weekly_stats, params):
+    result_name = st.text_input("Result Name",
+                    value=f"{len(df_trial_results)}_runs_"
+                          f"{params['sim_duration']}_weeks_"
+                          f"{params['mean_referrals_pw']}_referrals")
+
+    if st.button("Save Result", disabled=not result_name):
+        try:
+            saved_path = save_results(saved_results_dir, result_name,
+                                      df_trial_results, df_weekly_stats,
+                                      params)
+        except ValueError as e:
+            st.error(str(e))
+        else:
+            st.success(f"Saved as {os.path.basename(saved_path)}, it can be "
+                       "reopened from 'Open a Saved Result'")
+
+    download_cols = st.columns(4)
+
+    for i, (label, df, file_name) in enumerate(
+            [('Trial Results', df_trial_results, 'trial_results'),
+             ('Weekly Stats', df_weekly_stats, 'weekly_stats')]):
+        with download_cols[2 * i]:
+            st.download_button(f"Download {label} (Parquet)",
+                               results_to_parquet(df, params),
+                               f"{result_name}_{file_name}.parquet",
+                               "application/octet-stream")
+        with download_cols[2 * i + 1]:
+            st.download_button(f"Download {label} (Arrow)",
+                               results_to_arrow(df, params),
+                               f"{result_name}_{file_name}.arrow",
+                               "application/octet-stream")
+
+# check a new trial fits in the memory budget before starting it
+run_refused = False
+if button_run_pressed and not button_open_pressed:
+    try:
+        Trial(load_stage_cache()).choose_record_detail()
+    except MemoryBudgetError as e:
+        st.error(str(e))
+        run_refused = True
+
+if button_open_pressed or (button_run_pressed and not run_refused):
+    with st.spinner('Opening the saved result...' if button_open_pressed
+                    else 'Simulating the system...'):
 
-# Create an instance of the Trial class
-        my_trial = Trial()
         pd.set_option('display.max_rows', 1000)
-        # Call the run_trial method of our Trial class object
-        
-        df_trial_results, df_weekly_stats = my_trial.run_trial()
 
-        st.subheader(f"Summary of all {g.number_of_runs} Simulation Runs over {g.sim_duration} Weeks")
+        if button_open_pressed:
+            # no simulation needed, the results (and the inputs they were run
+            # with) are read straight from the saved files
+            df_trial_results, df_weekly_stats, result_params = open_results(
+                        os.path.join(saved_results_dir, saved_result_input))
+
+            st.subheader(f"Saved Result: {saved_result_input}")
+
+        else:
+            # The last trial is kept, so if the only change since then is a
+            # longer simulation duration its runs are carried on for the extra
+            # weeks rather than starting again from week 0
+            trial_params = all_params()
+            del trial_params['sim_duration']
+
+            cached_trial = st.session_state.get('trial')
+
+            if (cached_trial is not None
+                    and st.session_state.get('trial_params') == trial_params
+                    and g.sim_duration > cached_trial.sim_duration
+                    and cached_trial.can_extend()):
+                df_trial_results, df_weekly_stats = cached_trial.extend_trial(
+                                                                g.sim_duration)
+            else:
+                # Create an instance of the Trial class, reusing the earlier
+                # stages of previous runs if only later stages have changed
+                my_trial = Trial(load_stage_cache())
+                # Call the run_trial method of our Trial class object
+                df_trial_results, df_weekly_stats = my_trial.run_trial()
+
+                st.session_state.trial = my_trial
+                st.session_state.trial_params = trial_params
+
+            result_params = all_params()
+
+            trial = st.session_state.trial
+            if trial.record_detail != g.record_detail:
+                st.warning('To stay within the memory budget only the results '
+                           'of each run have been kept, so this trial can\'t '
+                           'be extended to a longer duration.')
+            if trial.peak_memory_mb is not None:
+                st.write(f'Peak memory used by the trial: '
+                         f'{trial.peak_memory_mb:.0f} MB (estimated '
+                         f'{trial.estimate_mb(trial.record_detail):.0f} MB)')
+
+        # the charts are drawn using the inputs the results were run with
+        result_weeks = result_params['sim_duration']
+        result_b6_hours = (result_params['number_staff_b6_prac']
+                           * result_params['hours_avail_b6_prac'])
+        result_b4_hours = (result_params['number_staff_b4_prac']
+                           * result_params['hours_avail_b4_prac'])
+
+        st.subheader(f"Summary of all {len(df_trial_results)} Simulation Runs over {result_weeks} Weeks")
+
+        with st.expander("Confidence Intervals"):
+            st.write('Mean of each output over the runs with its 95% '
+                     'confidence interval')
+            st.dataframe(results_summary(df_trial_results).round(2),
+                         hide_index=True)
+
+        with st.expander("Save or Export Results"):
+            # (a copy, as the weekly stats get the hours columns added below)
+            export_results(df_trial_results, df_weekly_stats.copy(),
+                           result_params)
         
         # turn mins values from running total to weekly total in hours
         df_weekly_stats['Referral Screen Hrs'] = (df_weekly_stats['Referral Screen Mins']-df_weekly_stats['Referral Screen Mins'].shift(1))/60
@@ -316,39 +593,29 @@ if button_run_pressed:
         
         ########## Job Plans Tab ##########
 
+        # the hours columns for each band's activities (see des_experiments.py)
+        b6_hrs_cols = [col.replace('Mins', 'Hrs') for col in b6_mins_cols]
+        b4_hrs_cols = [col.replace('Mins', 'Hrs') for col in b4_mins_cols]
+
         ##### Band 6 Practitioner
 
-        df_weekly_b6 = df_weekly_stats[['Run','Week Number',
-                                        'Referral Screen Hrs','Triage Clin Hrs',
-                                        'Triage Admin Hrs','Triage Reject Hrs',
-                                        'Pack Reject Hrs','Obs Reject Hrs',
-                                        'MDT Reject Hrs',
-                                        'Asst Clin Hrs','Asst Admin Hrs',
-                                        'Diag Accept Hrs','Diag Reject Hrs']]
+        df_weekly_b6 = df_weekly_stats[['Run','Week Number'] + b6_hrs_cols]
 
         df_weekly_b6_avg = df_weekly_b6.groupby(['Week Number'], as_index=False).mean()
         
-        df_weekly_b6_unpivot = pd.melt(df_weekly_b6_avg, value_vars=[
-                                        'Referral Screen Hrs','Triage Clin Hrs',
-                                        'Triage Admin Hrs','Triage Reject Hrs',
-                                        'Pack Reject Hrs','Obs Reject Hrs',
-                                        'MDT Reject Hrs',
-                                        'Asst Clin Hrs','Asst Admin Hrs',
-                                        'Diag Accept Hrs','Diag Reject Hrs'],
-                                        id_vars=['Week Number'])
+        df_weekly_b6_unpivot = pd.melt(df_weekly_b6_avg,
+                                       value_vars=b6_hrs_cols,
+                                       id_vars=['Week Number'])
         
         ##### Band 4 Practitioner
 
-        df_weekly_b4 = df_weekly_stats[['Run','Week Number',
-                                        'Obs Visit Hrs','Obs Reject Hrs',
-                                        'MDT Prep Hrs','MDT Meet Hrs']]
+        df_weekly_b4 = df_weekly_stats[['Run','Week Number'] + b4_hrs_cols]
 
         df_weekly_b4_avg = df_weekly_b4.groupby(['Week Number'], as_index=False).mean()
 
-        df_weekly_b4_unpivot = pd.melt(df_weekly_b4_avg, value_vars=[
-                                        'Obs Visit Hrs','Obs Reject Hrs',
-                                        'MDT Prep Hrs','MDT Meet Hrs'],
-                                        id_vars=['Week Number'])
+        df_weekly_b4_unpivot = pd.melt(df_weekly_b4_avg,
+                                       value_vars=b4_hrs_cols,
+                                       id_vars=['Week Number'])
         
                        
         tab1, tab2, tab3 = st.tabs(["Waiting Lists", "Clinical & Admin","Job Plans"])
@@ -491,11 +758,11 @@ if button_run_pressed:
                     st.subheader('')
                     
                     if list_name == 'Triage Wait':
-                        y_var_targ = triage_target_input
+                        y_var_targ = result_params['target_triage_wait']
                     elif list_name == 'MDT Wait':
-                        y_var_targ = mdt_target_input
+                        y_var_targ = result_params['target_mdt_wait']
                     elif list_name == 'Asst Wait':
-                        y_var_targ = asst_target_input
+                        y_var_targ = result_params['target_asst_wait']
                 
                     fig3 = px.line(
                                 df_weekly_wt_filtered,
@@ -527,10 +794,24 @@ if button_run_pressed:
                                         y=weekly_avg_wt["value"],
                                         name='Average',line=dict(width=3,
                                         color='blue')))
-        
+
+                    # P90 wait, averaged over the runs (results saved before
+                    # it was added don't have it)
+                    p90_col = f'{list_name} P90'
+                    if p90_col in df_weekly_stats.columns:
+                        weekly_p90_wt = df_weekly_stats.groupby(
+                                        'Week Number')[p90_col].mean(
+                                        ).reset_index()
+
+                        fig3.add_trace(
+                                go.Scatter(x=weekly_p90_wt["Week Number"],
+                                        y=weekly_p90_wt[p90_col],
+                                        name='P90 Wait',line=dict(width=3,
+                                        color='orange')))
+
                     fig3.add_trace(
                                 go.Scatter(x=weekly_avg_wt["Week Number"],
-                                        y=np.repeat(y_var_targ,g.sim_duration),
+                                        y=np.repeat(y_var_targ,result_weeks),
                                         name='Target',line=dict(width=3,
                                         color='green')))
                     
@@ -546,9 +827,17 @@ if button_run_pressed:
                     fig3.update_layout(title_x=0.3,font=dict(size=10))
 
                     ##fig3.add_hline(y=y_var_targ, annotation_text="mean")
-                    
+
                     st.plotly_chart(fig3, use_container_width=True)
 
+                    breach_col = list_name.replace('Wait', 'Breach %')
+                    if breach_col in df_weekly_stats.columns:
+                        breach = df_weekly_stats.groupby('Week Number')[
+                                                breach_col].mean().iloc[-1]
+                        st.caption(f'{breach:.0f}% of patients seen by the '
+                                   f'end waited longer than the target '
+                                   f'(average over the runs)')
+
                     st.divider()
 
 
@@ -633,7 +922,7 @@ if button_run_pressed:
             fig = px.histogram(df_ref_screen_avg, 
                                 x='Week Number',
                                 y='Referral Screen Hrs',
-                                nbins=sim_duration_input,
+                                nbins=result_weeks,
                                 labels={'Referral Screen Hrs': 'Hours'},
                                 color_discrete_sequence=['green'],
                                 title=f'Referral Screening Hours by Week')
@@ -660,7 +949,7 @@ if button_run_pressed:
                 fig = px.histogram(df_triage_clin_avg, 
                                     x='Week Number',
                                     y='Triage Clin Hrs',
-                                    nbins=sim_duration_input,
+                                    nbins=result_weeks,
                                     labels={'Triage Clin Hrs': 'Hours'},
                                     color_discrete_sequence=['green'],
                                     title=f'Triage Clinical Hours by Week')
@@ -683,7 +972,7 @@ if button_run_pressed:
                 fig = px.histogram(df_triage_admin_avg, 
                                     x='Week Number',
                                     y='Triage Admin Hrs',
-                                    nbins=sim_duration_input,
+                                    nbins=result_weeks,
                                     labels={'Triage Admin Hrs': 'Hours'},
                                     color_discrete_sequence=['blue'],
                                     title=f'Triage Admin Hours by Week')
@@ -706,7 +995,7 @@ if button_run_pressed:
                 fig = px.histogram(df_triage_rej_avg, 
                                     x='Week Number',
                                     y='Triage Reject Hrs',
-                                    nbins=sim_duration_input,
+                                    nbins=result_weeks,
                                     labels={'Triage Reject Hrs': 'Hours'},
                                     color_discrete_sequence=['red'],
                                     title=f'Triage Rejection Hours by Week')
@@ -751,7 +1040,7 @@ if button_run_pressed:
                     fig = px.histogram(weekly_avg_hrs_col4, 
                                        x="Week Number",
                                        y='value',
-                                       nbins=sim_duration_input,
+                                       nbins=result_weeks,
                                        labels={"value": "Hours"},
                                        color_discrete_sequence=[chart_colour],
                                        title=f'{list_name} by Week')
@@ -784,7 +1073,7 @@ if button_run_pressed:
                     fig = px.histogram(weekly_avg_hrs_col5, 
                                        x="Week Number",
                                        y='value',
-                                       nbins=sim_duration_input,
+                                       nbins=result_weeks,
                                        labels={"value": "Hours"},
                                        color_discrete_sequence=["red"],
                                        title=f'{list_name} by Week')
@@ -813,7 +1102,7 @@ if button_run_pressed:
                 fig = px.histogram(df_mdt_prep_avg, 
                                     x='Week Number',
                                     y='MDT Prep Hrs',
-                                    nbins=sim_duration_input,
+                                    nbins=result_weeks,
                                     labels={'MDT Prep Hrs': 'Hours'},
                                     color_discrete_sequence=['blue'],
                                     title=f'MDT Prep Hours by Week')
@@ -836,7 +1125,7 @@ if button_run_pressed:
                 fig = px.histogram(df_mdt_meet_avg, 
                                     x='Week Number',
                                     y='MDT Meet Hrs',
-                                    nbins=sim_duration_input,
+                                    nbins=result_weeks,
                                     labels={'MDT Meet Hrs': 'Hours'},
                                     color_discrete_sequence=['goldenrod'],
                                     title=f'MDT Meeting Hours by Week')
@@ -859,7 +1148,7 @@ if button_run_pressed:
                 fig = px.histogram(df_mdt_rej_avg, 
                                     x='Week Number',
                                     y='MDT Reject Hrs',
-                                    nbins=sim_duration_input,
+                                    nbins=result_weeks,
                                     labels={'MDT Reject Hrs': 'Hours'},
                                     color_discrete_sequence=['red'],
                                     title=f'MDT Rejection Hours by Week')
@@ -904,7 +1193,7 @@ if button_run_pressed:
                     fig = px.histogram(weekly_avg_hrs_col9, 
                                        x="Week Number",
                                        y='value',
-                                       nbins=sim_duration_input,
+                                       nbins=result_weeks,
                                        labels={"value": "Hours"},
                                        color_discrete_sequence=[chart_colour],
                                        title=f'{list_name} by Week')
@@ -942,7 +1231,7 @@ if button_run_pressed:
                     fig = px.histogram(weekly_avg_hrs_col10, 
                                        x="Week Number",
                                        y='value',
-                                       nbins=sim_duration_input,
+                                       nbins=result_weeks,
                                        labels={"value": "Hours"},
                                        color_discrete_sequence=[chart_colour],
                                        title=f'{list_name} by Week')
@@ -969,7 +1258,7 @@ if button_run_pressed:
             fig = px.histogram(df_weekly_b6_unpivot, 
                                 x='Week Number',
                                 y='value',
-                                nbins=sim_duration_input,
+                                nbins=result_weeks,
                                 labels={'value': 'Hours'
                                         ,'variable':'Time Alloc'},
                                 color='variable',
@@ -983,7 +1272,7 @@ if button_run_pressed:
             # add line for available B4 hours
             fig.add_trace(
                                 go.Scatter(x=weekly_avg_wt["Week Number"],
-                                        y=np.repeat(total_b6_prac_hours,g.sim_duration),
+                                        y=np.repeat(result_b6_hours,result_weeks),
                                         name='Avail Hrs',line=dict(width=3,
                                         color='green')))
 
@@ -996,7 +1285,7 @@ if button_run_pressed:
             fig = px.histogram(df_weekly_b4_unpivot, 
                                 x='Week Number',
                                 y='value',
-                                nbins=sim_duration_input,
+                                nbins=result_weeks,
                                 labels={'value': 'Hours'
                                         ,'variable':'Time Alloc'},
                                 color='variable',
@@ -1010,10 +1299,82 @@ if button_run_pressed:
             # add line for available B4 hours
             fig.add_trace(
                                 go.Scatter(x=weekly_avg_wt["Week Number"],
-                                        y=np.repeat(total_b4_prac_hours,g.sim_duration),
+                                        y=np.repeat(result_b4_hours,result_weeks),
                                         name='Avail Hrs',line=dict(width=3,
                                         color='green')))
             
             st.plotly_chart(fig, use_container_width=True)
 
-            st.divider()
\ No newline at end of file
+            st.divider()
+###########################################################
+# Compare the inputs against a saved baseline, running    #
+# both with the same random numbers                       #
+###########################################################
+
+st.divider()
+st.subheader('Compare with a Baseline')
+
+st.write('Save the current inputs as the baseline, change the inputs to the '
+         'proposed set up and compare them. Both are run with the same random '
+         'numbers (each run gets the same referrals and each patient the same '
+         'rejections and durations), so the differences between them are '
+         'down to the change in inputs rather than chance and fewer runs are '
+         'needed to see them.')
+
+compare_button_cols = st.columns(2)
+
+with compare_button_cols[0]:
+    if st.button('Save Inputs as Baseline'):
+        st.session_state.baseline_params = scenario_params()
+
+baseline_params = st.session_state.get('baseline_params')
+
+with compare_button_cols[1]:
+    button_compare_pressed = st.button('Compare with Baseline',
+                                       disabled=baseline_params is None)
+
+if baseline_params is not None:
+    alternative_params = scenario_params()
+
+    changed_params = pd.DataFrame(
+        [{'Input':name, 'Baseline':value,
+          'Proposed':alternative_params.get(name)}
+         for name, value in baseline_params.items()
+         if alternative_params.get(name) != value])
+
+    if changed_params.empty:
+        st.write('The inputs are the same as the baseline.')
+    else:
+        st.write('Inputs changed from the baseline:')
+        st.dataframe(changed_params, hide_index=True)
+
+    if button_compare_pressed:
+        with st.spinner('Simulating the baseline and proposed set ups...'):
+            df_paired, df_compare = compare_scenarios(
+                                        baseline_params, alternative_params,
+                                        seed=g.random_seed,
+                                        number_of_runs=g.number_of_runs,
+                                        sim_duration=g.sim_duration)
+
+        st.write(f'Proposed minus baseline over {g.number_of_runs} paired '
+                 'runs, with 95% confidence intervals. The unpaired half '
+                 'width is what the interval would be if the two had been run '
+                 'independently.')
+        st.dataframe(df_compare.round(2), hide_index=True)
+
+        fig = go.Figure(go.Scatter(
+            x=df_compare['Output'], y=df_compare['Difference'],
+            mode='markers', marker=dict(size=10, color='blue'),
+            error_y=dict(type='data', symmetric=False,
+                         array=df_compare['CI Upper'] - df_compare['Difference'],
+                         arrayminus=(df_compare['Difference']
+                                     - df_compare['CI Lower']))))
+        fig.add_hline(y=0, line_dash='dot')
+        fig.update_layout(title='Difference from Baseline (Proposed - Baseline)',
+                          title_x=0.3, font=dict(size=10),
+                          yaxis_title='Difference')
+
+        st.plotly_chart(fig, use_container_width=True)
+
+        with st.expander('Paired results by run'):
+            st.dataframe(df_paired.round(2))
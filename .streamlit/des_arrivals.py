@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+
+# Weekly referral arrivals. The number of referrals in every week of a run is
+# sampled once at the start of the run, from a Poisson distribution with a
+# rate that can follow a profile over the year (e.g. fewer referrals in the
+# school holidays, or the pattern from historical referrals).
+#
+# Profiles are lists of weekly multipliers of g.mean_referrals_pw (averaging
+# 1), so the referrals per week input still sets the overall level. A profile
+# shorter than the run is repeated.
+
+# weeks of the year (0 = first week of January) that are mostly school
+# holidays in England - Christmas, February half term, Easter, May half term,
+# summer and October half term
+school_holiday_weeks = [0, 7, 13, 14, 21, 29, 30, 31, 32, 33, 34, 43, 51]
+
+# profile over a year where referrals in the school holidays are
+# holiday_factor times those in term time. start_week is the week of the year
+# that the simulation starts in.
+def school_term_profile(holiday_factor=0.5, start_week=0):
+    profile = np.ones(52)
+    profile[school_holiday_weeks] = holiday_factor
+    profile = profile / profile.mean()
+
+    return list(np.roll(profile, -start_week))
+
+# profile from a CSV of historical weekly referrals, taking the given column
+# (or the last column if none is given). To replay the historical numbers
+# rather than just their pattern, set g.mean_referrals_pw to their mean.
+def profile_from_csv(path, column=None):
+    df_history = pd.read_csv(path)
+    if column is None:
+        column = df_history.columns[-1]
+
+    referrals = df_history[column].to_numpy(dtype=float)
+
+    return list(referrals / referrals.mean())
+
+# referral rate for each of the given number of weeks
+def referral_rates(mean_referrals_pw, profile, weeks):
+    if profile is None:
+        return np.full(weeks, float(mean_referrals_pw))
+
+    profile = np.asarray(profile, dtype=float)
+    return mean_referrals_pw * np.resize(profile, weeks)
+
+# number of referrals in each week, from the rates and a uniform draw for each
+# week (inverting the Poisson distribution, so the same uniform gives more
+# referrals at a higher rate and 1 - u gives the antithetic number)
+def sample_referral_counts(rates, uniforms):
+    # (a rate of 0 is nudged up so the logs below stay finite)
+    rates = np.maximum(np.asarray(rates, dtype=float), 1e-12)
+    max_count = int(rates.max() + 10 * np.sqrt(rates.max()) + 10)
+
+    counts = np.arange(max_count + 1)
+    log_factorials = np.concatenate([[0.0], np.cumsum(np.log(counts[1:]))])
+
+    # Poisson cumulative probabilities for every week (rows) and count (cols)
+    log_pmf = (counts[None, :] * np.log(rates[:, None]) - rates[:, None]
+               - log_factorials[None, :])
+    cdf = np.cumsum(np.exp(log_pmf), axis=1)
+
+    return (cdf < np.asarray(uniforms)[:, None]).sum(axis=1)
@@ -0,0 +1,76 @@
+import datetime
+
+# Working day calendar for releasing the slots a day at a time
+# (g.daily_slots). Time in the model is still measured in weeks - each week's
+# slots are split between the days the service works and each day's share is
+# released on that day, rather than all of them at the start of the week.
+# Weekends and bank holidays don't release any slots, so they don't need an
+# event of their own.
+#
+# Days are counted from the start of the run, so day 0 is the first day of
+# week 0 (taken to be a Monday) and day 7 * w + d is day d of week w.
+
+# Easter Sunday in a year (the anonymous Gregorian algorithm)
+def easter_sunday(year):
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    h = (19 * a + b - d - (b - f + 1) // 3 + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return datetime.date(year, month, day + 1)
+
+# first and last given weekday (0 = Monday) of a month
+def first_weekday(year, month, weekday):
+    date = datetime.date(year, month, 1)
+    return date + datetime.timedelta((weekday - date.weekday()) % 7)
+
+def last_weekday(year, month, weekday):
+    next_month = datetime.date(year + month // 12, month % 12 + 1, 1)
+    date = next_month - datetime.timedelta(1)
+    return date - datetime.timedelta((date.weekday() - weekday) % 7)
+
+# bank holidays in England and Wales in a year. New Year's Day, Christmas Day
+# and Boxing Day are moved to the next weekday when they fall at a weekend.
+def england_bank_holidays(year):
+    easter = easter_sunday(year)
+    holidays = [easter - datetime.timedelta(2),
+                easter + datetime.timedelta(1),
+                first_weekday(year, 5, 0),
+                last_weekday(year, 5, 0),
+                last_weekday(year, 8, 0)]
+
+    for date in [datetime.date(year, 1, 1), datetime.date(year, 12, 25),
+                 datetime.date(year, 12, 26)]:
+        while date.weekday() >= 5 or date in holidays:
+            date += datetime.timedelta(1)
+        holidays.append(date)
+
+    return sorted(holidays)
+
+# days of a run starting on start_date (moved back to its Monday) that are
+# bank holidays, for g.bank_holidays
+def run_bank_holidays(start_date, weeks):
+    start = start_date - datetime.timedelta(start_date.weekday())
+    end = start + datetime.timedelta(7 * weeks)
+
+    return [(date - start).days
+            for year in range(start.year, end.year + 1)
+            for date in england_bank_holidays(year)
+            if start <= date < end]
+
+# days of a week of the run (0-6 from the start of the week) that are worked
+def working_days(week, working_weekdays, bank_holidays):
+    return [day for day in sorted(working_weekdays)
+            if 7 * week + day not in bank_holidays]
+
+# share of a week's slots released on a day of the week. The slots are split
+# evenly between the working weekdays, with any left over going to the first
+# days of the week, so a bank holiday loses that day's share.
+def day_share(slots, day, working_weekdays):
+    days = sorted(working_weekdays)
+    share, left_over = divmod(slots, len(days))
+    return share + (1 if days.index(day) < left_over else 0)
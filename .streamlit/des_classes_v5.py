@@ -1,8 +1,20 @@
 import simpy
+import heapq
 import random
 import numpy as np
 import pandas as pd
 
+from des_arrivals import referral_rates, sample_referral_counts
+from des_calendar import working_days, day_share
+from des_memory import MemoryMonitor, MemoryBudgetError, estimate_trial_mb
+from des_stats import mean_ci, p2_state, p2_add, p2_quantile
+from des_trace import (TraceBuffer, STAGE_WEEK, STAGE_REFERRAL, STAGE_TRIAGE,
+                       STAGE_PACK, STAGE_OBS, STAGE_MDT, STAGE_ASST,
+                       STAGE_DIAGNOSIS, KIND_WEEK_START,
+                       KIND_REFERRALS_GENERATED, KIND_CARRIED_OVER,
+                       KIND_REPLENISHED, KIND_ACCEPTED, KIND_REJECTED,
+                       KIND_JOINED_QUEUE, KIND_STARTED, KIND_AGED_OUT)
+
 # This model aims to simulate the flow of CYP through the ADHD clinical pathway
 # Assumptions - CYP stay on caseload until they are 18
 # only accepted referralS flow through the pathway
@@ -20,13 +32,27 @@ import pandas as pd
 # inside.
 class g:
 
-    debug_level = 0
+    # Tracing - events are recorded into a trace buffer (see des_trace.py)
+    debug_level = 0 # 0 = off, 1 = weekly events, 2 = weekly & patient events
+    trace_capacity = 100000 # number of events kept in each run's trace
+    trace_sample_rate = 1.0 # share of patients whose events are recorded
+    trace_stages = None # list of stage names to trace (None = all stages)
 
     # Referrals
     mean_referrals_pw = 60
+    referral_profile = None # weekly multipliers of mean_referrals_pw, repeated (None = constant)
     referral_rejection_rate = 0.05 # % of referrals rejected, assume 5%
     base_waiting_list = 2741 # current number of patients on waiting list
     referral_screen_time = 15
+    referral_ages = None # None = ages not modelled, or a dict of {age in years: share of referrals that age}
+    age_out_age = 18 # CYP waiting for the pathway leave it when they turn this age
+
+    # Priority - shares of referrals seen before routine ones (see priority_names)
+    urgent_referral_rate = 0.0 # % of referrals that are urgent
+    lac_referral_rate = 0.0 # % of referrals for looked after children
+    near_18_referral_rate = 0.0 # % of referrals for CYP close to turning 18 (when ages aren't modelled)
+    near_18_years = 1.0 # with referral_ages, CYP within this many years of age_out_age are Near 18
+    priority_stages = ['triage','asst'] # stages where prioritised patients jump the queue
 
     # Triage
     target_triage_wait = 4 # triage within 4 weeks
@@ -57,6 +83,8 @@ class g:
     mdt_meet_time = 60 # number of mins to do MDT
     mdt_prep_time = 90 # time take for B4 to prep case for MDT
     mdt_reject_time = 45 # time taken if patient rejected at this stage
+    mdt_batched = False # review the cases together at one meeting a week (see MdtMeeting) rather than one at a time as slots allow
+    mdt_outcome_time = 0.5 # with mdt_batched, weeks from the meeting until patients hear the outcome
 
     # Assessment
     target_asst_wait = 4 # assess within 4 weeks
@@ -68,17 +96,41 @@ class g:
     # Diagnosis
     diag_time_disch = 90 # time taken after asst if discharged
     diag_time_accept = 150 # time taken after asst if accepted
+    journey_horizons = [18, 26] # weeks from referral the % diagnosed within is reported for
+
+    # Caseloads (see ClinicianPool)
+    clinician_caseload = None # None = caseloads not modelled, or the most CYP a full time B6 clinician can have on their caseload
+    titration_weeks = 12 # mean weeks a diagnosed CYP stays on caseload for titration
+
+    # Teams (see Team)
+    teams = None # None = one team, or a list of dicts of each team's 'name' and the parameters above it has different
+    shared_stages = [] # stages ('triage', 'mdt' or 'asst') with one set of slots shared by every team
+    team_overflow = False # see patients with another team that has slots left when their own team has none
 
     # Job Plans
     number_staff_b6_prac = 9.0
     number_staff_b4_prac = 10.0
     hours_avail_b6_prac = 20.0
     hours_avail_b4_prac = 22.0
+    enforce_job_plans = False # triage, MDT and assessment wait for staff minutes left in the week (see StaffBudget)
+
+    # Calendar (see des_calendar.py)
+    daily_slots = False # release each week's slots a day's share at a time on working days, rather than all at the start of the week
+    working_weekdays = [0, 1, 2, 3, 4] # days of the week the service works (0 = Monday)
+    bank_holidays = [] # days of the run that aren't worked (0 = the first day, see run_bank_holidays)
 
     # Simulation
     sim_duration = 52
     number_of_runs = 10
     std_dev = 3 # used for randomising activity times
+    random_seed = None # base seed for a trial, run n uses seed + n (None = unseeded)
+    antithetic_runs = False # pair up runs, the 2nd of each using opposite draws
+    control_variate = False # adjust results for the number of referrals sampled
+
+    # Memory (see des_memory.py)
+    memory_tracking = None # None = off, 'rss' = sample process memory weekly, 'tracemalloc' = exact but slower
+    memory_budget_mb = None # most memory a trial can use (None = no limit)
+    record_detail = 'full' # 'full' keeps every run (so it can be extended), 'summary' only keeps the results
 
     # Result storage
     all_results = []
@@ -142,14 +194,575 @@ class Patient:
         self.diag_time_reject = 0 # time taken notifying if rejected
         self.diag_time_accept = 0 # time taken notifying if accepted
 
+        # Titration
+        self.u_titration = 0 # uniform draw scaled to how long titration takes
+
+    # Decide everything random about the patient when they are created -
+    # whether they are rejected at each stage, how long each stage takes and
+    # a standard normal draw for each activity time. This way a patient's
+    # journey doesn't depend on what other patients are doing when they use the
+    # random number generator, so the later stages of a run can be rerun on
+    # their own with the same patients (see des_stage_cache.py). rng is the
+    # run's patient random number generator, which is only used for this so
+    # patient n gets the same draws in any run with the same seed.
+    def draw_fates(self, rng):
+        # uniform draws compared against each stage's rejection rate
+        self.reject_referral = rng.uniform(0,1)
+        self.reject_triage = rng.uniform(0,1)
+        self.reject_pack = rng.uniform(0,1)
+        self.reject_obs = rng.uniform(0,1)
+        self.reject_mdt = rng.uniform(0,1)
+        self.reject_asst = rng.uniform(0,1)
+
+        # uniform draws scaled to how long each stage takes
+        self.u_triage_time = rng.uniform(0,1)
+        self.u_pack_time = rng.uniform(0,1)
+        self.u_obs_time = rng.uniform(0,1)
+        self.u_mdt_time = rng.uniform(0,1)
+        self.u_asst_time = rng.uniform(0,1)
+
+        # standard normal draws for the activity times in minutes
+        self.z_mins = {activity:rng.gauss(0, 1)
+                       for activity in activity_names}
+
+    # Decide the patient's age and priority (see priority_names) using the
+    # team's parameters. The age is picked from the shares of referrals at
+    # each age (anywhere within that year), and the week the patient ages out
+    # worked out from it. The priority is from a uniform draw compared against
+    # the shares of each priority, with CYP close to aging out Near 18 when
+    # ages are modelled. rng is kept apart from the one used in draw_fates, so
+    # these don't change any of the patient's other draws.
+    def draw_referral(self, rng, team):
+        u_priority = rng.uniform(0,1)
+        u_age = rng.uniform(0,1)
+        u_age_in_year = rng.uniform(0,1)
+
+        self.age = np.nan
+        self.age_out_week = None
+        if team.referral_ages is not None:
+            ages = sorted(team.referral_ages)
+            shares = np.cumsum([team.referral_ages[age] for age in ages])
+            year = ages[min(np.searchsorted(shares, u_age * shares[-1],
+                                            side='right'), len(ages) - 1)]
+            self.age = year + u_age_in_year
+            years_left = team.age_out_age - self.age
+            self.age_out_week = self.week_added + years_left * weeks_per_year
+
+        rates = [team.urgent_referral_rate, team.lac_referral_rate]
+        if team.referral_ages is None:
+            rates.append(team.near_18_referral_rate)
+
+        self.priority = PRIORITY_ROUTINE
+        for priority, rate in enumerate(rates):
+            if u_priority < rate:
+                self.priority = priority
+                break
+            u_priority -= rate
+
+        if (self.priority == PRIORITY_ROUTINE
+                and self.age >= team.age_out_age - team.near_18_years):
+            self.priority = priority_names.index('Near 18')
+
+# priorities patients can have, in the order they are seen (a patient with more
+# than one reason to be prioritised has the first)
+priority_names = ['Urgent','LAC','Near 18','Routine']
+PRIORITY_ROUTINE = priority_names.index('Routine')
+
+# weeks in a year, for turning ages into weeks
+weeks_per_year = 52
+
+# stages patients queue for as they are recorded in the trace
+queue_trace_stages = {'triage':STAGE_TRIAGE, 'mdt':STAGE_MDT,
+                      'asst':STAGE_ASST}
+
+# activities that have a time in minutes recorded against them
+activity_names = ['referral_screen','triage_clin','triage_admin',
+                  'triage_disch','pack_admin','pack_reject','obs_visit',
+                  'obs_reject','mdt_prep','mdt_meet','mdt_reject','asst_clin',
+                  'asst_admin','diag_disch','diag_accept']
+
+# weekly stats column (running total in minutes) each activity is added to
+activity_mins_cols = {'referral_screen':'Referral Screen Mins',
+                      'triage_clin':'Triage Clin Mins',
+                      'triage_admin':'Triage Admin Mins',
+                      'triage_disch':'Triage Reject Mins',
+                      'pack_admin':'Pack Send Mins',
+                      'pack_reject':'Pack Reject Mins',
+                      'obs_visit':'Obs Visit Mins',
+                      'obs_reject':'Obs Reject Mins',
+                      'mdt_prep':'MDT Prep Mins', 'mdt_meet':'MDT Meet Mins',
+                      'mdt_reject':'MDT Reject Mins',
+                      'asst_clin':'Asst Clin Mins',
+                      'asst_admin':'Asst Admin Mins',
+                      'diag_disch':'Diag Reject Mins',
+                      'diag_accept':'Diag Accept Mins'}
+
+# band of staff doing each activity (as in the Job Plans tab)
+activity_bands = {'referral_screen':'b6', 'triage_clin':'b6',
+                  'triage_admin':'b6', 'triage_disch':'b6', 'pack_admin':'b4',
+                  'pack_reject':'b6', 'obs_visit':'b4', 'obs_reject':'b6',
+                  'mdt_prep':'b4', 'mdt_meet':'b4', 'mdt_reject':'b6',
+                  'asst_clin':'b6', 'asst_admin':'b6', 'diag_disch':'b6',
+                  'diag_accept':'b6'}
+
+# activities done once a patient has got a slot at each stage, which wait for
+# staff time with g.enforce_job_plans (all done by one band)
+stage_activities = {'triage':['triage_clin','triage_admin'],
+                    'mdt':['mdt_prep','mdt_meet'],
+                    'asst':['asst_clin','asst_admin']}
+waiting_activities = {activity for activities in stage_activities.values()
+                      for activity in activities}
+
+# stages of the pathway in order. Each stage only depends on the ones before
+# it, so a run can be restarted from any stage (see des_stage_cache.py)
+pathway_stages = ['referral','triage','mdt','asst']
+
+# stages patients queue for
+queue_stages = pathway_stages[1:]
+
+# quantile of each stage's waits reported in the weekly stats (P90)
+wait_quantile = 0.9
+
+# Class representing one of the teams (localities) running the pathway in a
+# run. A team has its own referrals and slots, and any parameter it doesn't
+# set itself (e.g. team.triage_resource) is the same as in g. Stages in
+# g.shared_stages have one set of slots (g's number) shared by every team.
+class Team:
+    def __init__(self, name, params=None):
+        self.name = name
+        self.params = dict(params or {})
+        for param in self.params:
+            if not hasattr(g, param):
+                raise AttributeError(f"g has no parameter called '{param}'")
+
+        # number of referrals for every week of the run, sampled up front
+        self.arrival_schedule = []
+        self.referrals = 0
+
+        # the slots the team's patients wait for at each stage (set up by
+        # Model.week_runner), the number of them waiting and the number seen
+        # by another team (see g.team_overflow)
+        self.slots = {}
+        self.number_on_wl = {stage:0 for stage in queue_stages}
+        self.seen_elsewhere = 0
+
+        # the clinicians whose caseloads the team's patients go on (only when
+        # caseloads are modelled, see ClinicianPool)
+        self.clinicians = None
+
+        # each band's minutes for the week (only with g.enforce_job_plans,
+        # see StaffBudget)
+        self.staff_budgets = None
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        params = self.__dict__.get('params', {})
+        if name in params:
+            return params[name]
+        return getattr(g, name)
+
+# the teams for a run from g.teams (a single team using g's parameters if
+# there are none)
+def model_teams():
+    if not g.teams:
+        return [Team('All')]
+
+    teams = []
+    for i, team_params in enumerate(g.teams):
+        params = dict(team_params)
+        teams.append(Team(params.pop('name', f'Team {i + 1}'), params))
+    return teams
+
+# columns of the journey stats kept for each referral week - the number of
+# patients diagnosed (or discharged after their assessment), their total time
+# from referral to diagnosis, then the number diagnosed within each of
+# g.journey_horizons
+DIAGNOSED, JOURNEY_TOTAL, DIAGNOSED_WITHIN = 0, 1, 2
+
+# Referral to diagnosis journeys of each cohort of patients (those referred in
+# the same week) at the end of a run, worked out from the cohorts' journey
+# stats and P90 sketches. The % diagnosed within each horizon is of all the
+# cohort's referrals, and only known for cohorts referred at least that long
+# before the end of the run. Returns a dict of columns.
+def journey_cohorts(referrals_per_week, journey_stats, journey_sketches,
+                    run_end):
+    weeks = len(referrals_per_week)
+    referrals = np.asarray(referrals_per_week, dtype=float)
+
+    # cohorts nobody from has been diagnosed yet may not have a row
+    stats = np.zeros((weeks, journey_stats.shape[1]))
+    stats[:len(journey_stats)] = journey_stats[:weeks]
+    sketches = np.zeros((weeks, journey_sketches.shape[1]))
+    sketches[:len(journey_sketches)] = journey_sketches[:weeks]
+
+    diagnosed = stats[:, DIAGNOSED]
+    cohorts = {
+        'Referral Week':np.arange(weeks),
+        'Referrals':referrals,
+        'Diagnosed':diagnosed,
+        'Mean Journey':np.where(diagnosed > 0,
+                                stats[:, JOURNEY_TOTAL]
+                                / np.maximum(diagnosed, 1), np.nan),
+        'Journey P90':np.array([p2_quantile(sketch, wait_quantile)
+                                for sketch in sketches]),
+        }
+
+    for i, horizon in enumerate(g.journey_horizons):
+        known = (np.arange(weeks) + horizon < run_end) & (referrals > 0)
+        cohorts[f'Diagnosed in {horizon} Weeks %'] = np.where(
+            known,
+            100 * stats[:, DIAGNOSED_WITHIN + i] / np.maximum(referrals, 1),
+            np.nan)
+
+    return cohorts
+
+# Random number generator giving the opposite (antithetic) draws to a
+# random.Random with the same seed - uniform draws u become 1 - u and normal
+# draws z become -z - so the two runs of an antithetic pair are negatively
+# correlated and their average varies less than that of two independent runs
+class AntitheticRandom(random.Random):
+    def uniform(self, a, b):
+        return a + b - super().uniform(a, b)
+
+    def gauss(self, mu=0.0, sigma=1.0):
+        return 2 * mu - super().gauss(mu, sigma)
+
+# outputs of each run stored in Trial.df_trial_results
+trial_output_cols = ['Mean Q Time Triage','Max Triage WL','Mean Q Time MDT',
+                     'Max MDT WL','Mean Q Time Asst','Max Asst WL']
+
+# mean of each output in df_trial_results with its 95% confidence interval.
+# The intervals are worked out from the pairs of runs, as the two runs in an
+# antithetic pair aren't independent.
+def results_summary(df_trial_results):
+    df_pairs = df_trial_results.groupby('Pair')[trial_output_cols].mean()
+
+    rows = []
+    for col in trial_output_cols:
+        mean, half_width = mean_ci(df_pairs[col])
+        rows.append({'Output':col, 'Mean':mean,
+                     'CI Lower':mean - half_width,
+                     'CI Upper':mean + half_width,
+                     'Half Width':half_width})
+
+    return pd.DataFrame(rows)
+
+# time in weeks a stage takes, to 1 decimal place. This is at least 0.1 weeks
+# so a patient never moves on to the next stage at the same instant they were
+# seen - the order of events at each stage then only depends on when patients
+# arrive at it, which the stage cache relies on to replay later stages exactly.
+def stage_duration(weeks):
+    return max(round(weeks, 1), 0.1)
+
+# Class representing the end of a week. This is a timeout that is dealt with
+# before anything else happening at the same time, so the weekly results are
+# always taken (and the slots topped up) before anyone moves in the new week.
+# With g.daily_slots it is also used for the start of each working day, so
+# the day's slots are always released before anyone arrives that day.
+class EndOfWeek(simpy.events.Timeout):
+    def __init__(self, env, delay=1):
+        self.env = env
+        self.callbacks = []
+        self._value = None
+        self._delay = delay
+        self._ok = True
+        env.schedule(self, simpy.events.URGENT, delay)
+
+# Class representing the requests waiting for a PriorityContainer's slots,
+# kept as a binary heap ordered by priority and then the order they were made
+# in (so patients with the same priority are first come first served). SimPy
+# only ever looks at and takes the request at the front - a container can't
+# give a slot to anyone behind a request still waiting - so adding and taking
+# requests are O(log n) however long the waiting list gets.
+#
+# Cancelled requests (e.g. patients aging out) are only marked as removed and
+# left in the heap until they reach the front, so cancelling is O(1) rather
+# than searching the heap for them. The heap is rebuilt without them if they
+# ever make up most of it.
+class PriorityQueue:
+    def __init__(self):
+        self.heap = []
+        self.requests_made = 0
+        self.waiting = 0
+
+    def append(self, request):
+        request.queue_entry = [request.priority, self.requests_made, request]
+        heapq.heappush(self.heap, request.queue_entry)
+        self.requests_made += 1
+        self.waiting += 1
+
+    # throw away cancelled requests that have reached the front
+    def drop_removed(self):
+        while self.heap and self.heap[0][2] is None:
+            heapq.heappop(self.heap)
+
+    def __getitem__(self, index):
+        if index != 0:
+            raise IndexError('only the front of a PriorityQueue can be read')
+        self.drop_removed()
+        return self.heap[0][2]
+
+    def pop(self, index=0):
+        if index != 0:
+            raise IndexError('only the front of a PriorityQueue can be taken')
+        self.drop_removed()
+        self.waiting -= 1
+        return heapq.heappop(self.heap)[2]
+
+    def remove(self, request):
+        request.queue_entry[2] = None
+        self.waiting -= 1
+
+        if len(self.heap) > 2 * self.waiting + 64:
+            self.heap = [entry for entry in self.heap if entry[2] is not None]
+            heapq.heapify(self.heap)
+
+    def __len__(self):
+        return self.waiting
+
+# Class representing a request for slots from a PriorityContainer
+class PriorityGet(simpy.resources.container.ContainerGet):
+    def __init__(self, resource, amount, priority):
+        self.priority = priority
+        super().__init__(resource, amount)
+
+# Class representing a stage's appointment slots that keeps running totals,
+# over time, of the slots used and the patients waiting for one. The totals
+# are brought up to date just before anything can change - a patient asking
+# for a slot, or slots being given out or topped up - so they only cost a
+# couple of sums each time, and week_averages reads them off at the end of
+# each week.
+class MonitoredContainer(simpy.Container):
+    def __init__(self, env, capacity, init):
+        super().__init__(env, capacity=capacity, init=init)
+        # number on the waiting list for these slots, counted from when
+        # patients join it until they carry on after getting a slot
+        self.number_on_wl = 0
+
+        self.last_change = env.now
+        self.used_time = 0.0
+        self.waiting_time = 0.0
+        self.week_start = env.now
+
+    # add the time since the last change to the running totals
+    def update_totals(self):
+        elapsed = self._env.now - self.last_change
+        if elapsed > 0:
+            self.used_time += (self._capacity - self._level) * elapsed
+            self.waiting_time += len(self.get_queue) * elapsed
+            self.last_change = self._env.now
+
+    def get(self, amount):
+        self.update_totals()
+        return simpy.resources.container.ContainerGet(self, amount)
+
+    def _trigger_get(self, put_event):
+        self.update_totals()
+        super()._trigger_get(put_event)
+
+    def _trigger_put(self, get_event):
+        self.update_totals()
+        super()._trigger_put(get_event)
+
+    # the % of the slots in use and the number of patients waiting, averaged
+    # over the time since this was last called (NaN if no time has passed).
+    # Starts the totals again for the next week.
+    def week_averages(self):
+        self.update_totals()
+        elapsed = self._env.now - self.week_start
+        if elapsed > 0:
+            utilisation = 100 * self.used_time / (self._capacity * elapsed)
+            avg_waiting = self.waiting_time / elapsed
+        else:
+            utilisation = avg_waiting = np.nan
+
+        self.used_time = self.waiting_time = 0.0
+        self.week_start = self._env.now
+        return utilisation, avg_waiting
+
+# Class representing a stage's appointment slots given out to the patients
+# waiting in order of priority (see PriorityQueue). Slots topped up each week
+# go to the highest priority patients waiting.
+class PriorityContainer(MonitoredContainer):
+    GetQueue = PriorityQueue
+
+    def get(self, amount, priority=PRIORITY_ROUTINE):
+        self.update_totals()
+        return PriorityGet(self, amount, priority)
+
+# Class representing the B6 clinicians who hold CYP on their caseloads, from
+# just before their assessment until they have finished titration (or are
+# discharged after it). There is a clinician for each WTE (rounding up, with
+# the last one part time and a smaller caseload). CYP wait for space on any
+# caseload in order of priority, then go to the clinician with the most space
+# left. The clinicians are kept in a heap of (caseload - limit, clinician),
+# with a new entry pushed whenever a caseload changes and out of date ones
+# thrown away as they reach the top, so finding the least loaded clinician
+# stays quick with thousands of CYP on caseloads.
+class ClinicianPool:
+    def __init__(self, env, wte, caseload):
+        whole = int(wte)
+        self.limits = [caseload] * whole
+        if wte > whole:
+            self.limits.append(max(1, round(caseload * (wte - whole))))
+        self.loads = [0] * len(self.limits)
+
+        self.heap = [(-limit, clinician)
+                     for clinician, limit in enumerate(self.limits)]
+        heapq.heapify(self.heap)
+
+        # spaces on the caseloads, which CYP wait for
+        self.places = PriorityContainer(env, capacity=sum(self.limits),
+                                        init=sum(self.limits))
+
+    # put a CYP who has been given a space on the least loaded caseload,
+    # returning the clinician
+    def assign(self):
+        while True:
+            space, clinician = self.heap[0]
+            if space == self.loads[clinician] - self.limits[clinician]:
+                break
+            heapq.heappop(self.heap)
+
+        self.change(clinician, 1)
+        return clinician
+
+    # take a CYP off a clinician's caseload, freeing up the space
+    def release(self, clinician):
+        self.change(clinician, -1)
+        self.places.put(1)
+
+    def change(self, clinician, amount):
+        self.loads[clinician] += amount
+        heapq.heappush(self.heap, (self.loads[clinician]
+                                   - self.limits[clinician], clinician))
+
+        if len(self.heap) > 4 * len(self.loads) + 64:
+            self.heap = [(load - limit, clinician) for clinician, (load, limit)
+                         in enumerate(zip(self.loads, self.limits))]
+            heapq.heapify(self.heap)
+
+    # number of CYP on the caseloads (including any given a space who are
+    # about to be put on one) and waiting for a space
+    def on_caseload(self):
+        return self.places.capacity - self.places.level
+
+    def waiting(self):
+        return len(self.places.get_queue)
+
+# Class representing the weekly MDT meeting (with g.mdt_batched). Cases wait
+# for the meeting in order of priority and are never given a place in
+# between - the meeting takes up to its number of places of them off the
+# waiting list in one go, and they all hear the outcome together (see
+# Model.mdt_meeting). The slots left are the places the last meeting didn't
+# fill.
+class MdtMeeting(PriorityContainer):
+    # cases are only ever taken at the meeting
+    def _do_get(self, event):
+        return False
+
+    def hold_meeting(self):
+        self.update_totals()
+        reviewed = 0
+        while self.get_queue and reviewed < self._capacity:
+            self.get_queue.pop(0).succeed()
+            reviewed += 1
+        self._level = self._capacity - reviewed
+
+# Class representing a band's staff minutes for the week from their job plans
+# (WTE x hours available per WTE). Triage, MDT and assessment work waits
+# until there are enough minutes left, in order of priority. The rest of the
+# work (screening referrals, sending packs, observations and letting patients
+# know they've been discharged) can't be put off, so it is charged straight
+# away, with anything over what's left counted as overtime. The minutes used
+# and the overtime are kept up to date as the work is done and read off at
+# the end of each week.
+class StaffBudget(PriorityContainer):
+    def __init__(self, env, minutes):
+        super().__init__(env, capacity=minutes, init=minutes)
+        self.overtime = 0.0
+
+    def charge(self, minutes):
+        self.update_totals()
+        from_budget = min(minutes, self._level)
+        self._level -= from_budget
+        self.overtime += minutes - from_budget
+
+    # the minutes used and the overtime this week, before the budget is
+    # topped up. Starts the overtime again for the next week.
+    def week_ledger(self):
+        used, overtime = self._capacity - self._level, self.overtime
+        self.overtime = 0.0
+        return used, overtime
+
 # Class representing our model of the ADHD clinical pathway
 class Model:
     # Constructor to set up the model for a run. We pass in a run number when
-    # we create a new model
-    def __init__(self, run_number):
+    # we create a new model, and optionally a StageCache so the earlier stages
+    # of the pathway can be reused between runs with the same seed. antithetic
+    # runs use the opposite patient draws to the run with the same seed. A
+    # MemoryMonitor can be passed in to sample the memory in use every week.
+    def __init__(self, run_number, seed=None, stage_cache=None,
+                 antithetic=False, memory=None):
         # Create a SimPy environment in which everything will live
         self.env = simpy.Environment()
 
+        # seed used for the random number generators in this run (None = unseeded)
+        self.seed = seed
+
+        # random number generator for the patients' own draws, kept apart from
+        # the one used for the number of referrals so two scenarios run with
+        # the same seed give patient n the same draws (common random numbers)
+        self.antithetic = antithetic
+        if antithetic:
+            self.patient_rng = AntitheticRandom(f'{seed} patients')
+        elif seed is not None:
+            self.patient_rng = random.Random(f'{seed} patients')
+        else:
+            self.patient_rng = random.Random()
+
+        # and one for the patients' priorities, so changing how many patients
+        # are prioritised leaves their other draws the same
+        if antithetic:
+            self.priority_rng = AntitheticRandom(f'{seed} priority')
+        elif seed is not None:
+            self.priority_rng = random.Random(f'{seed} priority')
+        else:
+            self.priority_rng = random.Random()
+
+        # and one for how long patients spend in titration
+        if antithetic:
+            self.titration_rng = AntitheticRandom(f'{seed} titration')
+        elif seed is not None:
+            self.titration_rng = random.Random(f'{seed} titration')
+        else:
+            self.titration_rng = random.Random()
+
+        # number of referrals for every week of the run, sampled up front
+        self.arrival_schedule = []
+        self.referral_rates = []
+        # number of referrals made each week so far (used as a control variate)
+        self.referrals_per_week = []
+
+        # teams running the pathway (see Team)
+        self.teams = model_teams()
+
+        # unseeded runs can't be repeated so there is nothing to cache, the
+        # stage cache doesn't know about teams, and with g.enforce_job_plans
+        # the stages share staff time so a later stage can change how the
+        # earlier ones play out
+        self.stage_cache = stage_cache if seed is not None else None
+        if g.teams or g.enforce_job_plans:
+            self.stage_cache = None
+        # stage the run starts from and the cached stages before it
+        self.start_stage = 'referral'
+        self.cached_stage = None
+        # arrivals into each stage as (time, patient) for the stage cache
+        self.stage_streams = {stage:[] for stage in pathway_stages[1:]}
+
+        self.memory = memory
+
         # # Create counters for various metrics we want to record
         self.patient_counter = 0
         self.run_number = run_number
@@ -166,6 +779,8 @@ class Model:
         self.results_df['Run Number'] = [0]
         self.results_df['Referral Time Screen'] = [0]
         self.results_df['Referral Rejected'] = [0.0]
+        self.results_df['Priority'] = ['Routine']
+        self.results_df['Age'] = [np.nan]
         # Triage
         self.results_df['Q Time Triage'] = [0.0]
         self.results_df['Time to Triage'] = [0.0]
@@ -206,6 +821,13 @@ class Model:
         # Diagnosis
         self.results_df['Diag Rejected Time'] = [0.0]
         self.results_df['Diag Accepted Time'] = [0.0]
+        # Caseload
+        self.results_df['Q Time Caseload'] = [0.0]
+        self.results_df['Clinician'] = [np.nan]
+        self.results_df['Titration Weeks'] = [0.0]
+        # Team (only when there are teams)
+        if g.teams:
+            self.results_df['Team'] = [None]
         # Indexing
         self.results_df.set_index("Patient ID", inplace=True)
 
@@ -215,58 +837,114 @@ class Model:
         self.mean_q_time_mdt = 0
         self.mean_q_time_asst = 0
 
-    # random number generator for activity times
-    def random_normal(self, mean, std_dev):
-        while True:
-            activity_time = random.gauss(mean, std_dev)
-            if activity_time > 0:
-                return activity_time
+        # Streaming metrics of the waits at each stage, updated as each
+        # patient is seen rather than worked out from every patient's wait -
+        # a P-squared sketch for the P90 (see des_stats.py) and the number of
+        # waits seen and over the stage's target
+        self.wait_sketches = {stage:p2_state() for stage in queue_stages}
+        self.waits_seen = {stage:0 for stage in queue_stages}
+        self.waits_over_target = {stage:0 for stage in queue_stages}
+
+        # journey stats and P90 sketch of the referral to diagnosis times for
+        # each referral week, updated as each patient is diagnosed (see
+        # journey_cohorts)
+        self.journey_stats = np.zeros((0, DIAGNOSED_WITHIN
+                                       + len(g.journey_horizons)))
+        self.journey_sketches = np.zeros((0, len(p2_state())))
+
+        # number of patients part way through each stage (seen and waiting
+        # for the stage to finish), for the end of week snapshots
+        self.in_progress = {stage:0 for stage in queue_stages}
+
+        # number of patients who aged out (see g.referral_ages) while waiting
+        # for each stage
+        self.aged_out = {stage:0 for stage in queue_stages}
+
+        # number of patients in titration, for the end of week snapshots
+        self.in_titration = 0
+
+        # weekly stats for each team (only when there are teams)
+        self.team_weekly_stats = [] if g.teams else None
+
+        # Trace of events in this run, only kept when debugging
+        if g.debug_level >= 1:
+            self.trace = TraceBuffer(g.trace_capacity, g.trace_sample_rate,
+                                     g.trace_stages,
+                                     patient_events=g.debug_level >= 2)
+        else:
+            self.trace = None
 
     def week_runner(self,number_of_weeks):
 
         # week counter
         self.week_number = 0
 
+        # last week to run to - this is moved on if the run is extended
+        self.horizon = number_of_weeks
+
         # list to hold weekly statistics
         self.df_weekly_stats = []
 
         # Create our resources which are appt slots for that week
         # SR comment - I've moved this outside of the weekly for loop
         # as you were both regenerating and starting afresh with the resource
-        self.triage_res = simpy.Container(
-            self.env,capacity=g.triage_resource,
-            init=g.triage_resource
-            )
-
-        self.mdt_res = simpy.Container(
-            self.env,
-            capacity=g.mdt_resource,
-            init=g.mdt_resource
-            )
-
-        self.asst_res = simpy.Container(
-            self.env,
-            capacity=g.asst_resource,
-            init=g.asst_resource
-            )
-
-
-        while self.week_number <= number_of_weeks:
-            if g.debug_level >= 1:
-                print(
-                    f"""
-    ##################################
-    # Week {self.week_number}
-    ##################################
-                    """
-                    )
-            
-            # Start up the referral generator function
-            self.env.process(self.generator_patient_referrals())
+        # (monitored so the weekly stats can show how busy each stage is).
+        # Each team has its own slots for a stage unless they are shared.
+        self.stage_slots = {stage:[] for stage in queue_stages}
+        for stage in queue_stages:
+            for team in self.teams:
+                if stage in g.shared_stages and self.stage_slots[stage]:
+                    team.slots[stage] = self.stage_slots[stage][0]
+                    continue
+
+                slots = (getattr(g, f'{stage}_resource')
+                         if stage in g.shared_stages
+                         else getattr(team, f'{stage}_resource'))
+                slots_class = (MdtMeeting if stage == 'mdt' and g.mdt_batched
+                               else PriorityContainer)
+                team.slots[stage] = slots_class(self.env, capacity=slots,
+                                                init=slots)
+                self.stage_slots[stage].append(team.slots[stage])
+
+        # the clinicians each team's patients go on the caseloads of, shared
+        # by every team if assessment is
+        self.clinician_pools = []
+        if g.clinician_caseload is not None:
+            for team in self.teams:
+                if 'asst' in g.shared_stages and self.clinician_pools:
+                    team.clinicians = self.clinician_pools[0]
+                    continue
+
+                source = g if 'asst' in g.shared_stages else team
+                team.clinicians = ClinicianPool(self.env,
+                                                source.number_staff_b6_prac,
+                                                source.clinician_caseload)
+                self.clinician_pools.append(team.clinicians)
+
+        # each team's staff minutes for the week
+        self.staff_budgets = {'b6':[], 'b4':[]}
+        if g.enforce_job_plans:
+            for team in self.teams:
+                team.staff_budgets = {
+                    band:StaffBudget(self.env, 60
+                        * getattr(team, f'number_staff_{band}_prac')
+                        * getattr(team, f'hours_avail_{band}_prac'))
+                    for band in self.staff_budgets}
+                for band, budget in team.staff_budgets.items():
+                    self.staff_budgets[band].append(budget)
+
+        while self.week_number <= self.horizon:
+            if self.trace is not None:
+                self.trace.record(-1, STAGE_WEEK, KIND_WEEK_START,
+                                  self.env.now, value=self.week_number)
+
+            # Create this week's referrals (unless the referrals are being
+            # replayed from the stage cache)
+            if self.start_stage == 'referral':
+                self.generate_referrals()
 
             self.referral_tot_screen = self.results_df['Referral Time Screen'
                                                                         ].sum()
-            self.max_triage_wl = self.results_df["Triage WL Posn"].max()
             self.triage_rej = self.results_df["Triage Rejected"].sum()
             self.triage_avg_wait = self.results_df["Q Time Triage"].mean()
             self.triage_tot_clin = self.results_df['Triage Mins Clin'].sum()
@@ -280,26 +958,71 @@ class Model:
             self.obs_tot_rej = self.results_df["Time Obs Reject"].sum()
             self.mdt_tot_prep = self.results_df["Time Prep MDT"].sum()
             self.mdt_tot_meet = self.results_df["Time Meet MDT"].sum()
-            self.max_mdt_wl = self.results_df["MDT WL Posn"].max()
             self.mdt_tot_rej = self.results_df["MDT Time Reject"].sum()
             self.mdt_rej = self.results_df["MDT Rejected"].sum()
             self.mdt_avg_wait = self.results_df["Q Time MDT"].mean()
-            self.max_asst_wl = self.results_df["Asst WL Posn"].max()
             self.asst_rej = self.results_df["Asst Rejected"].sum()
             self.asst_avg_wait = self.results_df["Q Time Asst"].mean()
             self.asst_tot_clin = self.results_df['Asst Mins Clin'].sum()
             self.asst_tot_admin = self.results_df['Asst Mins Admin'].sum()
             self.diag_tot_rej = self.results_df['Diag Rejected Time'].sum()
             self.diag_tot_acc = self.results_df['Diag Accepted Time'].sum()
+            self.triage_p90_wait, self.triage_breach = \
+                                                self.wait_metrics('triage')
+            self.mdt_p90_wait, self.mdt_breach = self.wait_metrics('mdt')
+            self.asst_p90_wait, self.asst_breach = self.wait_metrics('asst')
+
+            # snapshot of where everyone is at the end of the week (before any
+            # slots are topped up) - the patients waiting for each resource,
+            # the slots left unused and the patients part way through each
+            # stage. For triage that includes waiting for the pack and
+            # observations to come back. Along with the number waiting and
+            # the % of the slots used on average over the week (over all the
+            # teams' slots). The waiting list for each stage is the number
+            # waiting on it now.
+            week_snapshot = {}
+            for stage, label in zip(queue_stages, ['Triage','MDT','Asst']):
+                week_averages = [res.week_averages()
+                                 for res in self.stage_slots[stage]]
+                capacity = sum(res.capacity for res in self.stage_slots[stage])
+                week_snapshot[f'{label} Queue'] = sum(
+                    len(res.get_queue) for res in self.stage_slots[stage])
+                week_snapshot[f'{label} Slots Left'] = sum(
+                    res.level for res in self.stage_slots[stage])
+                week_snapshot[f'{label} In Progress'] = self.in_progress[stage]
+                week_snapshot[f'{label} Avg Queue'] = sum(
+                    avg_waiting for utilisation, avg_waiting in week_averages)
+                week_snapshot[f'{label} Utilisation %'] = sum(
+                    utilisation * res.capacity
+                    for (utilisation, avg_waiting), res
+                    in zip(week_averages, self.stage_slots[stage])) / capacity
+
+            # the staff minutes used and the overtime this week (over all the
+            # teams), and the work waiting for staff time
+            staff_ledger = {}
+            if g.enforce_job_plans:
+                for band, label in zip(self.staff_budgets, ['B6','B4']):
+                    budgets = self.staff_budgets[band]
+                    ledgers = [budget.week_ledger() for budget in budgets]
+                    used = sum(used for used, overtime in ledgers)
+                    staff_ledger[f'{label} Used Mins'] = used
+                    staff_ledger[f'{label} Overtime Mins'] = sum(
+                        overtime for used, overtime in ledgers)
+                    staff_ledger[f'{label} Utilisation %'] = 100 * used / sum(
+                        budget.capacity for budget in budgets)
+                    staff_ledger[f'{label} Staff Queue'] = sum(
+                        len(budget.get_queue) for budget in budgets)
 
             # weekly waiting list positions
             self.df_weekly_stats.append(
                 {
                  'Week Number':self.week_number,
                  'Referral Screen Mins':self.referral_tot_screen,   
-                 'Triage WL':self.max_triage_wl,
+                 'Triage WL':week_snapshot['Triage Queue'],
                  'Triage Rejects':self.triage_rej,
                  'Triage Wait':self.triage_avg_wait,
+                 'Triage Wait P90':self.triage_p90_wait,
+                 'Triage Breach %':self.triage_breach,
                  'Triage Clin Mins':self.triage_tot_clin,
                  'Triage Admin Mins':self.triage_tot_admin,
                  'Triage Reject Mins':self.triage_tot_reject,
@@ -311,19 +1034,39 @@ class Model:
                  'Obs Reject Mins':self.obs_tot_rej,
                  'MDT Prep Mins':self.mdt_tot_prep,
                  'MDT Meet Mins':self.mdt_tot_meet,
-                 'MDT WL':self.max_mdt_wl,
+                 'MDT WL':week_snapshot['MDT Queue'],
                  'MDT Rejects':self.mdt_rej,
                  'MDT Reject Mins':self.mdt_tot_rej,
                  'MDT Wait':self.mdt_avg_wait,
-                 'Asst WL':self.max_asst_wl,
+                 'MDT Wait P90':self.mdt_p90_wait,
+                 'MDT Breach %':self.mdt_breach,
+                 'Asst WL':week_snapshot['Asst Queue'],
                  'Asst Rejects':self.asst_rej,
                  'Asst Wait':self.asst_avg_wait,
+                 'Asst Wait P90':self.asst_p90_wait,
+                 'Asst Breach %':self.asst_breach,
                  'Asst Clin Mins':self.asst_tot_clin,
                  'Asst Admin Mins':self.asst_tot_admin,
                  'Diag Reject Mins':self.diag_tot_rej,
                  'Diag Accept Mins':self.diag_tot_acc,
+                 **week_snapshot,
+                 'Triage Aged Out':self.aged_out['triage'],
+                 'MDT Aged Out':self.aged_out['mdt'],
+                 'Asst Aged Out':self.aged_out['asst'],
+                 'Caseload':sum(pool.on_caseload()
+                                for pool in self.clinician_pools),
+                 'Caseload Queue':sum(pool.waiting()
+                                      for pool in self.clinician_pools),
+                 'In Titration':self.in_titration,
+                 **staff_ledger,
                 }
                 )
+
+            if self.team_weekly_stats is not None:
+                self.record_team_stats()
+
+            if self.memory is not None:
+                self.memory.sample()
             
                      
             # replenish resources ready for next week
@@ -333,47 +1076,24 @@ class Model:
             # We can't just set the level back to maximum because we can't directly overwrite the
             # level attribute ourselves.
             # So we need to do an extra step of calculation
+            # (with g.daily_slots only the first day's share is released now,
+            # and the rest on the week's other working days)
+            if g.daily_slots:
+                self.schedule_daily_slots()
+            else:
+                self.release_slots()
 
-            triage_amount_to_fill = g.triage_resource - self.triage_res.level
-            mdt_amount_to_fill = g.mdt_resource - self.mdt_res.level
-            asst_amount_to_fill = g.asst_resource - self.asst_res.level
-
-            if triage_amount_to_fill > 0:
-                if g.debug_level >= 2:
-                    print(f"Triage Level: {self.triage_res.level}")
-                    print(f"Putting in {triage_amount_to_fill}")
-
-                self.triage_res.put(triage_amount_to_fill)
-
-                if g.debug_level >= 2:
-                    print(f"New Triage Level: {self.triage_res.level}")
-
-            if mdt_amount_to_fill > 0:
-                if g.debug_level >= 2:
-                    print(f"MDT Level: {self.mdt_res.level}")
-                    print(f"Putting in {mdt_amount_to_fill}")
-
-                self.mdt_res.put(mdt_amount_to_fill)
-
-                if g.debug_level >= 2:
-                    print(f"New MDT Level: {self.mdt_res.level}")
-
-            if asst_amount_to_fill > 0:
-                if g.debug_level >= 2:
-                    print(f"Asst Level: {self.asst_res.level}")
-                    print(f"Putting in {asst_amount_to_fill}")
-
-                self.asst_res.put(asst_amount_to_fill)
-
-                if g.debug_level >= 2:
-                    print(f"New asst Level: {self.mdt_res.level}")
+            for budgets in self.staff_budgets.values():
+                for budget in budgets:
+                    if budget.capacity > budget.level:
+                        budget.put(budget.capacity - budget.level)
 
-            #print(f'Triage slots available: {self.triage_res.level} (of intended {g.triage_resource})')
-            #print(f'MDT slots available: {self.mdt_res.level} (of intended {g.mdt_resource})')
-            #print(f'Assessment slots available: {self.asst_res.level} (of intended {g.asst_resource})')
+            # this week's MDT meetings
+            if g.mdt_batched:
+                self.mdt_meeting()
 
             # Wait one unit of simulation time (1 week)
-            yield(self.env.timeout(1))
+            yield(EndOfWeek(self.env))
 
             # increment our week number tracker by 1 week
             self.week_number += 1
@@ -387,389 +1107,783 @@ class Model:
         # set at 0
         # self.week_number = 0
        
-    # generator function that represents the DES generator for referrals
-    def generator_patient_referrals(self):
-
-        # Randomly sample the number of referrals coming in. Here we
-        # sample from Poisson distribution - recommended by Mike Allen
-        # SR comment: I would potentially sample a larger number than your sim duration - maybe
-        # several hundred/thousand samples
-        # Or potentially don't need the two step process as you are redoing this sample
-        # each week anyway here - you could combine it into a single step where the size
-        # is just 1 (and as we're not specifying a seed I would expect it to be somewhat random
-        # here anyway)
-        # I would recommend taking a look at the reproducibility section here too:
-        # https://hsma-programme.github.io/hsma6_des_book/reproducibility.html#sec-robust
-        # replacing the exponential class in the example with poisson
-        # Just be aware you'll want to set a different random seed per run in the trial,
-        # but potentially give users a way to set a different random seed in the interface
-        # Happy to chat more about this - I've realised I need to expand on that section somewhat!
-        sampled_referrals_poisson = np.random.poisson(
-                            lam=g.mean_referrals_pw,
-                            size=g.sim_duration
-                            )
-        # pick a value at random from the Poisson distribution
-        sampled_referrals = \
-                        int(random.choice(sampled_referrals_poisson))
-
-        # # increment week number by 1
-        # self.week_number += 1
-
-        if g.debug_level >= 1:
-            print(f'Week {self.week_number}: {sampled_referrals} referrals generated')
-            print('')
-            print(f'Still remaining on triage WL from last week: {g.number_on_triage_wl}')
-
-            print('')
-            print(f'Still remaining on mdt WL from last week: {g.number_on_mdt_wl}')
-
-            print('')
-            print(f'Still remaining on Assessment WL from last week: {g.number_on_asst_wl}')
-            print("----------------")
+    # Top up every stage's slots (for every team) - back up to the number of
+    # slots, or with g.daily_slots by the share of them for the given day of
+    # the week (as far as the number of slots)
+    def release_slots(self, day=None):
+        for stage, trace_stage in zip(queue_stages, [STAGE_TRIAGE,
+                                                     STAGE_MDT,
+                                                     STAGE_ASST]):
+            # (the MDT meeting takes its cases itself, see mdt_meeting)
+            if stage == 'mdt' and g.mdt_batched:
+                continue
+
+            for res in self.stage_slots[stage]:
+                amount_to_fill = res.capacity - res.level
+                if day is not None:
+                    amount_to_fill = min(amount_to_fill,
+                                         day_share(res.capacity, day,
+                                                   g.working_weekdays))
+
+                if amount_to_fill > 0:
+                    res.put(amount_to_fill)
+
+                    if self.trace is not None:
+                        self.trace.record(-1, trace_stage,
+                                          KIND_REPLENISHED, self.env.now,
+                                          len(res.get_queue),
+                                          amount_to_fill)
+
+    # Release the slots for each of this week's working days on the day (see
+    # des_calendar.py). Only working days have an event, which releases every
+    # stage's slots for the day in one go, so running day by day costs at
+    # most one extra event for each working day of the week.
+    def schedule_daily_slots(self):
+        for day in working_days(self.week_number, g.working_weekdays,
+                                g.bank_holidays):
+            if day == 0:
+                self.release_slots(day)
+                continue
+
+            release = EndOfWeek(self.env, day / 7)
+            release.callbacks.append(
+                lambda event, day=day: self.release_slots(day))
+
+    # Sample the number of referrals for every week up to the given number of
+    # weeks. Uniform draws are turned into Poisson numbers of referrals at
+    # each week's rate, so an antithetic run gets the opposite numbers. The
+    # draws are made a week at a time (one for each team), so sampling the
+    # weeks in two goes when a run is extended gives the same numbers as
+    # sampling them all at once. The run's referrals are the teams' total.
+    def sample_arrivals(self, weeks):
+        weeks_sampled = len(self.arrival_schedule)
+        if weeks <= weeks_sampled:
+            return
+
+        uniforms = np.random.random((weeks - weeks_sampled, len(self.teams)))
+        if self.antithetic:
+            uniforms = 1 - uniforms
+
+        counts = np.zeros(weeks - weeks_sampled, dtype=int)
+        total_rates = np.zeros(weeks - weeks_sampled)
+        for i, team in enumerate(self.teams):
+            rates = referral_rates(team.mean_referrals_pw,
+                                   team.referral_profile,
+                                   weeks)[weeks_sampled:]
+
+            team_counts = sample_referral_counts(rates, uniforms[:, i])
+            team.arrival_schedule.extend(team_counts)
+            counts += team_counts
+            total_rates += rates
+
+        self.arrival_schedule.extend(counts)
+        self.referral_rates.extend(total_rates)
+
+    # expected referrals per week over the weeks run so far
+    def expected_referrals_pw(self):
+        return np.mean(self.referral_rates[:len(self.referrals_per_week)])
+
+    # Create the week's referrals as a single batch, starting each one off on
+    # the pathway
+    def generate_referrals(self):
+        sampled_referrals = int(self.arrival_schedule[self.week_number])
+
+        self.referrals_per_week.append(sampled_referrals)
+
+        if self.trace is not None:
+            now = self.env.now
+            self.trace.record(-1, STAGE_REFERRAL, KIND_REFERRALS_GENERATED, now,
+                              value=sampled_referrals)
+            # still remaining on each waiting list from last week
+            self.trace.record(-1, STAGE_TRIAGE, KIND_CARRIED_OVER, now,
+                              g.number_on_triage_wl)
+            self.trace.record(-1, STAGE_MDT, KIND_CARRIED_OVER, now,
+                              g.number_on_mdt_wl)
+            self.trace.record(-1, STAGE_ASST, KIND_CARRIED_OVER, now,
+                              g.number_on_asst_wl)
+
+        referrals = []
+        for team_number, team in enumerate(self.teams):
+            team_referrals = int(team.arrival_schedule[self.week_number])
+            team.referrals += team_referrals
+
+            for referral in range(team_referrals):
+
+                # Increment the patient counter by 1
+                self.patient_counter += 1
+
+                # Create a new patient from Patient Class, deciding everything
+                # random about them straight away. Patients only keep the
+                # number of their team so they can be replayed in another run
+                # (see des_stage_cache.py).
+                p = Patient(self.patient_counter)
+                p.week_added = self.week_number
+                p.team = team_number
+                p.draw_fates(self.patient_rng)
+                p.draw_referral(self.priority_rng, team)
+                p.u_titration = self.titration_rng.uniform(0,1)
+                referrals.append(p)
+
+        self.start_referrals(referrals)
+
+    # Start the week's referrals off on the pathway - all at the start of the
+    # week, or with g.daily_slots spread evenly over the week's working days
+    # (with one event for each day's referrals)
+    def start_referrals(self, referrals):
+        days = [0]
+        if g.daily_slots:
+            days = working_days(self.week_number, g.working_weekdays,
+                                g.bank_holidays) or [0]
+
+        for i, day in enumerate(days):
+            day_referrals = referrals[i * len(referrals) // len(days):
+                                      (i + 1) * len(referrals) // len(days)]
+            if day == 0:
+                self.start_pathways(day_referrals)
+            else:
+                arrival = self.env.timeout(day / 7)
+                arrival.callbacks.append(
+                    lambda event, day_referrals=day_referrals:
+                        self.start_pathways(day_referrals))
 
-        self.referral_counter = 0
+    def start_pathways(self, referrals):
+        for p in referrals:
+            # start up the patient pathway generator
+            self.env.process(self.patient_pathway(p))
+
+    # activity time in minutes using the patient's own draw for the activity.
+    # Times that would be 0 or less are mirrored about the mean instead. With
+    # g.enforce_job_plans, work that doesn't wait for staff time (see
+    # stage_activities) is charged to the band's minutes as it is done.
+    def activity_mins(self, p, activity, mean):
+        activity_time = mean + g.std_dev * p.z_mins[activity]
+        if activity_time <= 0:
+            activity_time = mean + g.std_dev * abs(p.z_mins[activity])
+
+        staff_budgets = self.teams[p.team].staff_budgets
+        if staff_budgets is not None and activity not in waiting_activities:
+            staff_budgets[activity_bands[activity]].charge(activity_time)
+        return activity_time
+
+    # With g.enforce_job_plans, wait until the patient's team has enough of
+    # the band's minutes left this week for the work done at a stage
+    # (prioritised patients first, as for the stage's slots)
+    def wait_for_staff(self, p, stage):
+        team = self.teams[p.team]
+        if team.staff_budgets is None:
+            return
+
+        activities = stage_activities[stage]
+        budget = team.staff_budgets[activity_bands[activities[0]]]
+        minutes = sum(self.activity_mins(p, activity,
+                                         getattr(team, f'{activity}_time'))
+                      for activity in activities)
+
+        # the weekly MDT meeting goes ahead whatever time is left
+        if stage == 'mdt' and g.mdt_batched:
+            budget.charge(minutes)
+            return
+        # (anything longer than the whole week's minutes takes all of them)
+        yield budget.get(min(minutes, budget.capacity),
+                         self.stage_priority(p, stage))
+
+    # Add a patient's wait for a stage to the stage's streaming wait metrics
+    # (the target is the patient's team's)
+    def record_wait(self, p, stage, wait):
+        p2_add(self.wait_sketches[stage], wait, wait_quantile)
+        self.waits_seen[stage] += 1
+        if wait > getattr(self.teams[p.team], f'target_{stage}_wait'):
+            self.waits_over_target[stage] += 1
+
+    # The slots a patient joining a stage's waiting list waits for - their
+    # team's, or the ones shared by every team. With g.team_overflow a patient
+    # whose team has no slots left this week is seen by the team with the
+    # most left (if any).
+    def slots_for(self, p, stage):
+        team = self.teams[p.team]
+        res = team.slots[stage]
+        if g.team_overflow and res.level == 0:
+            spare = max(self.stage_slots[stage], key=lambda res: res.level)
+            if spare.level > 0:
+                team.seen_elsewhere += 1
+                res = spare
+        return res
+
+    # A patient's priority at a stage - their own at g.priority_stages, and
+    # routine (first come first served) at the others
+    def stage_priority(self, p, stage):
+        if stage in self.teams[p.team].priority_stages:
+            return p.priority
+        return PRIORITY_ROUTINE
+
+    # Whether a patient about to join a stage's waiting list has already aged
+    # out (e.g. while their pack and observations were being done). If they
+    # have they are counted as aging out at the stage.
+    def aged_out_before(self, p, stage):
+        if p.age_out_week is None or self.env.now < p.age_out_week:
+            return False
+
+        self.aged_out[stage] += 1
+        if self.trace is not None:
+            self.trace.record(p.id, queue_trace_stages[stage], KIND_AGED_OUT,
+                              self.env.now)
+        return True
+
+    # Interrupt a patient waiting for a slot when they age out. Only patients
+    # who didn't get a slot straight away need watching.
+    def watch_age_out(self, p, request):
+        if p.age_out_week is None or request.triggered:
+            return
+
+        process = self.env.active_process
+        age_out = self.env.timeout(p.age_out_week - self.env.now)
+        age_out.callbacks.append(
+            lambda event: process.interrupt('aged out')
+                          if not request.triggered else None)
+
+    # Take a patient who has aged out off a stage's waiting list. Their
+    # request is cancelled as they leave (see PriorityQueue), and a slot given
+    # to them at the same moment they aged out goes back for the next patient.
+    def leave_aged_out(self, p, stage, res, request):
+        # (the time spent waiting so far is added up before the queue changes)
+        res.update_totals()
+
+        counter = f'number_on_{stage}_wl'
+        setattr(g, counter, getattr(g, counter) - 1)
+        self.leave_wl(p, stage, res)
+        self.aged_out[stage] += 1
+
+        if request.triggered:
+            res.put(1)
+
+        if self.trace is not None:
+            self.trace.record(p.id, queue_trace_stages[stage], KIND_AGED_OUT,
+                              self.env.now, getattr(g, counter))
+
+    # Wait for space on one of the caseloads of the patient's team's
+    # clinicians (prioritised patients first, as for assessment), then go on
+    # the least loaded one. Returns the clinician, or None if the patient aged
+    # out while waiting.
+    def join_caseload(self, p, pool):
+        start_q_caseload = self.env.now
+
+        with pool.places.get(1, self.stage_priority(p, 'asst')) as place_req:
+            self.watch_age_out(p, place_req)
+            try:
+                yield place_req
+            except simpy.Interrupt:
+                pool.places.update_totals()
+                if place_req.triggered:
+                    pool.places.put(1)
+                self.aged_out['asst'] += 1
+                if self.trace is not None:
+                    self.trace.record(p.id, STAGE_ASST, KIND_AGED_OUT,
+                                      self.env.now)
+                return None
+
+        clinician = pool.assign()
+        self.results_df.at[p.id, 'Q Time Caseload'] = (self.env.now
+                                                       - start_q_caseload)
+        self.results_df.at[p.id, 'Clinician'] = clinician
+        return clinician
+
+    # Add a patient to the waiting list for the slots they are waiting for at
+    # a stage, and to their team's number waiting. Returns their place on the
+    # waiting list.
+    def join_wl(self, p, stage, res):
+        res.number_on_wl += 1
+        self.teams[p.team].number_on_wl[stage] += 1
+        return res.number_on_wl
+
+    # Take a patient who has got a slot off the waiting list
+    def leave_wl(self, p, stage, res):
+        res.number_on_wl -= 1
+        self.teams[p.team].number_on_wl[stage] -= 1
+
+    # Add a patient who has just been diagnosed to the journey stats of the
+    # week they were referred
+    def record_journey(self, p):
+        week = p.week_added
+        journey = self.env.now - week
+
+        if week >= len(self.journey_stats):
+            extra = week + 1 - len(self.journey_stats)
+            self.journey_stats = np.vstack([
+                self.journey_stats,
+                np.zeros((extra, self.journey_stats.shape[1]))])
+            self.journey_sketches = np.vstack([
+                self.journey_sketches,
+                np.zeros((extra, self.journey_sketches.shape[1]))])
+
+        stats = self.journey_stats[week]
+        stats[DIAGNOSED] += 1
+        stats[JOURNEY_TOTAL] += journey
+        for i, horizon in enumerate(g.journey_horizons):
+            if journey <= horizon:
+                stats[DIAGNOSED_WITHIN + i] += 1
+        p2_add(self.journey_sketches[week], journey, wait_quantile)
+
+    # P90 of a stage's waits so far and the % of them over the stage's target
+    def wait_metrics(self, stage):
+        seen = self.waits_seen[stage]
+        breach = 100 * self.waits_over_target[stage] / seen if seen else np.nan
+        return p2_quantile(self.wait_sketches[stage], wait_quantile), breach
+
+    # Add this week's stats for each team - the team's referrals so far, its
+    # patients waiting at each stage (including for slots shared with other
+    # teams), their mean waits so far and the number seen by another team
+    def record_team_stats(self):
+        waits = self.results_df.groupby('Team')[
+            ['Q Time Triage','Q Time MDT','Q Time Asst']].mean()
+        waits = waits.reindex([team.name for team in self.teams])
+
+        for team, team_waits in zip(self.teams, waits.to_numpy()):
+            self.team_weekly_stats.append(
+                {
+                 'Week Number':self.week_number,
+                 'Team':team.name,
+                 'Referrals':team.referrals,
+                 'Triage Queue':team.number_on_wl['triage'],
+                 'MDT Queue':team.number_on_wl['mdt'],
+                 'Asst Queue':team.number_on_wl['asst'],
+                 'Triage Wait':team_waits[0],
+                 'MDT Wait':team_waits[1],
+                 'Asst Wait':team_waits[2],
+                 'Seen By Other Teams':team.seen_elsewhere,
+                }
+                )
 
-        while self.referral_counter <= sampled_referrals:
+    # generator function that represents the DES generator for patients
+    def patient_pathway(self, p):
 
-            # increment the referral counter by 1
-            self.referral_counter += 1
+            team = self.teams[p.team]
+            if self.team_weekly_stats is not None:
+                self.results_df.at[p.id, 'Team'] = team.name
 
-            # start up the patient pathway generator
-            self.env.process(self.patient_pathway(self.week_number))
+            self.results_df.at[p.id, 'Referral Time Screen'] = \
+                            self.activity_mins(p, 'referral_screen',
+                                               team.referral_screen_time)
 
-        # reset the referral counter
-        self.referral_counter = 0
+            self.results_df.at[p.id, 'Run Number'] = self.run_number
 
-        yield(self.env.timeout(1))
+            self.results_df.at[p.id, 'Priority'] = priority_names[p.priority]
+            self.results_df.at[p.id, 'Age'] = p.age
 
-    # generator function that represents the DES generator for patients
-    def patient_pathway(self, week_number):
-
-            # decide whether the patient was rejected at any point
-            # decide whether the referral was rejected
-            self.reject_referral = random.uniform(0,1)
-            # decide whether the triage was rejected
-            self.reject_triage = random.uniform(0,1)
-            # decide whether the pack was returned on time or not
-            self.reject_pack = random.uniform(0,1)
-            # decide whether the obs were completed on time or not
-            self.reject_obs = random.uniform(0,1)
-            # decide whether the mdt was rejected
-            self.reject_mdt = random.uniform(0,1)
-            # decide whether the assessment was rejected
-            self.reject_asst = random.uniform(0,1)
-
-            # Increment the patient counter by 1
-            self.patient_counter += 1
-
-            # Create a new patient from Patient Class
-            p = Patient(self.patient_counter)
-            p.week_added = week_number
-
-            self.results_df.at[p.id, 'Referral Time Screen'] = self.random_normal(g.referral_screen_time,g.std_dev)
+            self.results_df.at[p.id, 'Week Number'] = self.week_number
 
             # print(f'Week {week_number}: Patient number {p.id} created')
 
             # check whether the referral was rejected or not
-            if self.reject_referral <= g.referral_rejection_rate:
+            if p.reject_referral <= team.referral_rejection_rate:
 
                 # if this referral is rejected mark as rejected
-                self.results_df.at[p.id, 'Run Number'] = self.run_number
-
-                self.results_df.at[p.id, 'Week Number'] = self.week_number
-
                 self.results_df.at[p.id, 'Referral Rejected'] = 1
 
-                #reject all the other parts of the pathway if referral rejected
-                # SR Comment - check this? As this is patient-level, should this
-                # instead be just setting all to 1 (assuming using 1 = rejected)
-                # Also check at other stages of the pathway - it's being set as I
-                # would expect (0/1) within the dataframes but for the patient
-                # objects it's been set to match the global rejection rate value,
-                # which I'm not sure adds value here
-                # (this is also slight duplication but not sure there's much harm in
-                # it, though I'd potentially recommend instead doing)
-                # self.results_df.at[p.id, 'Triage Rejected'] = self.reject_triage
-                # at the relevant point instead of separately setting 0/1 again
-                self.reject_triage = g.triage_rejection_rate
-                self.reject_pack = g.pack_rejection_rate
-                self.reject_obs = g.obs_rejection_rate
-                self.reject_mdt = g.mdt_rejection_rate
-                self.reject_asst = g.asst_rejection_rate
-
+                if self.trace is not None:
+                    self.trace.record(p.id, STAGE_REFERRAL, KIND_REJECTED,
+                                      self.env.now)
             else:
                 # Mark referral as accepted and move on to Triage
                 self.results_df.at[p.id, 'Referral Rejected'] = 0
 
-                self.results_df.at[p.id, 'Run Number'] = self.run_number
+                if self.trace is not None:
+                    self.trace.record(p.id, STAGE_REFERRAL, KIND_ACCEPTED,
+                                      self.env.now)
+
+                yield from self.pathway_from(p, 'triage')
 
-                self.results_df.at[p.id, 'Week Number'] = self.week_number
-
-                # add referral to triage waiting list as has passed referral
-                g.number_on_triage_wl += 1
+            return self.results_df
+
+    # Carry a patient through the rest of the pathway starting at the given
+    # stage. Each stage returns whether the patient carries on to the next.
+    def pathway_from(self, p, stage):
+        stage_functions = {'triage':self.triage_stage, 'mdt':self.mdt_stage,
+                           'asst':self.asst_stage}
 
-                if g.debug_level >= 2:
-                    print(f'Patient {p.id} added in week {p.week_added}, current triage wl:{g.number_on_triage_wl}')
+        for stage_name in pathway_stages[pathway_stages.index(stage):]:
+            # keep the arrivals into each stage for the stage cache
+            if self.stage_cache is not None:
+                self.stage_streams[stage_name].append((self.env.now, p))
+
+            carry_on = yield from stage_functions[stage_name](p)
+            if not carry_on:
+                break
+
+    # Triage, followed by sending out the pack and the observations
+    def triage_stage(self, p):
+
+        if self.aged_out_before(p, 'triage'):
+            return False
+
+        team = self.teams[p.team]
+        triage_res = self.slots_for(p, 'triage')
+
+        # add referral to triage waiting list as has passed referral
+        g.number_on_triage_wl += 1
+        triage_posn = self.join_wl(p, 'triage', triage_res)
+
+        if self.trace is not None:
+            self.trace.record(p.id, STAGE_TRIAGE, KIND_JOINED_QUEUE,
+                              self.env.now, g.number_on_triage_wl)
+
+        ##### Now do the Triage #####
+
+        start_q_triage = self.env.now
+
+        # Record where the patient is on the Triage WL
+        self.results_df.at[p.id, "Triage WL Posn"] = triage_posn
+
+        # Request a Triage resource from the container (prioritised patients
+        # are seen first, see g.priority_stages)
+        triage_priority = self.stage_priority(p, 'triage')
+        with triage_res.get(1, triage_priority) as triage_req:
+            self.watch_age_out(p, triage_req)
+            try:
+                yield triage_req
+            except simpy.Interrupt:
+                self.leave_aged_out(p, 'triage', triage_res, triage_req)
+                return False
+
+            # with a slot, wait for the staff time to do it
+            yield from self.wait_for_staff(p, 'triage')
+
+            # as each patient reaches this stage take them off Triage wl
+            g.number_on_triage_wl -= 1
+            self.leave_wl(p, 'triage', triage_res)
+
+            if self.trace is not None:
+                self.trace.record(p.id, STAGE_TRIAGE, KIND_STARTED,
+                                  self.env.now, g.number_on_triage_wl,
+                                  p.week_added)
+
+            end_q_triage = self.env.now
+            self.in_progress['triage'] += 1
+            # pick a random time from 0.1-4 for how long it took to Triage
+            sampled_triage_time = stage_duration(4 * p.u_triage_time)
+
+            # Record how long the patient waited to be Triaged
+            self.results_df.at[p.id, 'Q Time Triage'] = \
+                                                end_q_triage - start_q_triage
+            self.record_wait(p, 'triage', end_q_triage - start_q_triage)
+            # Record how long the patient took to be Triaged
+            self.results_df.at[p.id, 'Time to Triage'] = sampled_triage_time
+            self.results_df.at[p.id,'Triage Mins Clin'] = \
+                self.activity_mins(p, 'triage_clin', team.triage_clin_time)
+            self.results_df.at[p.id,'Triage Mins Admin'] = \
+                self.activity_mins(p, 'triage_admin', team.triage_admin_time)
+
+            # Record total time it took to triage patient
+            self.results_df.at[p.id, 'Total Triage Time'] = \
+                        sampled_triage_time + (end_q_triage - start_q_triage)
+
+            # Determine whether patient was rejected following triage
+            if p.reject_triage <= team.triage_rejection_rate:
+
+                self.results_df.at[p.id, 'Triage Rejected'] = 1
+
+                if self.trace is not None:
+                    self.trace.record(p.id, STAGE_TRIAGE, KIND_REJECTED,
+                                      self.env.now)
+                self.results_df.at[p.id, 'Triage Time Reject'] = \
+                    self.activity_mins(p, 'triage_disch',
+                                       team.triage_discharge_time)
+
+                yield self.env.timeout(sampled_triage_time)
+                self.in_progress['triage'] -= 1
+                return False
+
+            # record that the Triage was accepted
+            self.results_df.at[p.id, 'Triage Rejected'] = 0
+
+            yield self.env.timeout(sampled_triage_time)
+            self.in_progress['triage'] -= 1
+
+        ##### Now send out the Pack #####
+
+        self.results_df.at[p.id, 'Time Pack Send'] = \
+                    self.activity_mins(p, 'pack_admin', team.pack_admin_time)
+
+        # determine whether the pack was returned on time or not
+        if p.reject_pack < team.pack_rejection_rate:
+            # came back late, after 3-5 weeks
+            self.results_df.at[p.id, 'Return Time Pack'] = \
+                                        round(3 + 2 * p.u_pack_time, 1)
+            # Mark that the pack was returned late
+            self.results_df.at[p.id, 'Pack Rejected'] = 1
+            self.results_df.at[p.id, 'Time Pack Reject'] = \
+                    self.activity_mins(p, 'pack_reject', team.pack_reject_time)
+
+            if self.trace is not None:
+                self.trace.record(p.id, STAGE_PACK, KIND_REJECTED,
+                                  self.env.now, value=self.results_df.at[
+                                                    p.id, 'Return Time Pack'])
+            return False
+
+        # came back in time, after 0-3 weeks
+        self.results_df.at[p.id, 'Return Time Pack'] = \
+                                        round(3 * p.u_pack_time, 1)
+        # Mark that the pack was returned on time
+        self.results_df.at[p.id, 'Pack Rejected'] = 0
+
+        if self.trace is not None:
+            self.trace.record(p.id, STAGE_PACK, KIND_ACCEPTED, self.env.now,
+                              value=self.results_df.at[p.id,
+                                                       'Return Time Pack'])
+
+        ##### Now do the Observations #####
+
+        self.results_df.at[p.id, 'Time Obs Visit'] = \
+                    self.activity_mins(p, 'obs_visit', team.school_obs_time)
+
+        # determine whether the obs were returned on time or not
+        if p.reject_obs < team.obs_rejection_rate:
+            # mark that the obs were returned late
+            self.results_df.at[p.id, 'Obs Rejected'] = 1
+            # record a return time that is after the target (4-6 weeks)
+            self.results_df.at[p.id, 'Return Time Obs'] = \
+                                        round(4 + 2 * p.u_obs_time, 1)
+            self.results_df.at[p.id, 'Time Obs Reject'] = \
+                    self.activity_mins(p, 'obs_reject', team.obs_reject_time)
+
+            if self.trace is not None:
+                self.trace.record(p.id, STAGE_OBS, KIND_REJECTED,
+                                  self.env.now, value=self.results_df.at[
+                                                    p.id, 'Return Time Obs'])
+            return False
+
+        # Record how long the patient took for Obs (0-4 weeks)
+        self.results_df.at[p.id, 'Return Time Obs'] = \
+                                        round(4 * p.u_obs_time, 1)
+        # Mark that the obs were returned on time
+        self.results_df.at[p.id, 'Obs Rejected'] = 0
+
+        if self.trace is not None:
+            self.trace.record(p.id, STAGE_OBS, KIND_ACCEPTED, self.env.now,
+                              value=self.results_df.at[p.id,
+                                                       'Return Time Obs'])
+
+        return True
 
-                ##### Now do the Triage #####
+    # MDT
+    def mdt_stage(self, p):
+
+        if self.aged_out_before(p, 'mdt'):
+            return False
+
+        team = self.teams[p.team]
+        mdt_res = self.slots_for(p, 'mdt')
+
+        start_q_mdt = self.env.now
+
+        self.results_df.at[p.id, 'Time Prep MDT'] = \
+                    self.activity_mins(p, 'mdt_prep', team.mdt_prep_time)
+        self.results_df.at[p.id, 'Time Meet MDT'] = \
+                    self.activity_mins(p, 'mdt_meet', team.mdt_meet_time)
+        # add referral to MDT waiting list as has passed obs
+        g.number_on_mdt_wl += 1
+        mdt_posn = self.join_wl(p, 'mdt', mdt_res)
+
+        # Record where they patient is on the MDT WL
+        self.results_df.at[p.id, "MDT WL Posn"] = mdt_posn
+
+        if self.trace is not None:
+            self.trace.record(p.id, STAGE_MDT, KIND_JOINED_QUEUE,
+                              self.env.now, g.number_on_mdt_wl)
+        # Wait until an MDT resource becomes available (or the case is taken
+        # by the weekly meeting with g.mdt_batched)
+        mdt_priority = self.stage_priority(p, 'mdt')
+        with mdt_res.get(1, mdt_priority) as mdt_req:
+            self.watch_age_out(p, mdt_req)
+            try:
+                yield mdt_req
+            except simpy.Interrupt:
+                self.leave_aged_out(p, 'mdt', mdt_res, mdt_req)
+                return False
+
+            yield from self.wait_for_staff(p, 'mdt')
+
+            # take patient off the MDT waiting list once MDT has taken place
+            g.number_on_mdt_wl -= 1
+            self.leave_wl(p, 'mdt', mdt_res)
+
+            if self.trace is not None:
+                self.trace.record(p.id, STAGE_MDT, KIND_STARTED, self.env.now,
+                                  g.number_on_mdt_wl, p.week_added)
+
+            end_q_mdt = self.env.now
+            self.in_progress['mdt'] += 1
+            # pick a random time from 0.1-1 weeks for how long it took for MDT
+            # (the time until the outcome of the meeting with g.mdt_batched)
+            if g.mdt_batched:
+                sampled_mdt_time = stage_duration(g.mdt_outcome_time)
+            else:
+                sampled_mdt_time = stage_duration(p.u_mdt_time)
+
+            # Record how long the patient waited for MDT
+            self.results_df.at[p.id, 'Q Time MDT'] = end_q_mdt - start_q_mdt
+            self.record_wait(p, 'mdt', end_q_mdt - start_q_mdt)
+            # Record how long the patient took to be MDT'd
+            self.results_df.at[p.id, 'Time to MDT'] = sampled_mdt_time
+            # Record total time it took to MDT patient
+            self.results_df.at[p.id, 'Total MDT Time'] = \
+                            sampled_mdt_time + (end_q_mdt - start_q_mdt)
+
+            if p.reject_mdt <= team.mdt_rejection_rate:
+                self.results_df.at[p.id, 'MDT Rejected'] = 1
+
+                if self.trace is not None:
+                    self.trace.record(p.id, STAGE_MDT, KIND_REJECTED,
+                                      self.env.now)
+
+                self.results_df.at[p.id, 'MDT Time Reject'] = \
+                    self.activity_mins(p, 'mdt_reject', team.mdt_reject_time)
+
+                # release the MDT resource
+                yield self.mdt_done(sampled_mdt_time)
+                self.in_progress['mdt'] -= 1
+                return False
+
+            self.results_df.at[p.id, 'MDT Rejected'] = 0
+            # release the MDT resource
+            yield self.mdt_done(sampled_mdt_time)
+            self.in_progress['mdt'] -= 1
+
+        return True
+
+    # The weekly MDT meetings of each team (or the one joint meeting) with
+    # g.mdt_batched. Everyone reviewed this week hears the outcome at the same
+    # time, g.mdt_outcome_time after the meetings.
+    def mdt_meeting(self):
+        self.mdt_outcome = self.env.timeout(
+                                    stage_duration(g.mdt_outcome_time))
+        for meeting in self.stage_slots['mdt']:
+            meeting.hold_meeting()
+
+    # event for an MDT case taken sampled_mdt_time ago to be finished - the
+    # outcome of this week's meetings going out with g.mdt_batched
+    def mdt_done(self, sampled_mdt_time):
+        if g.mdt_batched:
+            return self.mdt_outcome
+        return self.env.timeout(sampled_mdt_time)
+
+    # Assessment and diagnosis
+    def asst_stage(self, p):
+
+        if self.aged_out_before(p, 'asst'):
+            return False
+
+        team = self.teams[p.team]
+
+        # assessment doesn't start until there is space on a clinician's
+        # caseload (when caseloads are modelled)
+        clinician = None
+        if team.clinicians is not None:
+            clinician = yield from self.join_caseload(p, team.clinicians)
+            if clinician is None:
+                return False
+
+        asst_res = self.slots_for(p, 'asst')
+
+        start_q_asst = self.env.now
+
+        # add referral to asst waiting list as has passed mdt
+        g.number_on_asst_wl += 1
+        asst_posn = self.join_wl(p, 'asst', asst_res)
+
+        # Record where they patient is on the Asst WL
+        self.results_df.at[p.id, "Asst WL Posn"] = asst_posn
+
+        if self.trace is not None:
+            self.trace.record(p.id, STAGE_ASST, KIND_JOINED_QUEUE,
+                              self.env.now, g.number_on_asst_wl)
+        # Wait until an Assessment resource becomes available (prioritised
+        # patients are seen first, see g.priority_stages)
+        asst_priority = self.stage_priority(p, 'asst')
+        with asst_res.get(1, asst_priority) as asst_req:
+            self.watch_age_out(p, asst_req)
+            try:
+                yield asst_req
+            except simpy.Interrupt:
+                self.leave_aged_out(p, 'asst', asst_res, asst_req)
+                if clinician is not None:
+                    team.clinicians.release(clinician)
+                return False
+
+            yield from self.wait_for_staff(p, 'asst')
+
+            # take patient off the Asst waiting list once Asst starts
+            g.number_on_asst_wl -= 1
+            self.leave_wl(p, 'asst', asst_res)
+
+            if self.trace is not None:
+                self.trace.record(p.id, STAGE_ASST, KIND_STARTED, self.env.now,
+                                  g.number_on_asst_wl, p.week_added)
+
+            end_q_asst = self.env.now
+            self.in_progress['asst'] += 1
+
+            # pick a random time from 0.1-4 for how long it took to Assess
+            sampled_asst_time = stage_duration(4 * p.u_asst_time)
+
+            # Record how long the patient waited to be Assessed
+            self.results_df.at[p.id, 'Q Time Asst'] = end_q_asst - start_q_asst
+            self.record_wait(p, 'asst', end_q_asst - start_q_asst)
+            # Record how long the patient took to be Assessed
+            self.results_df.at[p.id, 'Time to Asst'] = sampled_asst_time
+            self.results_df.at[p.id,'Asst Mins Clin'] = \
+                    self.activity_mins(p, 'asst_clin', team.asst_clin_time)
+            self.results_df.at[p.id,'Asst Mins Admin'] = \
+                    self.activity_mins(p, 'asst_admin', team.asst_admin_time)
+            # Record total time it took to assess patient
+            self.results_df.at[p.id, 'Total Asst Time'] = \
+                            sampled_asst_time + (end_q_asst - start_q_asst)
+
+            # Determine whether patient was rejected following assessment
+            if p.reject_asst <= team.asst_rejection_rate:
+
+                self.results_df.at[p.id, 'Asst Rejected'] = 1
+
+                if self.trace is not None:
+                    self.trace.record(p.id, STAGE_ASST, KIND_REJECTED,
+                                      self.env.now)
+                self.results_df.at[p.id,'Diag Rejected Time'] = \
+                    self.activity_mins(p, 'diag_disch', team.diag_time_disch)
+            else:
+                self.results_df.at[p.id, 'Asst Rejected'] = 0
+                self.results_df.at[p.id, 'Diag Accepted Time'] = \
+                    self.activity_mins(p, 'diag_accept', team.diag_time_accept)
 
-                start_q_triage = self.env.now
+            # release the resource once the Assessment is completed
+            yield self.env.timeout(sampled_asst_time)
+            self.in_progress['asst'] -= 1
 
-                # Record where the patient is on the Triage WL
-                self.results_df.at[p.id, "Triage WL Posn"] = \
-                                                    g.number_on_triage_wl
-
-                # Request a Triage resource from the container
-                with self.triage_res.get(1) as triage_req:
-                    yield triage_req
-
-                    #print(f'Patient {p} started triage')
-
-                    # as each patient reaches this stage take them off Triage wl
-                    g.number_on_triage_wl -= 1
-
-                    if g.debug_level >= 2:
-                        print(f'Week {self.env.now}: Patient number {p.id} (added week {p.week_added}) put through triage')
-
-                    end_q_triage = self.env.now
-                    # pick a random time from 1-4 for how long it took to Triage
-                    sampled_triage_time = round(random.uniform(0, 4), 1)
-
-                    # Calculate how long it took the patient to be Triaged
-                    self.q_time_triage = end_q_triage - start_q_triage
-
-                    # Record how long the patient waited to be Triaged
-                    self.results_df.at[p.id, 'Q Time Triage'] = \
-                                                            (self.q_time_triage)
-                    # Record how long the patient took to be Triaged
-                    self.results_df.at[p.id, 'Time to Triage'] = \
-                                                    sampled_triage_time
-                    self.results_df.at[p.id,'Triage Mins Clin'] = \
-                                                    self.random_normal(g.triage_clin_time,g.std_dev)
-                    self.results_df.at[p.id,'Triage Mins Admin'] = \
-                                                    self.random_normal(g.triage_admin_time,g.std_dev)
-
-                    # Record total time it took to triage patient
-                    self.results_df.at[p.id, 'Total Triage Time'] = \
-                                                            (sampled_triage_time
-                                                            +(end_q_triage -
-                                                            start_q_triage))
-
-                    #print(f'Patient number {self.patient_counter} triaged')
-
-                    # Determine whether patient was rejected following triage
-                    if self.reject_triage <= g.triage_rejection_rate:
-
-                        self.results_df.at[p.id, 'Triage Rejected'] = 1
-                        
-                        self.results_df.at[p.id, 'Triage Time Reject'] = self.random_normal(g.triage_discharge_time,g.std_dev)
-
-                        #reject all the other parts of the pathway if triage rejected
-                        # SR Comment - see above ref setting of these patient attributes
-                        self.reject_pack = g.pack_rejection_rate
-                        self.reject_obs = g.obs_rejection_rate
-                        self.reject_mdt = g.mdt_rejection_rate
-                        self.reject_asst = g.asst_rejection_rate
-
-                        yield self.env.timeout(sampled_triage_time)
-                    else:
-                        # record that the Triage was accepted
-                        self.results_df.at[p.id, 'Triage Rejected'] = 0
-
-                        yield self.env.timeout(sampled_triage_time)
-
-                        ##### Now send out the Pack #####
-
-                        self.results_df.at[p.id, 'Time Pack Send'] = self.random_normal(g.pack_admin_time,g.std_dev)
-
-                        # determine whether the pack was returned on time or not
-                        if self.reject_pack < g.pack_rejection_rate:
-                        #print(f'Patient {p} pack sent out')
-                            self.sampled_pack_time = round(random.uniform(3,5),1) # came back late
-                            self.results_df.at[p.id, 'Return Time Pack'] = \
-                                                                    self.sampled_pack_time
-                            # Mark that the pack was returned on time
-                            self.results_df.at[p.id, 'Pack Rejected'] = 1
-                            self.results_df.at[p.id, 'Time Pack Reject'] = self.random_normal(g.pack_reject_time,g.std_dev)
-                            #reject all the other parts of the pathway if pack rejected
-                            self.reject_obs = g.obs_rejection_rate
-                            self.reject_mdt = g.mdt_rejection_rate
-                            self.reject_asst = g.asst_rejection_rate
-                        else:
-                            #print(f'Patient {p} pack returned')
-                            # pick a random time for how long it took for Pack to be returned
-                            self.sampled_pack_time = round(random.uniform(0, 3), 1) # came back in time
-
-                            # Record how long the pack took to be returned
-                            self.results_df.at[p.id, 'Return Time Pack'] = \
-                                                                    self.sampled_pack_time
-                            # Mark that the pack was returned on time
-                            self.results_df.at[p.id, 'Pack Rejected'] = 0
-
-                            ##### Now do the Observations #####
-
-                            self.results_df.at[p.id, 'Time Obs Visit'] = self.random_normal(g.school_obs_time,g.std_dev)
-
-                            # determine whether the obs were returned on time or not
-                            if self.reject_obs < g.obs_rejection_rate:
-                            #print(f'Patient {p} obs started')
-                                # mark that the pack was returned late
-                                self.results_df.at[p.id, 'Obs Rejected'] = 1
-                                # record a return time that is after the target
-                                self.sampled_obs_time = round(random.uniform(4, 6), 1)
-                                # Record how long the patient took for Obs
-                                self.results_df.at[p.id, 'Return Time Obs'] = \
-                                                                            self.sampled_obs_time
-                                self.results_df.at[p.id, 'Time Obs Reject'] = self.random_normal(g.obs_reject_time,g.std_dev)
-
-                                #reject all the other parts of the pathway if obs rejected
-                                self.reject_mdt = g.mdt_rejection_rate
-                                self.reject_asst = g.asst_rejection_rate
-
-                            else:
-                                # pick a random time for how long it took for Obs to be returned
-                                self.sampled_obs_time = round(random.uniform(0, 4), 1)
-
-                                # Record how long the patient took for Obs
-                                self.results_df.at[p.id, 'Return Time Obs'] = \
-                                                                            self.sampled_obs_time
-
-                                # Mark that the pack was returned on time
-                                self.results_df.at[p.id, 'Obs Rejected'] = 0
-                                #print(f'Patient {p} obs completed')
-
-                                ##### Now do the MDT #####
-
-                                #print(f'Patient {p} MDT started')
-                                start_q_mdt = self.env.now
-
-                                self.results_df.at[p.id, 'Time Prep MDT'] = self.random_normal(g.mdt_prep_time,g.std_dev)
-                                self.results_df.at[p.id, 'Time Meet MDT'] = self.random_normal(g.mdt_meet_time,g.std_dev)
-                                # add referral to MDT waiting list as has passed obs
-                                g.number_on_mdt_wl += 1
-
-                                # Record where they patient is on the MDT WL
-                                self.results_df.at[p.id, "MDT WL Posn"] = \
-                                                                    g.number_on_mdt_wl
-                                # Wait until an MDT resource becomes available
-                                with self.mdt_res.get(1) as mdt_req: # request an MDT resource
-                                    yield mdt_req
-
-                                    #print(f'Resource in use: {mdt_req}')
-                                    # take patient off the MDT waiting list once MDT has taken place
-                                    g.number_on_mdt_wl -= 1
-
-                                    if g.debug_level >= 2:
-                                        print(f'Week {self.env.now}: Patient number {p.id}  (added week {p.week_added}) put through mdt')
-
-                                    end_q_mdt = self.env.now
-                                    # pick a random time from 0-1 weeks for how long it took for MDT
-                                    sampled_mdt_time = round(random.uniform(0,1),1)
-
-                                    # Calculate how long the patient waited to have MDT
-                                    self.q_time_mdt = end_q_mdt - start_q_mdt
-
-                                    # Record how long the patient waited for MDT
-                                    self.results_df.at[p.id, 'Q Time MDT'] = (self.q_time_mdt)
-                                    # Record how long the patient took to be MDT'd
-                                    self.results_df.at[p.id, 'Time to MDT'] = sampled_mdt_time
-                                    # Record total time it took to MDT patient
-                                    self.results_df.at[p.id, 'Total MDT Time'] = \
-                                                                                 (sampled_mdt_time
-                                                                                +(end_q_mdt -
-                                                                                start_q_mdt))
-                                    if self.reject_mdt <= g.mdt_rejection_rate:
-                                        self.results_df.at[p.id, 'MDT Rejected'] = 1
-
-                                        self.results_df.at[p.id, 'MDT Time Reject'] = self.random_normal(g.mdt_reject_time,g.std_dev)
-                                        #reject all the other parts of the pathway if mdt rejected
-                                        self.reject_asst = g.asst_rejection_rate
-
-                                        # release the MDT resource
-                                        yield self.env.timeout(sampled_mdt_time)
-                                    else:
-                                        self.results_df.at[p.id, 'MDT Rejected'] = 0
-                                        # release the MDT resource
-                                        yield self.env.timeout(sampled_mdt_time)
-
-                                    #print(f'Patient {p} MDT completed')
-
-                                        ##### Now do the Assessment #####
-
-                                        #print(f'Patient {p} assessment started')
-                                        start_q_asst = self.env.now
-
-                                        # add referral to asst waiting list as has passed mdt
-                                        g.number_on_asst_wl += 1
-
-                                        # Record where they patient is on the MDT WL
-                                        self.results_df.at[p.id, "Asst WL Posn"] = \
-                                                                                    g.number_on_asst_wl
-                                        # Wait until an Assessment resource becomes available
-                                        with self.asst_res.get(1) as asst_req:
-                                            yield asst_req
-
-                                            #print(f'Resource in use: {asst_req}')
-                                            # take patient off the Asst waiting list once Asst starts
-                                            g.number_on_asst_wl -= 1
-
-                                            if g.debug_level >= 2:
-                                                print(f'Week {self.env.now}: Patient number {p.id} (added week {p.week_added}) put through assessment')
-
-                                            end_q_asst = self.env.now
-
-                                            # pick a random time from 1-4 for how long it took to Assess
-                                            sampled_asst_time = round(random.uniform(0,4),1)
-
-                                            # Calculate how long it took the patient to be Assessed
-                                            self.q_time_asst = end_q_asst - start_q_asst
-
-                                            # Record how long the patient waited to be Assessed
-                                            self.results_df.at[p.id, 'Q Time Asst'] = \
-                                                                                        (self.q_time_asst)
-                                            # Record how long the patient took to be Triage
-                                            self.results_df.at[p.id, 'Time to Asst'] = \
-                                                    sampled_asst_time
-                                            self.results_df.at[p.id,'Asst Mins Clin'] = \
-                                                    self.random_normal(g.asst_clin_time,g.std_dev)
-                                            self.results_df.at[p.id,'Asst Mins Admin'] = \
-                                                    self.random_normal(g.asst_admin_time,g.std_dev)
-                                            # Record total time it took to triage patient
-                                            self.results_df.at[p.id, 'Total Asst Time'] = \
-                                                                                        (sampled_asst_time
-                                                                                        +(end_q_asst -
-                                                                                        start_q_asst))
-
-                                            # Determine whether patient was rejected following assessment
-                                            if self.reject_asst <= g.asst_rejection_rate:
-
-                                                self.results_df.at[p.id, 'Asst Rejected'] = 1
-                                                self.results_df.at[p.id,'Diag Rejected Time'] = self.random_normal(g.diag_time_disch,g.std_dev)
-                                                # release the resource once the Assessment is completed
-                                                yield self.env.timeout(sampled_asst_time)
-
-                                            else:
-                                                self.results_df.at[p.id, 'Asst Rejected'] = 0
-                                                self.results_df.at[p.id, 'Diag Accepted Time'] = self.random_normal(g.diag_time_accept,g.std_dev)
-                                                # release the resource once the Assessment is completed
-                                                yield self.env.timeout(sampled_asst_time)
-
-            yield self.env.timeout(0)
-
-                                        #print(f'Patient {p} assessment completed')
-            # # replenish resources ready for next week
-            # self.triage_res.put(g.triage_resource)
-            # self.mdt_res.put(g.mdt_resource)
-            # self.asst_res.put(g.asst_resource)
-
-            # reset referral counter ready for next batch
-            self.referral_counter = 0
-
-            # Freeze this instance of this function in place for one
-            # unit of time i.e. 1 week
-            #yield self.env.timeout(1)
+            # the outcome of the assessment - diagnosed with ADHD (accepted)
+            # or discharged (rejected)
+            if self.trace is not None:
+                self.trace.record(p.id, STAGE_DIAGNOSIS,
+                                  KIND_REJECTED
+                                  if p.reject_asst <= team.asst_rejection_rate
+                                  else KIND_ACCEPTED, self.env.now)
 
-            return self.results_df
+            self.record_journey(p)
+
+        if clinician is None:
+            return True
+
+        # CYP diagnosed with ADHD stay on the clinician's caseload while their
+        # medication is titrated, for an exponentially distributed time
+        if p.reject_asst > team.asst_rejection_rate:
+            titration_weeks = stage_duration(
+                -team.titration_weeks * np.log(1 - p.u_titration))
+            self.results_df.at[p.id, 'Titration Weeks'] = titration_weeks
+
+            self.in_titration += 1
+            yield self.env.timeout(titration_weeks)
+            self.in_titration -= 1
+
+        team.clinicians.release(clinician)
+
+        return True
 
     # def calculate_weekly_results(self):
     #     # Take the mean of the queuing times and the maximum waiting list
@@ -799,12 +1913,38 @@ class Model:
     # and in turns calls anything we need to generate results for the run
     def run(self, print_run_results=True):
 
+        # seed the random number generators so a run can be reproduced
+        if self.seed is not None:
+            random.seed(self.seed)
+            np.random.seed(self.seed)
+
+        # sample the referrals for every week of the run
+        self.sample_arrivals(g.sim_duration)
+
+        # start from the latest stage the stage cache already has the
+        # arrivals for (the trace needs every stage to be run)
+        if self.stage_cache is not None and self.trace is None:
+            self.start_stage, self.cached_stage = \
+                                        self.stage_cache.lookup(self)
+
+        if self.cached_stage is not None:
+            self.replay_arrivals()
+
         # Start up the referral generator to create new referrals
         self.env.process(self.week_runner(g.sim_duration))
 
         # Run the model for the duration specified in g class
         self.env.run(until=g.sim_duration)
 
+        if self.cached_stage is not None:
+            self.merge_cached_stages()
+
+        # Keep a snapshot of the end of the run so it can be extended later
+        self.snapshot()
+
+        if self.stage_cache is not None:
+            self.stage_cache.store(self)
+
         # Now the simulation run has finished, call the method that calculates
         # run results
         self.calculate_run_results()
@@ -816,11 +1956,106 @@ class Model:
             print (f"Run Number {self.run_number}")
             print (self.results_df)
 
+    # Send the cached arrivals into the stage the run starts from, each at the
+    # time they arrived when the earlier stages were run
+    def replay_arrivals(self):
+        for arrival_time, p in self.cached_stage['stream']:
+            arrival = self.env.timeout(arrival_time)
+            arrival.callbacks.append(
+                lambda event, p=p: self.env.process(
+                    self.pathway_from(p, self.start_stage)))
+
+        self.patient_counter = self.cached_stage['patient_counter']
+        self.referrals_per_week = list(self.cached_stage['referrals_per_week'])
+
+    # Put the results of the cached stages back alongside the results of the
+    # stages that were run
+    def merge_cached_stages(self):
+        df_cached = self.cached_stage['results']
+
+        self.results_df = self.results_df.reindex(
+                                self.results_df.index.union(df_cached.index))
+        self.results_df[df_cached.columns] = df_cached
+
+        for week_stats, cached_week_stats in zip(self.df_weekly_stats,
+                                                 self.cached_stage['weekly']):
+            week_stats.update(cached_week_stats)
+
+        # waiting list counters for the cached stages at the end of the run
+        for name, value in self.cached_stage['counters'].items():
+            setattr(g, name, value)
+
+    # Take a snapshot of the parts of the run's state that aren't held in the
+    # model itself - the random number generator states and the waiting list
+    # counters in g. The SimPy environment (with its queues and processes),
+    # the resources and the results all stay in the model, so together these
+    # are everything needed to carry on the run from where it finished.
+    def snapshot(self):
+        self.saved_state = {
+            'sim_time':self.env.now,
+            'random_state':random.getstate(),
+            'np_random_state':np.random.get_state(),
+            'number_on_triage_wl':g.number_on_triage_wl,
+            'number_on_mdt_wl':g.number_on_mdt_wl,
+            'number_on_asst_wl':g.number_on_asst_wl,
+            }
+
+    # Carry on a finished run up to a longer simulation duration, so only the
+    # new weeks need to be simulated rather than starting again from week 0
+    def extend(self, sim_duration):
+        if self.start_stage != 'referral':
+            raise ValueError(f"Run {self.run_number} was replayed from the "
+                             f"stage cache so can't be extended")
+        if sim_duration <= self.saved_state['sim_time']:
+            raise ValueError(f"Run {self.run_number} has already been run for "
+                             f"{self.saved_state['sim_time']} weeks")
+
+        # put back the state from the end of the run
+        random.setstate(self.saved_state['random_state'])
+        np.random.set_state(self.saved_state['np_random_state'])
+        g.number_on_triage_wl = self.saved_state['number_on_triage_wl']
+        g.number_on_mdt_wl = self.saved_state['number_on_mdt_wl']
+        g.number_on_asst_wl = self.saved_state['number_on_asst_wl']
+
+        # sample the referrals for the extra weeks, move the week runner's last
+        # week on and run the extra weeks
+        self.sample_arrivals(sim_duration)
+        self.horizon = sim_duration
+        self.env.run(until=sim_duration)
+
+        self.snapshot()
+        self.calculate_run_results()
+
+    # The results of the run as plain values and arrays - the outputs stored
+    # in Trial.df_trial_results and the weekly stats by column - which are
+    # small enough to send back cheaply from another process or machine
+    def compact_results(self):
+        df_weekly_stats = pd.DataFrame(self.df_weekly_stats)
+
+        return {
+            'outputs':[self.mean_q_time_triage, self.max_triage_wl,
+                       self.mean_q_time_mdt, self.max_mdt_wl,
+                       self.mean_q_time_asst, self.max_asst_wl],
+            'mean_referrals_pw':np.mean(self.referrals_per_week),
+            'expected_referrals_pw':self.expected_referrals_pw(),
+            'weekly_stats':{col:df_weekly_stats[col].to_numpy()
+                            for col in df_weekly_stats.columns},
+            'journeys':journey_cohorts(self.referrals_per_week,
+                                       self.journey_stats,
+                                       self.journey_sketches, self.env.now),
+            'teams':pd.DataFrame(self.team_weekly_stats or []).to_dict('list'),
+            }
+
 # Class representing a Trial for our simulation - a batch of simulation runs.
 class Trial:
     # The constructor sets up a pandas dataframe that will store the key
     # results from each run against run number, with run number as the index.
-    def  __init__(self):
+    # A StageCache can be passed in so runs reuse the earlier stages of runs
+    # with the same seed that have already been done, a different
+    # model_class to run the trial with another engine (taking the same
+    # arguments as Model, see des_validation.py), and an executor to send the
+    # runs off to other processes or machines (see des_executors.py).
+    def  __init__(self, stage_cache=None, model_class=None, executor=None):
         self.df_trial_results = pd.DataFrame()
         self.df_trial_results["Run Number"] = [0]
         self.df_trial_results["Mean Q Time Triage"] = [0.0]
@@ -829,9 +2064,32 @@ class Trial:
         self.df_trial_results["Max MDT WL"] = [0]
         self.df_trial_results["Mean Q Time Asst"] = [0.0]
         self.df_trial_results["Max Asst WL"] = [0]
+        # runs are in pairs when using antithetic runs, otherwise each run is
+        # its own "pair" - the pairs are what's independent between runs
+        self.df_trial_results["Pair"] = [0]
+        self.df_trial_results["Mean Referrals PW"] = [0.0]
+        # peak memory used by each run (only measured if g.memory_tracking)
+        self.df_trial_results["Peak Memory MB"] = [0.0]
         self.df_trial_results.set_index("Run Number", inplace=True)
 
         self.weekly_wl_dfs = []
+        self.journey_dfs = [] # referral to diagnosis journeys of each run
+        self.team_dfs = [] # weekly stats of each team when there are g.teams
+        self.trace_dfs = [] # trace of each run when g.debug_level >= 1
+
+        # the models from each run are kept so the trial can be extended
+        # (unless the trial is only recording 'summary' detail)
+        self.models = []
+        self.sim_duration = 0
+        self.record_detail = g.record_detail
+
+        # peak memory used by the whole trial (only measured if
+        # g.memory_tracking)
+        self.peak_memory_mb = None
+
+        self.stage_cache = stage_cache
+        self.model_class = model_class if model_class is not None else Model
+        self.executor = executor
 
     # Method to print out the results from the trial.  In real world models,
     # you'd likely save them as well as (or instead of) printing them
@@ -839,6 +2097,33 @@ class Trial:
         print ("Trial Results")
         print (self.df_trial_results)
 
+    # Method to work out the seed for each run of the trial. Returns a list of
+    # (run, seed, antithetic) for the runs.
+    def run_seeds(self):
+        # antithetic pairs have to share a seed so pick one if unseeded
+        base_seed = g.random_seed
+        if base_seed is None and g.antithetic_runs:
+            base_seed = random.SystemRandom().randrange(2**31)
+
+        run_seeds = []
+        for run in range(g.number_of_runs):
+            # give each run its own seed so runs differ but can be repeated.
+            # With antithetic runs both runs in a pair use the pair's seed,
+            # the second with the opposite draws to the first
+            if g.antithetic_runs:
+                pair, antithetic = divmod(run, 2)
+                run_seed = base_seed + pair
+            elif base_seed is None:
+                run_seed = None
+                antithetic = 0
+            else:
+                run_seed = base_seed + run
+                antithetic = 0
+
+            run_seeds.append((run, run_seed, antithetic == 1))
+
+        return run_seeds
+
     # Method to run a trial
     def run_trial(self):
         # Run the simulation for the number of runs specified in g class.
@@ -846,27 +2131,226 @@ class Trial:
         # run method, which sets everything else in motion.  Once the run has
         # completed, we grab out the stored run results and store it against
         # the run number in the trial results dataframe
-        for run in range(g.number_of_runs):
-            my_model = Model(run)
+        run_seeds = self.run_seeds()
+
+        # with an executor the runs are done elsewhere and only their results
+        # come back
+        if self.executor is not None:
+            return self.store_replications(
+                        self.executor.run_replications(run_seeds,
+                                                       self.model_class))
+
+        # keep within the memory budget - this drops to only keeping the
+        # results of each run if needed, or raises a MemoryBudgetError if the
+        # trial wouldn't fit even then
+        self.record_detail = self.choose_record_detail()
+        # (the stage cache keeps every run's patients, so is only used when
+        # they are all being kept anyway)
+        stage_cache = self.stage_cache if self.record_detail == 'full' else None
+
+        memory = self.start_memory_tracking()
+
+        for run, run_seed, antithetic in run_seeds:
+            if memory is not None:
+                memory.start_run()
+
+            my_model = self.model_class(run, run_seed, stage_cache,
+                                        antithetic, memory)
             my_model.run(print_run_results=False)
 
-            self.df_trial_results.loc[run] =  [
-                my_model.mean_q_time_triage,
-                my_model.max_triage_wl,
-                my_model.mean_q_time_mdt,
-                my_model.max_mdt_wl,
-                my_model.mean_q_time_asst,
-                my_model.max_asst_wl,
-                ]
+            if self.record_detail == 'full':
+                self.models.append(my_model)
+            self.store_run_results(run, my_model, memory)
 
-            my_model.df_weekly_stats = pd.DataFrame(my_model.df_weekly_stats)
+        self.sim_duration = g.sim_duration
 
-            my_model.df_weekly_stats['Run'] = run
+        if memory is not None:
+            self.peak_memory_mb = memory.end_trial()
 
-            self.weekly_wl_dfs.append(my_model.df_weekly_stats)
+        if g.control_variate:
+            self.apply_control_variate()
                    
         # Once the trial (i.e. all runs) has completed, print the final results
         return self.df_trial_results, pd.concat(self.weekly_wl_dfs)
+
+    # Method to store the results of runs done elsewhere (a list of
+    # Model.compact_results in run order) and finish off the trial. The
+    # models aren't kept, so the trial only has 'summary' detail.
+    def store_replications(self, replications):
+        self.record_detail = 'summary'
+
+        for run, results in enumerate(replications):
+            self.store_compact_results(run, results)
+
+        self.sim_duration = g.sim_duration
+
+        if g.control_variate:
+            self.apply_control_variate()
+
+        return self.df_trial_results, pd.concat(self.weekly_wl_dfs)
+
+    # Method to extend a trial that has already been run to a longer
+    # simulation duration. Each run carries on from where it finished, so
+    # only the extra weeks are simulated.
+    def extend_trial(self, sim_duration):
+        self.weekly_wl_dfs = []
+        self.journey_dfs = []
+        self.team_dfs = []
+        self.trace_dfs = []
+
+        memory = self.start_memory_tracking()
+
+        for run, my_model in enumerate(self.models):
+            if memory is not None:
+                memory.start_run()
+
+            my_model.memory = memory
+            my_model.extend(sim_duration)
+            self.store_run_results(run, my_model, memory)
+
+        self.sim_duration = sim_duration
+
+        if memory is not None:
+            self.peak_memory_mb = memory.end_trial()
+
+        if g.control_variate:
+            self.apply_control_variate()
+
+        return self.df_trial_results, pd.concat(self.weekly_wl_dfs)
+
+    # Method to check whether the trial can be extended to g.sim_duration -
+    # every run has to have been kept, within the memory budget for the
+    # longer duration, and runs replayed from the stage cache only have the
+    # arrivals up to the end of the trial
+    def can_extend(self):
+        if self.record_detail != 'full':
+            return False
+        if (g.memory_budget_mb is not None
+                and self.estimate_mb('full') > g.memory_budget_mb):
+            return False
+        return all(my_model.start_stage == 'referral'
+                   for my_model in self.models)
+
+    # Method to estimate the memory in MB the trial needs at the given record
+    # detail with the settings in g (see des_memory.py)
+    def estimate_mb(self, record_detail):
+        return estimate_trial_mb(record_detail, g.number_of_runs,
+                                 g.sim_duration,
+                                 sum(team.mean_referrals_pw
+                                     for team in model_teams()),
+                                 g.referral_profile,
+                                 self.stage_cache is not None)
+
+    # Method to choose the record detail for the trial so it stays within
+    # g.memory_budget_mb. Raises a MemoryBudgetError (with the estimate) if
+    # even 'summary' detail would go over the budget.
+    def choose_record_detail(self):
+        if g.memory_budget_mb is None:
+            return g.record_detail
+
+        if (g.record_detail == 'full'
+                and self.estimate_mb('full') <= g.memory_budget_mb):
+            return 'full'
+
+        estimate_mb = self.estimate_mb('summary')
+        if estimate_mb > g.memory_budget_mb:
+            raise MemoryBudgetError(estimate_mb, g.memory_budget_mb)
+
+        return 'summary'
+
+    # Method to start measuring the memory used if g.memory_tracking is set.
+    # Returns the MemoryMonitor, or None if memory isn't being measured.
+    def start_memory_tracking(self):
+        if not g.memory_tracking:
+            return None
+
+        memory = MemoryMonitor(g.memory_tracking)
+        memory.start_trial()
+        return memory
+
+    # Method to store the results from a finished run against its run number
+    def store_run_results(self, run, my_model, memory=None):
+        self.store_compact_results(
+            run, my_model.compact_results(),
+            memory.end_run() if memory is not None else np.nan)
+
+        if my_model.trace is not None:
+            df_trace = my_model.trace.to_dataframe()
+            df_trace['Run'] = run
+            self.trace_dfs.append(df_trace)
+
+    # Method to store a run's results from Model.compact_results
+    def store_compact_results(self, run, results, peak_memory_mb=np.nan):
+        self.df_trial_results.loc[run] =  [
+            *results['outputs'],
+            run // 2 if g.antithetic_runs else run,
+            results['mean_referrals_pw'],
+            peak_memory_mb,
+            ]
+
+        # the same for every run, kept for the control variate as the models
+        # aren't always kept
+        self.expected_referrals_pw = results['expected_referrals_pw']
+
+        df_weekly_stats = pd.DataFrame(results['weekly_stats'])
+
+        df_weekly_stats['Run'] = run
+
+        self.weekly_wl_dfs.append(df_weekly_stats)
+
+        df_journeys = pd.DataFrame(results['journeys'])
+        df_journeys['Run'] = run
+        self.journey_dfs.append(df_journeys)
+
+        if results['teams']:
+            df_teams = pd.DataFrame(results['teams'])
+            df_teams['Run'] = run
+            self.team_dfs.append(df_teams)
+
+    # Method to adjust each run's outputs using the number of referrals
+    # sampled as a control variate. Runs that happened to get more referrals
+    # than expected will have longer waits, so each output is moved back by
+    # the slope of the output against the mean referrals per week (across
+    # pairs of runs) times how far the run's referrals were from the expected
+    # number.
+    # The unadjusted results are kept in df_unadjusted_results.
+    def apply_control_variate(self):
+        self.df_unadjusted_results = self.df_trial_results.copy()
+
+        df_pairs = self.df_trial_results.groupby('Pair').mean()
+        referrals = df_pairs['Mean Referrals PW']
+        # need a few pairs (and some spread in the referrals) for the slope
+        if len(df_pairs) < 3 or referrals.var() == 0:
+            return
+
+        referrals_diff = (self.df_trial_results['Mean Referrals PW']
+                          - self.expected_referrals_pw)
+
+        for col in trial_output_cols:
+            slope = df_pairs[col].cov(referrals) / referrals.var()
+            self.df_trial_results[col] = (self.df_trial_results[col]
+                                          - slope * referrals_diff)
+
+    # Method to get the mean of each output over the trial with its 95%
+    # confidence interval (see results_summary)
+    def trial_summary(self):
+        return results_summary(self.df_trial_results)
+
+    # Method to get the referral to diagnosis journeys from all runs, by the
+    # week patients were referred, as a single DataFrame (see
+    # journey_cohorts)
+    def journey_results(self):
+        return pd.concat(self.journey_dfs, ignore_index=True)
+
+    # Method to get the weekly stats of each team from all runs as a single
+    # DataFrame (only available if the trial was run with g.teams)
+    def team_results(self):
+        return pd.concat(self.team_dfs, ignore_index=True)
+
+    # Method to get the traces from all runs as a single DataFrame (only
+    # available if the trial was run with g.debug_level >= 1)
+    def trace_results(self):
+        return pd.concat(self.trace_dfs, ignore_index=True)
     
 # my_trial = Trial()
 # pd.set_option('display.max_rows', 1000)
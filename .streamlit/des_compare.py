@@ -0,0 +1,91 @@
+import numpy as np
+import pandas as pd
+
+from des_classes_v5 import trial_output_cols
+from des_experiments import all_params, evaluate_point
+from des_stats import mean_ci
+
+# Paired comparison of two scenarios (e.g. current vs proposed staffing) using
+# common random numbers. Both scenarios are run with the same seeds, so run n
+# of each gets the same weekly referrals (as long as the referral inputs are
+# the same) and patient n gets the same rejection and duration draws. The
+# noise that is common to both then cancels out in the per-run differences,
+# so a difference can be picked up with far fewer runs than comparing two
+# independent trials.
+
+# outputs compared between the scenarios (columns of df_trial_results)
+compare_cols = trial_output_cols
+
+# g parameters that control how the comparison is run rather than describing
+# a scenario
+run_params = ['random_seed','number_of_runs','sim_duration','memory_tracking',
+              'memory_budget_mb','record_detail']
+
+# get the current scenario from g (everything apart from the run settings)
+def scenario_params():
+    params = all_params()
+    for name in run_params:
+        params.pop(name, None)
+    return params
+
+# run the baseline and alternative scenarios with common random numbers.
+# Returns the per-run results of both with the paired differences, and a
+# summary of the mean difference in each output with its 95% confidence
+# interval. The half width of the interval from treating the two trials as
+# independent is included to show how much the pairing has gained.
+def compare_scenarios(baseline_params, alternative_params, seed=42,
+                      number_of_runs=None, sim_duration=None):
+    baseline = evaluate_point(baseline_params, seed, number_of_runs,
+                              sim_duration)
+    alternative = evaluate_point(alternative_params, seed, number_of_runs,
+                                 sim_duration)
+
+    df_baseline = baseline['runs'][compare_cols]
+    df_alternative = alternative['runs'][compare_cols]
+    df_difference = df_alternative - df_baseline
+
+    df_paired = pd.concat({'Baseline':df_baseline,
+                           'Alternative':df_alternative,
+                           'Difference':df_difference}, axis=1)
+
+    # the intervals are worked out from pairs of runs, as the two runs in an
+    # antithetic pair (if used) aren't independent
+    pairs = baseline['runs']['Pair']
+    df_baseline_pairs = df_baseline.groupby(pairs).mean()
+    df_alternative_pairs = df_alternative.groupby(pairs).mean()
+    df_difference_pairs = df_difference.groupby(pairs).mean()
+
+    rows = []
+    for col in compare_cols:
+        difference, paired_half_width = mean_ci(df_difference_pairs[col])
+        baseline_mean, baseline_half_width = mean_ci(df_baseline_pairs[col])
+        alternative_mean, alternative_half_width = \
+                                            mean_ci(df_alternative_pairs[col])
+
+        rows.append({
+            'Output':col,
+            'Baseline':baseline_mean,
+            'Alternative':alternative_mean,
+            'Difference':difference,
+            'CI Lower':difference - paired_half_width,
+            'CI Upper':difference + paired_half_width,
+            # the interval excludes 0 so the scenarios really do differ
+            'Significant':bool(abs(difference) > paired_half_width),
+            'Paired Half Width':paired_half_width,
+            'Unpaired Half Width':np.sqrt(baseline_half_width**2
+                                          + alternative_half_width**2),
+            })
+
+    return df_paired, pd.DataFrame(rows)
+
+if __name__ == '__main__':
+    # compare the default set up against two extra MDT slots per week
+    baseline_params = scenario_params()
+    alternative_params = {**baseline_params,
+                          'mdt_resource':baseline_params['mdt_resource'] + 2}
+    df_paired, df_summary = compare_scenarios(baseline_params,
+                                              alternative_params,
+                                              number_of_runs=5,
+                                              sim_duration=52)
+    pd.set_option('display.max_columns', 20)
+    print(df_summary)
@@ -0,0 +1,107 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from des_classes_v5 import g, Model
+from des_experiments import apply_params, all_params, current_params
+
+# Executors run the replications (runs) of trials, either here, in a pool of
+# local processes or on a Dask cluster spread over several machines. Each
+# replication is shipped as a small task - the g parameters (config), the
+# run's seed and its run number - and only the run's compact results (its
+# outputs and weekly stats, see Model.compact_results) come back, never the
+# patient level results, so there is little to pickle or send over the
+# network.
+#
+# Pass an executor to Trial (or des_experiments.evaluate_points) to use it:
+#
+#   Trial(executor=ProcessExecutor()).run_trial()
+#
+#   from dask.distributed import LocalCluster
+#   with LocalCluster(n_workers=4) as cluster:
+#       Trial(executor=DaskExecutor(cluster)).run_trial()
+
+# run a single replication with the given g parameters, putting g back as it
+# was afterwards (runs in the same process share g). Returns the run's
+# compact results.
+def run_replication(config, seed, run, antithetic=False, model_class=None):
+    saved_params = current_params(config)
+
+    try:
+        apply_params(config)
+
+        if model_class is None:
+            model_class = Model
+        my_model = model_class(run, seed, None, antithetic)
+        my_model.run(print_run_results=False)
+
+        return my_model.compact_results()
+    finally:
+        for name, value in saved_params.items():
+            setattr(g, name, value)
+
+# Class with the parts shared by every executor. Executors only need to
+# provide map, which runs a function over a list of argument tuples and
+# returns the results in the same order.
+class Executor:
+    # tasks for the given (run, seed, antithetic) of a trial with the current
+    # g parameters
+    def replication_tasks(self, run_seeds, model_class=None):
+        config = all_params()
+        return [(config, seed, run, antithetic, model_class)
+                for run, seed, antithetic in run_seeds]
+
+    # run replication tasks, returning their compact results in order
+    def run_tasks(self, tasks):
+        return self.map(run_replication, tasks)
+
+    # run the replications of a trial with the current g parameters (see
+    # Trial.run_seeds)
+    def run_replications(self, run_seeds, model_class=None):
+        return self.run_tasks(self.replication_tasks(run_seeds, model_class))
+
+    def map(self, fn, tasks):
+        raise NotImplementedError
+
+# Class to run replications one after the other in this process - the same as
+# not using an executor, apart from the models not being kept
+class LocalExecutor(Executor):
+    def map(self, fn, tasks):
+        return [fn(*task) for task in tasks]
+
+# Class to run replications in a pool of processes on this machine (one per
+# CPU unless max_workers is given)
+class ProcessExecutor(Executor):
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers
+
+    def map(self, fn, tasks):
+        if not tasks:
+            return []
+
+        max_workers = self.max_workers or os.cpu_count() or 1
+        # send the tasks in chunks so each worker gets a few at a time
+        chunksize = max(1, len(tasks) // (4 * max_workers))
+
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            return list(pool.map(fn, *zip(*tasks), chunksize=chunksize))
+
+# Class to run replications on a Dask cluster. Takes a dask.distributed
+# Client, a cluster (e.g. a LocalCluster to try it out on one machine) or the
+# address of a scheduler. The workers need this folder on their Python path.
+# Dask is only needed if this executor is used.
+class DaskExecutor(Executor):
+    def __init__(self, client_or_cluster):
+        from dask.distributed import Client
+
+        if isinstance(client_or_cluster, Client):
+            self.client = client_or_cluster
+        else:
+            self.client = Client(client_or_cluster)
+
+    def map(self, fn, tasks):
+        if not tasks:
+            return []
+
+        # pure=False as unseeded runs with the same arguments still differ
+        futures = self.client.map(fn, *zip(*tasks), pure=False)
+        return self.client.gather(futures)
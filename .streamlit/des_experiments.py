@@ -0,0 +1,280 @@
+import os
+import json
+import pickle
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from des_classes_v5 import (g, Trial, activity_bands, activity_mins_cols,
+                            activity_names)
+
+# Helpers for running a trial at a given set of g parameters (a "point") and
+# reducing it down to the key outputs. These are shared by the sensitivity
+# analysis and anything else that needs to run lots of trials over different
+# parameter values.
+
+# weekly stats columns (running totals in minutes) that make up each job plan,
+# from the band doing each activity (also used for the Job Plans tab in des.py)
+b6_mins_cols = [activity_mins_cols[activity] for activity in activity_names
+                if activity_bands[activity] == 'b6']
+b4_mins_cols = [activity_mins_cols[activity] for activity in activity_names
+                if activity_bands[activity] == 'b4']
+
+# weekly stats columns kept (averaged over runs) as the trajectory for a point
+trajectory_cols = ['Triage WL','MDT WL','Asst WL','Triage Wait','MDT Wait',
+                   'Asst Wait']
+
+# the key outputs calculated for every point
+output_names = ['Mean Q Time Triage','Mean Q Time MDT','Mean Q Time Asst',
+                'End Triage WL','End MDT WL','End Asst WL','B6 Hours',
+                'B4 Hours']
+
+# set g parameters from a dictionary of {parameter name: value}
+def apply_params(params):
+    for name, value in params.items():
+        if not hasattr(g, name):
+            raise AttributeError(f"g has no parameter called '{name}'")
+        # keep whole number parameters (e.g. number of slots) as whole numbers
+        current = getattr(g, name)
+        if isinstance(current, int) and not isinstance(current, bool):
+            value = int(round(value))
+        setattr(g, name, value)
+
+# get the current value of the named g parameters as a dictionary
+def current_params(names):
+    return {name: getattr(g, name) for name in names}
+
+# get every g parameter (anything that is a single value or a list or
+# dictionary of values, like a referral profile, and isn't one of the counters
+# or results used while a run is going) as a dictionary, e.g. to check whether
+# the inputs have changed since a trial was run
+def all_params():
+    counters = ['number_on_triage_wl','number_on_mdt_wl','number_on_asst_wl',
+                'all_results']
+    return {name:value for name, value in vars(g).items()
+            if not name.startswith('_') and name not in counters
+            and isinstance(value, (int, float, str, bool, list, tuple, dict,
+                                   type(None)))}
+
+# version of the model that points are run with. Increase this whenever a
+# change to the model changes its results, so points cached by an older
+# version aren't reused.
+model_version = 3
+
+# g parameters that only change what is recorded about a run (the trace,
+# memory use and how much of each run is kept), not the results
+recording_params = ['debug_level','trace_capacity','trace_sample_rate',
+                    'trace_stages','memory_tracking','memory_budget_mb',
+                    'record_detail']
+
+# every g parameter a point is run with - the current g values with the
+# point's parameters on top. The seed, number of runs and duration are left
+# out as they are set separately for each point.
+def point_settings(params):
+    settings = {**all_params(), **params}
+    for name in recording_params + ['random_seed','number_of_runs',
+                                    'sim_duration']:
+        settings.pop(name, None)
+    return settings
+
+# names of the parameters that are different between two sets of point
+# settings, apart from the ones in ignore. Only parameters in both are
+# compared, as anything else isn't a g parameter the model uses.
+def changed_settings(settings, other_settings, ignore=()):
+    return sorted(name for name in settings
+                  if name in other_settings and name not in ignore
+                  and settings[name] != other_settings[name])
+
+# reduce the outputs of Trial.run_trial down to the key outputs
+def summarise_trial(df_trial_results, df_weekly_stats):
+    last_week = df_weekly_stats[df_weekly_stats['Week Number'] ==
+                                df_weekly_stats['Week Number'].max()]
+
+    return {
+        'Mean Q Time Triage':df_trial_results['Mean Q Time Triage'].mean(),
+        'Mean Q Time MDT':df_trial_results['Mean Q Time MDT'].mean(),
+        'Mean Q Time Asst':df_trial_results['Mean Q Time Asst'].mean(),
+        # the waiting list counters are read at the end of each run
+        'End Triage WL':df_trial_results['Max Triage WL'].mean(),
+        'End MDT WL':df_trial_results['Max MDT WL'].mean(),
+        'End Asst WL':df_trial_results['Max Asst WL'].mean(),
+        'B6 Hours':last_week[b6_mins_cols].sum(axis=1).mean()/60,
+        'B4 Hours':last_week[b4_mins_cols].sum(axis=1).mean()/60,
+        }
+
+# call fn with g set to a point (and the given run settings), putting g back
+# as it was afterwards. Returns what fn returns.
+def call_at_point(fn, params, seed, number_of_runs=None, sim_duration=None):
+    # remember the g values we are about to change so they can be put back
+    names = list(params) + ['random_seed','number_of_runs','sim_duration']
+    saved_params = current_params(names)
+
+    try:
+        apply_params(params)
+        g.random_seed = seed
+        if number_of_runs is not None:
+            g.number_of_runs = number_of_runs
+        if sim_duration is not None:
+            g.sim_duration = sim_duration
+
+        return fn()
+    finally:
+        for name, value in saved_params.items():
+            setattr(g, name, value)
+
+# run a trial at a single point. Returns the outputs of Trial.run_trial.
+# model_class runs the trial with a different engine to Model, and executor
+# runs it on other processes or machines (see des_executors.py).
+def run_point(params, seed, number_of_runs=None, sim_duration=None,
+              model_class=None, executor=None):
+    return call_at_point(
+        lambda: Trial(model_class=model_class, executor=executor).run_trial(),
+        params, seed, number_of_runs, sim_duration)
+
+# the key outputs of a trial at a point along with the per-run results, the
+# average weekly trajectory and the full g settings it was run with
+def point_result(params, seed, df_trial_results, df_weekly_stats):
+    trajectory = df_weekly_stats.groupby('Week Number')[trajectory_cols].mean()
+
+    return {
+        'params':dict(params),
+        'settings':point_settings(params),
+        'seed':seed,
+        'outputs':summarise_trial(df_trial_results, df_weekly_stats),
+        'runs':df_trial_results,
+        'trajectory':trajectory,
+        }
+
+# run a trial at a single point and return the key outputs along with the
+# per-run results and the average weekly trajectory
+def evaluate_point(params, seed, number_of_runs=None, sim_duration=None):
+    return point_result(params, seed, *run_point(params, seed, number_of_runs,
+                                                 sim_duration))
+
+# Class to store evaluated points on disk so an interrupted study can pick up
+# where it left off. Each point is saved to its own file as soon as it is done.
+# Points are keyed on every g parameter they were run with (not just the ones
+# being varied), so changing anything else about the set up, or the model
+# itself, means they are run again.
+class PointCache:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    # build a key that uniquely identifies a point and how it was run
+    def key(self, params, seed, number_of_runs, sim_duration):
+        key_text = json.dumps(
+            {'settings':point_settings(params), 'seed':seed,
+             'runs':number_of_runs, 'weeks':sim_duration,
+             'version':model_version},
+            sort_keys=True, default=float)
+
+        return hashlib.sha1(key_text.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, f'{key}.pkl')
+
+    def get(self, key):
+        if not os.path.exists(self.path(key)):
+            return None
+        with open(self.path(key), 'rb') as f:
+            return pickle.load(f)
+
+    def put(self, key, result):
+        # write to a temporary file first so a half written file is never
+        # mistaken for a finished point if the study is interrupted
+        tmp_path = self.path(key) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(result, f)
+        os.replace(tmp_path, self.path(key))
+
+    # load every point in the cache
+    def load_all(self):
+        results = []
+        for file_name in sorted(os.listdir(self.directory)):
+            if file_name.endswith('.pkl'):
+                with open(os.path.join(self.directory, file_name), 'rb') as f:
+                    results.append(pickle.load(f))
+        return results
+
+# evaluate a list of points (dictionaries of parameter values), running any
+# that aren't already cached in parallel. base_params are applied to every
+# point, so points only need to hold the parameters that are being varied.
+# Results are returned in the same order as the points. With an executor (see
+# des_executors.py) every run of every point is sent to it as its own task,
+# otherwise the points are run in a local process pool.
+def evaluate_points(points, seed, base_params=None, number_of_runs=None,
+                    sim_duration=None, cache=None, max_workers=None,
+                    executor=None):
+    if number_of_runs is None:
+        number_of_runs = g.number_of_runs
+    if sim_duration is None:
+        sim_duration = g.sim_duration
+
+    full_points = [{**(base_params or {}), **point} for point in points]
+
+    results = [None] * len(full_points)
+    to_run = {}
+
+    for i, params in enumerate(full_points):
+        if cache is not None:
+            key = cache.key(params, seed, number_of_runs, sim_duration)
+            results[i] = cache.get(key)
+        else:
+            key = i
+        # the same point can appear more than once in a design, only run it once
+        if results[i] is None:
+            to_run.setdefault(key, []).append(i)
+
+    def store(key, result):
+        if cache is not None:
+            cache.put(key, result)
+        for i in to_run[key]:
+            results[i] = result
+
+    if executor is not None and to_run:
+        # the tasks for each point's runs, all sent off together so the
+        # executor can spread them over its workers
+        trials = {key:Trial() for key in to_run}
+        tasks = {key:call_at_point(
+                        lambda: executor.replication_tasks(
+                                        trials[key].run_seeds()),
+                        full_points[indexes[0]], seed, number_of_runs,
+                        sim_duration)
+                 for key, indexes in to_run.items()}
+
+        replications = executor.run_tasks([task for key in to_run
+                                           for task in tasks[key]])
+
+        start = 0
+        for key, indexes in to_run.items():
+            params = full_points[indexes[0]]
+            point_replications = replications[start:start + len(tasks[key])]
+            start += len(tasks[key])
+
+            df_trial_results, df_weekly_stats = call_at_point(
+                lambda: trials[key].store_replications(point_replications),
+                params, seed, number_of_runs, sim_duration)
+            store(key, point_result(params, seed, df_trial_results,
+                                    df_weekly_stats))
+    elif max_workers == 1:
+        for key, indexes in to_run.items():
+            store(key, evaluate_point(full_points[indexes[0]], seed,
+                                      number_of_runs, sim_duration))
+    elif to_run:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            futures = {
+                pool.submit(evaluate_point, full_points[indexes[0]], seed,
+                            number_of_runs, sim_duration): key
+                for key, indexes in to_run.items()
+                }
+            for future in as_completed(futures):
+                store(futures[future], future.result())
+
+    return results
+
+# turn a list of evaluated points into a table of parameters and outputs
+def results_to_df(results):
+    return pd.DataFrame([{**result['params'], **result['outputs']}
+                         for result in results])
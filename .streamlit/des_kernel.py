@@ -0,0 +1,670 @@
+import math
+import random
+
+import numpy as np
+import pandas as pd
+
+from des_classes_v5 import (g, Model, AntitheticRandom, activity_names,
+                            stage_duration, queue_stages, wait_quantile,
+                            journey_cohorts, model_teams, DIAGNOSED,
+                            JOURNEY_TOTAL, DIAGNOSED_WITHIN)
+from des_stats import p2_state, p2_add, p2_quantile
+
+# A faster engine for the simulation that steps through the pathway a week at
+# a time with the queues held in arrays, rather than running every patient as
+# a SimPy process. The work for each week - the referrals arriving, the
+# rejections at each stage, handing out the week's triage, MDT and assessment
+# slots first come first served and recording the waits - is done by
+# run_week, which is compiled with Numba when it is installed and runs as
+# plain Python otherwise (much slower, but still quicker than Model).
+#
+# Within a week patients arrive at the MDT and assessment queues part way
+# through the week (when their previous stage finishes), so the kernel goes
+# through the arrival times in order, giving out slots in the same order
+# SimPy does - patients arriving at the same time in the order their
+# previous stage started. Patients get the same random draws as they do in
+# Model, so a run with the same seed gives the same results as Model (to
+# rounding), and KernelModel can be used anywhere Model is:
+#
+#   Trial(model_class=KernelModel).run_trial()
+#
+# The kernel only keeps the weekly stats and outputs, not each patient's
+# results, so it can't be used with the stage cache or the trace. It also
+# only runs the pathway as a single team (no g.teams) with every patient seen
+# first come first served (no prioritised referrals), nobody aging out (no
+# g.referral_ages), no clinician caseloads (no g.clinician_caseload),
+# unlimited staff time (no g.enforce_job_plans), MDT cases reviewed one at a
+# time (no g.mdt_batched) and the slots released once a week (no
+# g.daily_slots).
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# whether run_week is compiled ('numba') or plain Python ('python')
+kernel_backend = 'numba' if njit is not None else 'python'
+
+# compile a kernel function with Numba if it is installed
+def jit(fn):
+    if njit is None:
+        return fn
+    return njit(cache=True)(fn)
+
+# the streaming quantile sketch is updated inside the kernel
+p2_add = jit(p2_add)
+p2_quantile = jit(p2_quantile)
+
+# weekly stats columns added up week by week by the kernel, in the order
+# Model has them (the P90 waits and breaches are added in weekly_stats)
+weekly_cols = ['Referral Screen Mins','Triage WL','Triage Rejects',
+               'Triage Wait','Triage Clin Mins','Triage Admin Mins',
+               'Triage Reject Mins','Pack Send Mins','Pack Rejects',
+               'Pack Reject Mins','Obs Visit Mins','Obs Rejects',
+               'Obs Reject Mins','MDT Prep Mins','MDT Meet Mins','MDT WL',
+               'MDT Rejects','MDT Reject Mins','MDT Wait','Asst WL',
+               'Asst Rejects','Asst Wait','Asst Clin Mins','Asst Admin Mins',
+               'Diag Reject Mins','Diag Accept Mins']
+
+(REFERRAL_SCREEN_MINS, TRIAGE_WL, TRIAGE_REJECTS, TRIAGE_WAIT,
+ TRIAGE_CLIN_MINS, TRIAGE_ADMIN_MINS, TRIAGE_REJECT_MINS, PACK_SEND_MINS,
+ PACK_REJECTS, PACK_REJECT_MINS, OBS_VISIT_MINS, OBS_REJECTS, OBS_REJECT_MINS,
+ MDT_PREP_MINS, MDT_MEET_MINS, MDT_WL, MDT_REJECTS, MDT_REJECT_MINS, MDT_WAIT,
+ ASST_WL, ASST_REJECTS, ASST_WAIT, ASST_CLIN_MINS, ASST_ADMIN_MINS,
+ DIAG_REJECT_MINS, DIAG_ACCEPT_MINS) = range(len(weekly_cols))
+
+# columns that are the waiting list at the end of the week (filled in from the
+# week snapshots) or the mean wait so far (the rest are totals so far)
+wl_cols = [TRIAGE_WL, MDT_WL, ASST_WL]
+mean_cols = [TRIAGE_WAIT, MDT_WAIT, ASST_WAIT]
+
+# stages with a queue, and diagnosis (which patients are sent on to once
+# their assessment finishes, but don't queue for)
+TRIAGE, MDT, ASST, DIAGNOSIS = 0, 1, 2, 3
+WAIT_COLS = (TRIAGE_WAIT, MDT_WAIT, ASST_WAIT)
+
+# where each queue's head, tail, number of patients on their way to it and
+# slots left unused at the end of the last week are kept in the kernel state
+HEAD, TAIL, INCOMING, SLOTS_LEFT = 0, 1, 2, 3
+
+# where the number of waits counted in each stage's mean wait, the number of
+# waits seen, the number over the target, the change in the number of
+# patients part way through each stage, and the time (in patient or slot
+# weeks) spent waiting in the queue and the slots spent in use over the week
+# start in counts
+MEAN_COUNT, SEEN, OVER_TARGET, IN_PROGRESS, QUEUE_TIME, SLOT_TIME = \
+    0, 3, 6, 9, 12, 15
+
+# whether each patient is rejected at each stage
+(REJECT_REFERRAL, REJECT_TRIAGE, REJECT_PACK, REJECT_OBS, REJECT_MDT,
+ REJECT_ASST) = range(6)
+
+# activity times in minutes, in the order of activity_names
+(REFERRAL_SCREEN, TRIAGE_CLIN, TRIAGE_ADMIN, TRIAGE_DISCH, PACK_ADMIN,
+ PACK_REJECT, OBS_VISIT, OBS_REJECT, MDT_PREP, MDT_MEET, MDT_REJECT, ASST_CLIN,
+ ASST_ADMIN, DIAG_DISCH, DIAG_ACCEPT) = range(len(activity_names))
+
+# weeks after the week a result is recorded in that it can be counted in the
+# weekly stats (triage takes up to 4 weeks, and results are counted from the
+# start of the next week)
+bucket_slack = 6
+
+# mean time of each activity in minutes from g, in the order of
+# activity_names
+def activity_means():
+    return np.array([g.referral_screen_time, g.triage_clin_time,
+                     g.triage_admin_time, g.triage_discharge_time,
+                     g.pack_admin_time, g.pack_reject_time, g.school_obs_time,
+                     g.obs_reject_time, g.mdt_prep_time, g.mdt_meet_time,
+                     g.mdt_reject_time, g.asst_clin_time, g.asst_admin_time,
+                     g.diag_time_disch, g.diag_time_accept], dtype=float)
+
+# add a patient to the end of a stage's queue at the given time, recording
+# the time left in the week they could be waiting for
+@jit
+def join_queue(stage, p, time, b, queues, join_times, state, weekly, counts):
+    counts[b, QUEUE_TIME + stage] += b - time
+    tail = state[stage, TAIL]
+    queues[stage, tail] = p
+    state[stage, TAIL] = tail + 1
+    join_times[stage, p] = time
+
+# send a patient on their way to a stage, arriving at the given time
+@jit
+def send_to(stage, p, time, pools, join_times, state):
+    pools[stage, state[stage, INCOMING]] = p
+    state[stage, INCOMING] += 1
+    join_times[stage, p] = time
+
+# record a patient's wait for a stage. Patient 1 (index 0) is already counted
+# in the mean wait as Model starts its results with a row of zeros for them.
+@jit
+def record_wait(stage, p, wait, b, weekly, counts, sketches, targets):
+    weekly[b, WAIT_COLS[stage]] += wait
+    if p != 0:
+        counts[b, MEAN_COUNT + stage] += 1
+
+    counts[b, SEEN + stage] += 1
+    if wait > targets[stage]:
+        counts[b, OVER_TARGET + stage] += 1
+    p2_add(sketches[stage], wait, wait_quantile)
+
+# a patient starting a stage at the given time - record their wait and what
+# happens to them, sending them on to the next stage unless they are rejected
+@jit
+def start_stage(stage, p, time, b, rejected, durations, mins, pools,
+                join_times, state, weekly, counts, sketches, targets):
+    record_wait(stage, p, time - join_times[stage, p], b, weekly,
+                counts, sketches, targets)
+    finish = time + durations[p, stage]
+
+    # part way through the stage until it finishes, which can be in a later
+    # week
+    fb = math.floor(finish) + 1
+    counts[b, IN_PROGRESS + stage] += 1
+    counts[fb, IN_PROGRESS + stage] -= 1
+
+    # no longer waiting and using a slot for the rest of the week
+    counts[b, QUEUE_TIME + stage] -= b - time
+    counts[b, SLOT_TIME + stage] += b - time
+
+    if stage == TRIAGE:
+        weekly[b, TRIAGE_CLIN_MINS] += mins[p, TRIAGE_CLIN]
+        weekly[b, TRIAGE_ADMIN_MINS] += mins[p, TRIAGE_ADMIN]
+        if rejected[p, REJECT_TRIAGE]:
+            weekly[b, TRIAGE_REJECTS] += 1
+            weekly[b, TRIAGE_REJECT_MINS] += mins[p, TRIAGE_DISCH]
+            return
+
+        # the pack and observations are recorded once the triage finishes
+        weekly[fb, PACK_SEND_MINS] += mins[p, PACK_ADMIN]
+        if rejected[p, REJECT_PACK]:
+            weekly[fb, PACK_REJECTS] += 1
+            weekly[fb, PACK_REJECT_MINS] += mins[p, PACK_REJECT]
+            return
+        weekly[fb, OBS_VISIT_MINS] += mins[p, OBS_VISIT]
+        if rejected[p, REJECT_OBS]:
+            weekly[fb, OBS_REJECTS] += 1
+            weekly[fb, OBS_REJECT_MINS] += mins[p, OBS_REJECT]
+            return
+        send_to(MDT, p, finish, pools, join_times, state)
+
+    elif stage == MDT:
+        if rejected[p, REJECT_MDT]:
+            weekly[b, MDT_REJECTS] += 1
+            weekly[b, MDT_REJECT_MINS] += mins[p, MDT_REJECT]
+            return
+        send_to(ASST, p, finish, pools, join_times, state)
+
+    else:
+        weekly[b, ASST_CLIN_MINS] += mins[p, ASST_CLIN]
+        weekly[b, ASST_ADMIN_MINS] += mins[p, ASST_ADMIN]
+        if rejected[p, REJECT_ASST]:
+            weekly[b, ASST_REJECTS] += 1
+            weekly[b, DIAG_REJECT_MINS] += mins[p, DIAG_DISCH]
+        else:
+            weekly[b, DIAG_ACCEPT_MINS] += mins[p, DIAG_ACCEPT]
+        send_to(DIAGNOSIS, p, finish, pools, join_times, state)
+
+# give out a stage's slots left this week to the patients waiting, first come
+# first served. Returns the number of slots left.
+@jit
+def give_out_slots(stage, time, slots_left, b, rejected, durations, mins,
+                   queues, pools, join_times, state, weekly, counts,
+                   sketches, targets):
+    while slots_left > 0 and state[stage, HEAD] < state[stage, TAIL]:
+        p = queues[stage, state[stage, HEAD]]
+        state[stage, HEAD] += 1
+        slots_left -= 1
+        start_stage(stage, p, time, b, rejected, durations, mins, pools,
+                    join_times, state, weekly, counts, sketches, targets)
+    return slots_left
+
+# take the patients arriving at a stage this week out of those on their way,
+# keeping the rest in order. Returns the patients, their arrival times and
+# the order they arrive in - patients arriving at the same time stay in the
+# order they were sent (the order their previous stage started).
+@jit
+def take_arrivals(stage, week, pools, join_times, state):
+    incoming = state[stage, INCOMING]
+    arrivals = np.empty(incoming, dtype=np.int64)
+    n_arrivals = 0
+    n_left = 0
+    for i in range(incoming):
+        p = pools[stage, i]
+        if join_times[stage, p] < week + 1:
+            arrivals[n_arrivals] = p
+            n_arrivals += 1
+        else:
+            pools[stage, n_left] = p
+            n_left += 1
+    state[stage, INCOMING] = n_left
+
+    arrivals = arrivals[:n_arrivals]
+    arrival_times = np.empty(n_arrivals)
+    for i in range(n_arrivals):
+        arrival_times[i] = join_times[stage, arrivals[i]]
+    order = np.argsort(arrival_times, kind='mergesort')
+
+    return arrivals, arrival_times, order
+
+# run the MDT or assessment stage for a week. Patients arriving during the
+# week join the queue at the time they arrive, and anyone waiting is seen at
+# the start of the week or as soon as they arrive while slots are left.
+@jit
+def run_arrivals_stage(stage, week, slots, b, rejected, durations, mins,
+                       queues, pools, join_times, state, weekly, counts,
+                       sketches, targets):
+    arrivals, arrival_times, order = take_arrivals(stage, week, pools,
+                                                   join_times, state)
+    n_arrivals = len(arrivals)
+
+    # everyone arriving at the same time joins the queue before any of them
+    # are seen
+    slots_left = slots
+    time = float(week)
+    i = 0
+    while True:
+        while i < n_arrivals and arrival_times[order[i]] == time:
+            p = arrivals[order[i]]
+            join_queue(stage, p, time, b, queues, join_times, state, weekly,
+                       counts)
+            if stage == MDT:
+                weekly[b, MDT_PREP_MINS] += mins[p, MDT_PREP]
+                weekly[b, MDT_MEET_MINS] += mins[p, MDT_MEET]
+            i += 1
+
+        slots_left = give_out_slots(stage, time, slots_left, b, rejected,
+                                    durations, mins, queues, pools,
+                                    join_times, state, weekly, counts,
+                                    sketches, targets)
+
+        if i == n_arrivals:
+            break
+        time = arrival_times[order[i]]
+
+    state[stage, SLOTS_LEFT] = slots_left
+
+# Kernel for one simulated week - patients first..last - 1 are referred at
+# the start of the week. Results from the week are added to the weekly stats
+# from the next week (row week + 1 of weekly), and each stage's waits to its
+# P90 sketch. targets are the target waits for the stages.
+@jit
+def run_week(week, first, last, slots, targets, rejected, durations, mins,
+             queues, pools, join_times, state, weekly, counts, sketches):
+    b = week + 1
+    time = float(week)
+
+    # referrals that aren't rejected join the triage queue
+    for p in range(first, last):
+        weekly[b, REFERRAL_SCREEN_MINS] += mins[p, REFERRAL_SCREEN]
+        if not rejected[p, REJECT_REFERRAL]:
+            join_queue(TRIAGE, p, time, b, queues, join_times, state, weekly,
+                       counts)
+
+    # triage is only ever at the start of the week, when the referrals come in
+    state[TRIAGE, SLOTS_LEFT] = give_out_slots(
+        TRIAGE, time, slots[TRIAGE], b, rejected, durations, mins, queues,
+        pools, join_times, state, weekly, counts, sketches, targets)
+
+    # triage finishing can send patients to MDT this week, and MDT to
+    # assessment, so the stages are run in order
+    run_arrivals_stage(MDT, week, slots[MDT], b, rejected, durations, mins,
+                       queues, pools, join_times, state, weekly, counts,
+                       sketches, targets)
+    run_arrivals_stage(ASST, week, slots[ASST], b, rejected, durations, mins,
+                       queues, pools, join_times, state, weekly, counts,
+                       sketches, targets)
+
+# add the patients diagnosed this week (their assessment finishing) to the
+# journey stats and P90 sketch of the week they were referred, in the order
+# they are diagnosed
+@jit
+def finish_journeys(week, referral_weeks, horizons, pools, join_times, state,
+                    journey_stats, journey_sketches):
+    diagnosed, diagnosis_times, order = take_arrivals(DIAGNOSIS, week, pools,
+                                                      join_times, state)
+    for i in order:
+        cohort = referral_weeks[diagnosed[i]]
+        journey = diagnosis_times[i] - cohort
+
+        journey_stats[cohort, DIAGNOSED] += 1
+        journey_stats[cohort, JOURNEY_TOTAL] += journey
+        for h in range(len(horizons)):
+            if journey <= horizons[h]:
+                journey_stats[cohort, DIAGNOSED_WITHIN + h] += 1
+        p2_add(journey_sketches[cohort], journey, wait_quantile)
+
+# make an array longer along an axis, filling the new part with zeros
+def pad(array, length, axis=0):
+    widths = [(0, 0)] * array.ndim
+    widths[axis] = (0, max(length - array.shape[axis], 0))
+    return np.pad(array, widths)
+
+# Class running the simulation with the weekly kernel. Takes the same
+# arguments as Model (the stage cache isn't used) and has the same run,
+# extend and compact_results methods.
+class KernelModel:
+    def __init__(self, run_number, seed=None, stage_cache=None,
+                 antithetic=False, memory=None):
+        self.run_number = run_number
+        self.seed = seed
+
+        # patient draws as in Model, so patient n gets the same draws
+        self.antithetic = antithetic
+        if antithetic:
+            self.patient_rng = AntitheticRandom(f'{seed} patients')
+        elif seed is not None:
+            self.patient_rng = random.Random(f'{seed} patients')
+        else:
+            self.patient_rng = random.Random()
+
+        if g.teams:
+            raise ValueError("KernelModel can't run more than one team "
+                             "(g.teams)")
+        if (g.urgent_referral_rate or g.lac_referral_rate
+                or g.near_18_referral_rate):
+            raise ValueError("KernelModel can't prioritise referrals")
+        if g.referral_ages is not None:
+            raise ValueError("KernelModel can't age patients out")
+        if g.clinician_caseload is not None:
+            raise ValueError("KernelModel can't model clinician caseloads")
+        if g.enforce_job_plans:
+            raise ValueError("KernelModel can't enforce job plans")
+        if g.mdt_batched:
+            raise ValueError("KernelModel can't batch the MDT")
+        if g.daily_slots:
+            raise ValueError("KernelModel can't release slots daily")
+        self.teams = model_teams()
+
+        self.arrival_schedule = []
+        self.referral_rates = []
+        self.referrals_per_week = []
+
+        # no stage cache or trace - every stage is run from the referrals
+        self.stage_cache = None
+        self.start_stage = 'referral'
+        self.trace = None
+
+        self.memory = memory
+
+        self.week_number = 0
+        self.patient_counter = 0
+        # index of each week's first patient
+        self.week_first_patient = [0]
+
+        # patients, by index (patient ID - 1)
+        self.referral_weeks = np.zeros(0, dtype=np.int64)
+        self.rejected = np.zeros((0, 6), dtype=np.bool_)
+        self.durations = np.zeros((0, 3))
+        self.mins = np.zeros((0, len(activity_names)))
+
+        # the queues, patients on their way to each stage (and diagnosis)
+        # and the time each patient joined each queue
+        self.queues = np.zeros((3, 0), dtype=np.int64)
+        self.pools = np.zeros((4, 0), dtype=np.int64)
+        self.join_times = np.zeros((4, 0))
+        self.state = np.zeros((4, 4), dtype=np.int64)
+
+        # results recorded each week (counted in the weekly stats from the
+        # week after). Patient 1's wait starts counted as 0, as in Model.
+        self.weekly = np.zeros((bucket_slack, len(weekly_cols)))
+        self.counts = np.zeros((bucket_slack, 18))
+        self.counts[0, MEAN_COUNT:MEAN_COUNT + 3] = 1
+
+        # P90 sketch of each stage's waits, and its estimate at the start of
+        # each week
+        self.sketches = np.array([p2_state() for stage in queue_stages])
+        self.wait_p90 = []
+
+        # patients waiting at each stage and the slots left unused at the end
+        # of each week
+        self.week_snapshots = []
+
+        # journey stats and P90 sketch for each referral week (see
+        # journey_cohorts)
+        self.journey_stats = np.zeros((0, DIAGNOSED_WITHIN
+                                       + len(g.journey_horizons)))
+        self.journey_sketches = np.zeros((0, len(p2_state())))
+
+    # referrals are sampled the same way as Model, so runs with the same seed
+    # get the same number of referrals each week
+    sample_arrivals = Model.sample_arrivals
+    expected_referrals_pw = Model.expected_referrals_pw
+
+    # Decide everything random about the patients referred in the weeks up to
+    # the given week, drawing in the same order as Patient.draw_fates
+    def add_patients(self, weeks):
+        uniform = self.patient_rng.uniform
+        gauss = self.patient_rng.gauss
+
+        first_patient = self.rejected.shape[0]
+        draws = []
+        for week in range(len(self.week_first_patient) - 1, weeks):
+            for referral in range(int(self.arrival_schedule[week])):
+                draws.append([uniform(0,1) for i in range(11)]
+                             + [gauss(0, 1) for activity in activity_names])
+            self.week_first_patient.append(first_patient + len(draws))
+
+        draws = np.array(draws, dtype=float).reshape(-1, 11
+                                                     + len(activity_names))
+        u = draws[:, :11]
+        z = draws[:, 11:]
+
+        rejected = np.column_stack([
+            u[:, 0] <= g.referral_rejection_rate,
+            u[:, 1] <= g.triage_rejection_rate,
+            u[:, 2] < g.pack_rejection_rate,
+            u[:, 3] < g.obs_rejection_rate,
+            u[:, 4] <= g.mdt_rejection_rate,
+            u[:, 5] <= g.asst_rejection_rate,
+            ])
+
+        # stage_duration rounds as Python does, so the times match Model's
+        durations = np.array([[stage_duration(4 * u_triage),
+                               stage_duration(u_mdt),
+                               stage_duration(4 * u_asst)]
+                              for u_triage, u_mdt, u_asst
+                              in u[:, [6, 9, 10]].tolist()]).reshape(-1, 3)
+
+        # activity times, mirrored about the mean where they would be 0 or
+        # less (see Model.activity_mins)
+        means = activity_means()
+        mins = means + g.std_dev * z
+        mins = np.where(mins <= 0, means + g.std_dev * np.abs(z), mins)
+
+        self.referral_weeks = np.repeat(
+            np.arange(len(self.week_first_patient) - 1),
+            np.diff(self.week_first_patient))
+        self.rejected = np.concatenate([self.rejected, rejected])
+        self.durations = np.concatenate([self.durations, durations])
+        self.mins = np.concatenate([self.mins, mins])
+
+        patients = self.rejected.shape[0]
+        self.queues = pad(self.queues, patients, axis=1)
+        self.pools = pad(self.pools, patients, axis=1)
+        self.join_times = pad(self.join_times, patients, axis=1)
+
+    # run the weeks up to the given week
+    def run_weeks(self, weeks):
+        self.add_patients(weeks)
+        self.weekly = pad(self.weekly, weeks + bucket_slack)
+        self.counts = pad(self.counts, weeks + bucket_slack)
+        self.journey_stats = pad(self.journey_stats, weeks)
+        self.journey_sketches = pad(self.journey_sketches, weeks)
+
+        slots = np.array([g.triage_resource, g.mdt_resource, g.asst_resource],
+                         dtype=np.int64)
+        targets = np.array([g.target_triage_wait, g.target_mdt_wait,
+                            g.target_asst_wait], dtype=float)
+        horizons = np.array(g.journey_horizons, dtype=float)
+
+        # every slot is free at the start of the run
+        if self.week_number == 0:
+            self.state[:DIAGNOSIS, SLOTS_LEFT] = slots
+
+        while self.week_number < weeks:
+            first = self.week_first_patient[self.week_number]
+            last = self.week_first_patient[self.week_number + 1]
+            self.referrals_per_week.append(last - first)
+            self.patient_counter = last
+
+            self.wait_p90.append([p2_quantile(sketch, wait_quantile)
+                                  for sketch in self.sketches])
+            self.week_snapshots.append(
+                [*(self.state[:DIAGNOSIS, TAIL] - self.state[:DIAGNOSIS, HEAD]),
+                 *self.state[:DIAGNOSIS, SLOTS_LEFT]])
+
+            run_week(self.week_number, first, last, slots, targets,
+                     self.rejected, self.durations, self.mins, self.queues,
+                     self.pools, self.join_times, self.state, self.weekly,
+                     self.counts, self.sketches)
+            finish_journeys(self.week_number, self.referral_weeks, horizons,
+                            self.pools, self.join_times, self.state,
+                            self.journey_stats, self.journey_sketches)
+
+            if self.memory is not None:
+                self.memory.sample()
+
+            self.week_number += 1
+
+    # The weekly stats for each week run so far, by column. Each week's stats
+    # are for everything up to the start of the week.
+    def weekly_stats(self):
+        weeks = self.week_number
+        totals = np.cumsum(self.weekly[:weeks], axis=0)
+        counts = np.cumsum(self.counts[:weeks], axis=0)
+        wait_p90 = np.array(self.wait_p90).reshape(-1, 3)
+
+        week_snapshots = np.array(self.week_snapshots).reshape(-1, 6)
+
+        stats = {'Week Number':np.arange(weeks)}
+        for col, name in enumerate(weekly_cols):
+            if col in wl_cols:
+                stats[name] = week_snapshots[:, wl_cols.index(col)]
+            elif col in mean_cols:
+                stage = mean_cols.index(col)
+                stats[name] = (totals[:, col]
+                               / counts[:, MEAN_COUNT + stage])
+
+                seen = counts[:, SEEN + stage]
+                stats[f'{name} P90'] = wait_p90[:, stage]
+                stats[name.replace('Wait', 'Breach %')] = np.where(
+                    seen > 0,
+                    100 * counts[:, OVER_TARGET + stage]
+                    / np.maximum(seen, 1),
+                    np.nan)
+            else:
+                stats[name] = totals[:, col]
+
+        # snapshots of the end of each week, and the number waiting and % of
+        # slots used on average over the week (the number waiting at the
+        # start of the week plus the time those joining waited, less the time
+        # those seen didn't). There's no time before week 0 to average over.
+        slots = np.array([g.triage_resource, g.mdt_resource, g.asst_resource])
+        for stage, label in enumerate(['Triage','MDT','Asst']):
+            queue_time = np.full(weeks, np.nan)
+            queue_time[1:] = (week_snapshots[:-1, stage]
+                              + self.counts[1:weeks, QUEUE_TIME + stage])
+            slot_time = np.full(weeks, np.nan)
+            slot_time[1:] = self.counts[1:weeks, SLOT_TIME + stage]
+
+            stats[f'{label} Queue'] = week_snapshots[:, stage]
+            stats[f'{label} Slots Left'] = week_snapshots[:, 3 + stage]
+            stats[f'{label} In Progress'] = counts[:, IN_PROGRESS + stage]
+            stats[f'{label} Avg Queue'] = queue_time
+            stats[f'{label} Utilisation %'] = 100 * slot_time / slots[stage]
+
+        # nobody ages out
+        for label in ['Triage','MDT','Asst']:
+            stats[f'{label} Aged Out'] = np.zeros(weeks, dtype=int)
+
+        # or goes on a caseload
+        for col in ['Caseload','Caseload Queue','In Titration']:
+            stats[col] = np.zeros(weeks, dtype=int)
+
+        return stats
+
+    # The run's outputs - the mean waits over everyone seen before the end
+    # of the run and the waiting lists at the end
+    def calculate_run_results(self):
+        end = self.week_number + 1
+        waits = [self.weekly[:end, col].sum()
+                 / self.counts[:end, MEAN_COUNT + stage].sum()
+                 for stage, col in enumerate(WAIT_COLS)]
+        waiting = self.state[:DIAGNOSIS, TAIL] - self.state[:DIAGNOSIS, HEAD]
+
+        self.mean_q_time_triage, self.mean_q_time_mdt, \
+            self.mean_q_time_asst = waits
+        self.max_triage_wl, self.max_mdt_wl, self.max_asst_wl = \
+            [int(n) for n in waiting]
+
+    def run(self, print_run_results=True):
+        # seed the random number generators so a run can be reproduced
+        if self.seed is not None:
+            random.seed(self.seed)
+            np.random.seed(self.seed)
+
+        self.sample_arrivals(g.sim_duration)
+        self.run_weeks(g.sim_duration)
+
+        self.snapshot()
+        self.calculate_run_results()
+
+        if print_run_results:
+            print (f"Run Number {self.run_number}")
+            print (pd.DataFrame(self.weekly_stats()))
+
+    # keep the random number generator states so the run can be extended
+    # (the rest of the run's state is all in the model)
+    def snapshot(self):
+        self.saved_state = {
+            'sim_time':self.week_number,
+            'random_state':random.getstate(),
+            'np_random_state':np.random.get_state(),
+            }
+
+    # Carry on a finished run up to a longer simulation duration
+    def extend(self, sim_duration):
+        if sim_duration <= self.saved_state['sim_time']:
+            raise ValueError(f"Run {self.run_number} has already been run for "
+                             f"{self.saved_state['sim_time']} weeks")
+
+        random.setstate(self.saved_state['random_state'])
+        np.random.set_state(self.saved_state['np_random_state'])
+
+        self.sample_arrivals(sim_duration)
+        self.run_weeks(sim_duration)
+
+        self.snapshot()
+        self.calculate_run_results()
+
+    # The results of the run in the same form as Model.compact_results
+    def compact_results(self):
+        return {
+            'outputs':[self.mean_q_time_triage, self.max_triage_wl,
+                       self.mean_q_time_mdt, self.max_mdt_wl,
+                       self.mean_q_time_asst, self.max_asst_wl],
+            'mean_referrals_pw':np.mean(self.referrals_per_week),
+            'expected_referrals_pw':self.expected_referrals_pw(),
+            'weekly_stats':self.weekly_stats(),
+            'journeys':journey_cohorts(self.referrals_per_week,
+                                       self.journey_stats,
+                                       self.journey_sketches,
+                                       self.week_number),
+            'teams':{},
+            }
+
+if __name__ == '__main__':
+    # check the kernel against Model with independent seeds (see
+    # des_validation.py)
+    import sys
+    from des_validation import validate_engine
+
+    df_report, passed = validate_engine(KernelModel, number_of_runs=10)
+    pd.set_option('display.max_rows', 1000)
+    pd.set_option('display.width', 200)
+    print(df_report)
+    print(f"Kernel backend: {kernel_backend}")
+    print('PASSED' if passed else 'FAILED')
+    sys.exit(0 if passed else 1)
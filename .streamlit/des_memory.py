@@ -0,0 +1,130 @@
+import os
+import tracemalloc
+
+import numpy as np
+
+from des_arrivals import referral_rates
+
+# Memory accounting for trials. A long trial with every patient kept can use
+# more memory than the server has, so:
+#
+# - MemoryMonitor measures the peak memory of each run and of the whole trial,
+#   either by sampling the resident memory of the process every week ('rss',
+#   cheap but only as fine as the weekly samples) or with tracemalloc
+#   ('tracemalloc', exact for Python allocations but runs about 3x slower).
+# - estimate_trial_mb estimates how much memory a trial will need before it
+#   starts, which Trial uses to keep within g.memory_budget_mb - dropping to
+#   'summary' detail (each run's patients are thrown away once its results
+#   are stored) or refusing to run.
+
+# bytes of memory per patient, measured with tracemalloc on 52 and 156 week
+# runs of the default set up. A finished run that is kept holds its patients'
+# results and the SimPy processes of those still waiting. Runs using the stage
+# cache also keep the arrivals into each stage, in the run and in the cache.
+kept_bytes_per_patient = 4000
+peak_bytes_per_patient = 4300
+stage_cache_bytes_per_patient = 4200
+
+# bytes of memory per week of each run's weekly stats
+weekly_stats_bytes_per_week = 2500
+
+# Error raised when a trial would need more memory than the budget even with
+# only the results kept. Includes the estimate in MB.
+class MemoryBudgetError(ValueError):
+    def __init__(self, estimate_mb, budget_mb):
+        self.estimate_mb = estimate_mb
+        self.budget_mb = budget_mb
+        super().__init__(f"The trial is estimated to need {estimate_mb:.0f} "
+                         f"MB of memory even keeping only the results of each "
+                         f"run, which is over the budget of {budget_mb:.0f} "
+                         f"MB. Try fewer runs or a shorter simulation.")
+
+# estimated memory in MB for a trial at the given record detail ('full' keeps
+# every run, 'summary' only keeps the results of each run)
+def estimate_trial_mb(record_detail, number_of_runs, sim_duration,
+                      mean_referrals_pw, referral_profile=None,
+                      stage_cache=False):
+    # expected number of patients referred in each run
+    patients = float(np.sum(referral_rates(mean_referrals_pw,
+                                           referral_profile, sim_duration)))
+    weekly_stats = (number_of_runs * (sim_duration + 1)
+                    * weekly_stats_bytes_per_week)
+
+    if record_detail == 'full':
+        per_patient = kept_bytes_per_patient
+        if stage_cache:
+            per_patient += stage_cache_bytes_per_patient
+        # every run is kept, and the last one peaks a bit above what is kept
+        estimate = (number_of_runs * patients * per_patient
+                    + patients * (peak_bytes_per_patient
+                                  - kept_bytes_per_patient))
+    else:
+        # only one run's patients are held at a time
+        estimate = patients * peak_bytes_per_patient
+
+    return (estimate + weekly_stats) / 1e6
+
+# resident memory of this process in bytes (Linux only, None elsewhere)
+def current_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+# Class to measure the peak memory of each run in a trial, and of the trial as
+# a whole, above what was in use when the trial started. method is 'rss' or
+# 'tracemalloc' ('rss' falls back to 'tracemalloc' where the resident memory
+# can't be read).
+class MemoryMonitor:
+    def __init__(self, method='rss'):
+        if method == 'rss' and current_rss() is None:
+            method = 'tracemalloc'
+        self.method = method
+
+        self.started_tracing = False
+        self.run_peak = 0
+        self.trial_peak = 0
+
+    # memory in use now and the peak since the last reset
+    def measure(self):
+        if self.method == 'tracemalloc':
+            return tracemalloc.get_traced_memory()
+        rss = current_rss()
+        return rss, max(rss, self.run_peak)
+
+    def start_trial(self):
+        if self.method == 'tracemalloc' and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+
+        self.trial_start = self.measure()[0]
+        self.trial_peak = 0
+
+    def start_run(self):
+        if self.method == 'tracemalloc':
+            tracemalloc.reset_peak()
+
+        self.run_start = self.measure()[0]
+        self.run_peak = self.run_start
+
+    # take a sample of the memory in use (only needed for 'rss', tracemalloc
+    # keeps track of its own peak)
+    def sample(self):
+        if self.method == 'rss':
+            self.run_peak = max(self.run_peak, current_rss())
+
+    # peak memory in MB during the run, above what was in use when it started
+    def end_run(self):
+        peak = self.measure()[1]
+        self.trial_peak = max(self.trial_peak, peak - self.trial_start)
+        return (peak - self.run_start) / 1e6
+
+    # peak memory in MB during the trial, above what was in use when it
+    # started
+    def end_trial(self):
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+        return self.trial_peak / 1e6
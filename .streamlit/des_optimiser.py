@@ -0,0 +1,183 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from des_classes_v5 import g
+from des_experiments import PointCache, evaluate_points
+
+# Capacity optimiser - searches over the number of slots (and optionally the
+# staff WTE) for the cheapest set up where the simulated waits meet the targets
+# in g with a chosen probability.
+#
+# The cost of a candidate doesn't depend on the simulation (it is either the
+# total number of slots or the contracted staff hours per week), so the only
+# noisy part is whether the waits meet the targets. Staff only limit the
+# simulation when the job plans are enforced (see StaffBudget), so they always
+# are when the staff WTE are searched over or staff hours are the cost.
+#
+# The search uses successive halving - every candidate starts with a few runs,
+# then each round clearly infeasible candidates and ones that cost more than a
+# clearly feasible one are dropped, the cheapest half of the rest are kept and
+# their number of runs is doubled. Dropped candidates are brought back once the
+# cheaper ones have been settled. That way most runs are spent on the
+# candidates that could be the answer.
+
+# default slots to search over
+default_search_space = {
+    'triage_resource':list(range(30, 75, 5)),
+    'mdt_resource':list(range(5, 65, 5)),
+    'asst_resource':list(range(20, 90, 10)),
+    }
+
+# staff WTE to add to the search when optimising staff hours
+default_staff_space = {
+    'number_staff_b6_prac':[6.0, 7.0, 8.0, 9.0, 10.0, 11.0, 12.0],
+    'number_staff_b4_prac':[6.0, 8.0, 10.0, 12.0, 14.0],
+    }
+
+slot_params = ['triage_resource','mdt_resource','asst_resource']
+
+# the result columns compared against each of the wait targets
+wait_targets = {
+    'Mean Q Time Triage':'target_triage_wait',
+    'Mean Q Time MDT':'target_mdt_wait',
+    'Mean Q Time Asst':'target_asst_wait',
+    }
+
+# cost of a candidate - total slots per week or contracted staff hours per week
+def candidate_cost(params, objective):
+    if objective == 'slots':
+        return sum(params.get(name, getattr(g, name)) for name in slot_params)
+    elif objective == 'staff_hours':
+        return (params.get('number_staff_b6_prac', g.number_staff_b6_prac)
+                * params.get('hours_avail_b6_prac', g.hours_avail_b6_prac)
+                + params.get('number_staff_b4_prac', g.number_staff_b4_prac)
+                * params.get('hours_avail_b4_prac', g.hours_avail_b4_prac))
+    else:
+        raise ValueError(f"Unknown objective '{objective}'")
+
+# Wilson score interval for the probability of meeting the targets
+def wilson_interval(successes, trials, z=1.96):
+    if trials == 0:
+        return 0.0, 1.0
+    p_hat = successes / trials
+    denom = 1 + z**2 / trials
+    centre = (p_hat + z**2 / (2 * trials)) / denom
+    half_width = (z * np.sqrt(p_hat * (1 - p_hat) / trials
+                              + z**2 / (4 * trials**2)) / denom)
+    return max(0.0, centre - half_width), min(1.0, centre + half_width)
+
+# count the runs in a result where every wait met its target
+def runs_meeting_targets(result, targets):
+    df_runs = result['runs']
+    meets = np.ones(len(df_runs), dtype=bool)
+    for col, target in targets.items():
+        meets &= (df_runs[col] <= target).to_numpy()
+    return int(meets.sum()), len(df_runs)
+
+# search for the cheapest candidate that meets the wait targets with at least
+# target_probability. Returns a table of every candidate with its estimated
+# probability and status, and the parameters of the best candidate (or None
+# if nothing was found to be feasible).
+def optimise_capacity(search_space=None, objective='slots', search_staff=False,
+                      target_probability=0.9, base_params=None, seed=42,
+                      initial_runs=2, max_runs=32, sim_duration=None,
+                      cache_dir=None, max_workers=None, executor=None):
+    if search_space is None:
+        search_space = dict(default_search_space)
+        if search_staff:
+            search_space.update(default_staff_space)
+
+    base_params = dict(base_params or {})
+    # without enforced job plans the staff don't change the waits at all, and
+    # the fewest staff would always look the cheapest feasible set up
+    if search_staff or objective == 'staff_hours':
+        base_params['enforce_job_plans'] = True
+
+    targets = {col:base_params.get(name, getattr(g, name))
+               for col, name in wait_targets.items()}
+
+    names = list(search_space)
+    candidates = pd.DataFrame(list(itertools.product(*search_space.values())),
+                              columns=names)
+    candidates['Cost'] = [candidate_cost({**base_params, **params}, objective)
+                          for params in candidates[names].to_dict('records')]
+    candidates['Runs'] = 0
+    candidates['Runs Met'] = 0
+    candidates['Status'] = 'undecided'
+
+    cache = PointCache(cache_dir) if cache_dir is not None else None
+
+    active = list(candidates.index)
+
+    while active:
+        # give every active candidate another batch of runs, doubling the runs
+        # it has had so far. The batch seed follows on from the runs already
+        # done (run n uses seed + n) and is the same for every candidate, so
+        # they are compared on common random numbers.
+        for runs_done, group in candidates.loc[active].groupby('Runs'):
+            batch_runs = min(max(initial_runs, runs_done), max_runs - runs_done)
+            results = evaluate_points(
+                group[names].to_dict('records'), seed + runs_done,
+                base_params=base_params, number_of_runs=batch_runs,
+                sim_duration=sim_duration, cache=cache, max_workers=max_workers,
+                executor=executor)
+
+            for i, result in zip(group.index, results):
+                met, runs = runs_meeting_targets(result, targets)
+                candidates.loc[i, 'Runs Met'] += met
+                candidates.loc[i, 'Runs'] += runs
+
+        for i in active:
+            lower, upper = wilson_interval(candidates.loc[i, 'Runs Met'],
+                                           candidates.loc[i, 'Runs'])
+            if upper < target_probability:
+                candidates.loc[i, 'Status'] = 'infeasible'
+            elif lower >= target_probability:
+                candidates.loc[i, 'Status'] = 'feasible'
+
+        # anything costing more than a clearly feasible candidate can't win
+        feasible = candidates[candidates['Status'] == 'feasible']
+        best_cost = feasible['Cost'].min() if len(feasible) else np.inf
+        candidates.loc[candidates['Status'].isin(['undecided','dropped'])
+                       & (candidates['Cost'] >= best_cost), 'Status'] = 'dominated'
+
+        undecided = candidates.loc[active]
+        undecided = undecided[(undecided['Status'] == 'undecided')
+                              & (undecided['Runs'] < max_runs)]
+
+        # once the cheaper candidates are settled, bring back any dropped in
+        # earlier rounds that could still beat the best feasible candidate
+        if undecided.empty:
+            undecided = candidates[(candidates['Status'] == 'dropped')
+                                   & (candidates['Runs'] < max_runs)]
+            candidates.loc[undecided.index, 'Status'] = 'undecided'
+
+        # keep the cheapest half of the undecided candidates for the next round
+        keep = int(np.ceil(len(undecided) / 2))
+        undecided = undecided.sort_values('Cost')
+        candidates.loc[undecided.index[keep:], 'Status'] = 'dropped'
+        active = list(undecided.index[:keep])
+
+    candidates['P Meet Targets'] = (candidates['Runs Met']
+                                    / candidates['Runs'].replace(0, np.nan))
+
+    # the best candidate is the cheapest one that is clearly feasible, or if
+    # the run budget ran out, the cheapest one that looks feasible
+    chosen = candidates[candidates['Status'] == 'feasible']
+    if chosen.empty:
+        chosen = candidates[candidates['P Meet Targets'] >= target_probability]
+    if chosen.empty:
+        best = None
+    else:
+        best = chosen.sort_values('Cost').iloc[0][names].to_dict()
+
+    return candidates, best
+
+if __name__ == '__main__':
+    df_candidates, best = optimise_capacity(sim_duration=52,
+                                            cache_dir='optimiser_cache')
+    pd.set_option('display.max_rows', 1000)
+    print(df_candidates.sort_values('Cost').head(50))
+    print(f'Best set up: {best}')
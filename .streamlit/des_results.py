@@ -0,0 +1,122 @@
+import os
+import io
+import re
+import json
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Saving the results of a trial so they can be reopened later without running
+# the simulation again. A saved result is a folder holding df_trial_results
+# and the weekly stats as Arrow IPC files, with the g parameters the trial was
+# run with kept in the file metadata. Arrow files are opened by memory mapping
+# them and the columns are turned into a DataFrame without copying them where
+# they can be (numbers without any gaps), so even a large trial opens almost
+# instantly - only the parts of the file that are actually used get read from
+# disk.
+#
+# Results can also be exported as Parquet (smaller, and readable by most data
+# tools) or Arrow for downloading from the page.
+
+# tables making up a saved result and the file each is kept in
+result_files = {'trial_results':'trial_results.arrow',
+                'weekly_stats':'weekly_stats.arrow'}
+
+# key the g parameters are stored under in the file metadata
+params_key = b'adhd_params'
+
+# convert a results DataFrame to an Arrow table, keeping the parameters
+def results_to_table(df, params):
+    table = pa.Table.from_pandas(df)
+    metadata = {**(table.schema.metadata or {}),
+                params_key:json.dumps(params, default=float).encode('utf-8')}
+    return table.replace_schema_metadata(metadata)
+
+# get the parameters back from a table made by results_to_table
+def table_params(table):
+    metadata = table.schema.metadata or {}
+    if params_key not in metadata:
+        return {}
+    return json.loads(metadata[params_key])
+
+# DataFrame as the bytes of a Parquet file, e.g. for a download button
+def results_to_parquet(df, params):
+    buffer = io.BytesIO()
+    pq.write_table(results_to_table(df, params), buffer)
+    return buffer.getvalue()
+
+# DataFrame as the bytes of an Arrow IPC file, e.g. for a download button
+def results_to_arrow(df, params):
+    table = results_to_table(df, params)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+# name of the folder a result called name is saved in. Anything other than
+# letters, numbers, spaces, '-', '_' and '.' is replaced with '_' and leading
+# dots and spaces are removed, so the folder is always inside the saved
+# results directory (e.g. '../x' is saved as '_x').
+def result_folder_name(name):
+    folder_name = re.sub(r'[^\w\-. ]', '_', name).lstrip('. ')
+    if not folder_name:
+        raise ValueError(f"'{name}' can't be used as the name of a result")
+    return folder_name
+
+# save the results of a trial to a folder in directory named after name (see
+# result_folder_name). Returns the path of the saved result.
+def save_results(directory, name, df_trial_results, df_weekly_stats, params):
+    path = os.path.join(directory, result_folder_name(name))
+    os.makedirs(path, exist_ok=True)
+
+    for table_name, df in [('trial_results', df_trial_results),
+                           ('weekly_stats', df_weekly_stats)]:
+        file_path = os.path.join(path, result_files[table_name])
+        # write to a temporary file first so a half written file is never
+        # opened as a saved result
+        tmp_path = file_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(results_to_arrow(df, params))
+        os.replace(tmp_path, file_path)
+
+    return path
+
+# names of the saved results in directory, newest first
+def list_saved_results(directory):
+    if not os.path.isdir(directory):
+        return []
+
+    names = [name for name in os.listdir(directory)
+             if all(os.path.exists(os.path.join(directory, name, file_name))
+                    for file_name in result_files.values())]
+
+    return sorted(names, key=lambda name: os.path.getmtime(
+                        os.path.join(directory, name,
+                                     result_files['weekly_stats'])),
+                  reverse=True)
+
+# memory map an Arrow file and read it as a table (without copying it into
+# memory)
+def open_arrow(file_path):
+    with pa.memory_map(file_path, 'r') as source:
+        return pa.ipc.open_file(source).read_all()
+
+# turn a table from open_arrow into a DataFrame. Each column is kept as its
+# own block so number columns can point straight at the memory mapped file
+# rather than being copied into one big block, and the table is freed as it
+# goes so nothing is held twice.
+def table_to_pandas(table):
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+# open a saved result. Returns df_trial_results, the weekly stats and the g
+# parameters the trial was run with.
+def open_results(path):
+    df_trial_results = table_to_pandas(open_arrow(os.path.join(
+                            path, result_files['trial_results'])))
+    table_weekly_stats = open_arrow(os.path.join(
+                            path, result_files['weekly_stats']))
+    # (the parameters are read first as the table can't be used once it has
+    # been turned into a DataFrame)
+    params = table_params(table_weekly_stats)
+
+    return df_trial_results, table_to_pandas(table_weekly_stats), params
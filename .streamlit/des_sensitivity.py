@@ -0,0 +1,185 @@
+import numpy as np
+import pandas as pd
+
+from des_experiments import (PointCache, evaluate_points, output_names,
+                             results_to_df)
+
+# Global sensitivity analysis over the g parameters. Parameter ranges are
+# given as a dictionary of {parameter name: (low, high)}. Designs are built in
+# the unit hypercube and then scaled to the parameter ranges, every point is
+# evaluated with the same seeds (so differences between points aren't just
+# noise) and points are cached so a long study can be resumed.
+
+# parameter ranges used if none are given - the main levers in the pathway
+default_ranges = {
+    'mean_referrals_pw':(40, 80),
+    'referral_rejection_rate':(0.0, 0.1),
+    'triage_rejection_rate':(0.0, 0.1),
+    'mdt_rejection_rate':(0.0, 0.1),
+    'asst_rejection_rate':(0.0, 0.05),
+    'triage_resource':(30, 70),
+    'mdt_resource':(4, 60),
+    'asst_resource':(20, 80),
+    'triage_clin_time':(30, 90),
+    'asst_clin_time':(60, 120),
+    }
+
+# scale points from the unit hypercube to the parameter ranges
+def scale_to_ranges(unit_points, ranges):
+    names = list(ranges)
+    low = np.array([ranges[name][0] for name in names], dtype=float)
+    high = np.array([ranges[name][1] for name in names], dtype=float)
+
+    return pd.DataFrame(low + unit_points * (high - low), columns=names)
+
+########## Morris (elementary effects) ##########
+
+# build a Morris design of one-at-a-time trajectories on a grid with the given
+# number of levels. Each trajectory has k+1 points, each one moving a single
+# parameter (in a random order) by delta.
+def morris_sample(ranges, trajectories=10, levels=4, seed=None):
+    rng = np.random.default_rng(seed)
+    k = len(ranges)
+    delta = levels / (2 * (levels - 1))
+
+    # starting levels are picked so that adding delta stays inside the range
+    start_levels = np.arange(levels)[np.arange(levels) / (levels - 1) + delta
+                                     <= 1 + 1e-9] / (levels - 1)
+
+    unit_points = []
+    for _ in range(trajectories):
+        point = rng.choice(start_levels, size=k)
+        unit_points.append(point.copy())
+        for i in rng.permutation(k):
+            point[i] += delta
+            unit_points.append(point.copy())
+
+    return scale_to_ranges(np.array(unit_points), ranges)
+
+# calculate the Morris indices - mu* (mean absolute elementary effect, the
+# overall importance of a parameter) and sigma (spread of the effects, which
+# shows interactions/non-linearity) - for each parameter and output
+def morris_indices(design, df_outputs, ranges, levels=4):
+    names = list(ranges)
+    k = len(names)
+    delta = levels / (2 * (levels - 1))
+
+    unit = np.column_stack([(design[name] - ranges[name][0]) /
+                            (ranges[name][1] - ranges[name][0])
+                            for name in names])
+
+    rows = []
+    for output in df_outputs.columns:
+        values = df_outputs[output].to_numpy()
+        effects = {name:[] for name in names}
+
+        for start in range(0, len(design), k + 1):
+            for step in range(k):
+                before = start + step
+                after = before + 1
+                # find the parameter that moved between these two points
+                i = int(np.argmax(np.abs(unit[after] - unit[before])))
+                effects[names[i]].append((values[after] - values[before]) /
+                                         delta)
+
+        for name in names:
+            name_effects = np.array(effects[name])
+            rows.append({
+                'Parameter':name,
+                'Output':output,
+                'mu':name_effects.mean(),
+                'mu_star':np.abs(name_effects).mean(),
+                'sigma':name_effects.std(ddof=1) if len(name_effects) > 1
+                                                 else 0.0,
+                })
+
+    return pd.DataFrame(rows)
+
+########## Sobol (variance based) ##########
+
+# build a Saltelli design for Sobol indices. This is made of two independent
+# base samples A and B of size n, followed by k matrices AB_i which are A with
+# column i taken from B, giving n * (k + 2) points in total.
+def saltelli_sample(ranges, n=64, seed=None):
+    rng = np.random.default_rng(seed)
+    k = len(ranges)
+
+    a = rng.random((n, k))
+    b = rng.random((n, k))
+
+    blocks = [a, b]
+    for i in range(k):
+        ab = a.copy()
+        ab[:, i] = b[:, i]
+        blocks.append(ab)
+
+    return scale_to_ranges(np.vstack(blocks), ranges)
+
+# calculate first order (S1) and total (ST) Sobol indices for each parameter
+# and output using the Saltelli (2010) and Jansen estimators
+def sobol_indices(df_outputs, ranges, n):
+    names = list(ranges)
+
+    rows = []
+    for output in df_outputs.columns:
+        values = df_outputs[output].to_numpy()
+        f_a = values[:n]
+        f_b = values[n:2 * n]
+        variance = np.var(np.concatenate([f_a, f_b]))
+
+        for i, name in enumerate(names):
+            f_ab = values[(2 + i) * n:(3 + i) * n]
+            if variance > 0:
+                first_order = np.mean(f_b * (f_ab - f_a)) / variance
+                total = 0.5 * np.mean((f_a - f_ab) ** 2) / variance
+            else:
+                first_order = total = 0.0
+
+            rows.append({'Parameter':name, 'Output':output, 'S1':first_order,
+                         'ST':total})
+
+    return pd.DataFrame(rows)
+
+########## Running a study ##########
+
+# run a full sensitivity study and return the design with its outputs and the
+# sensitivity indices. method is 'sobol' or 'morris', n is the number of base
+# samples (sobol) or trajectories (morris)
+def run_study(ranges=None, method='sobol', n=32, seed=42, base_params=None,
+              number_of_runs=None, sim_duration=None, cache_dir=None,
+              max_workers=None, levels=4, executor=None):
+    if ranges is None:
+        ranges = default_ranges
+
+    if method == 'sobol':
+        design = saltelli_sample(ranges, n, seed)
+    elif method == 'morris':
+        design = morris_sample(ranges, n, levels, seed)
+    else:
+        raise ValueError(f"Unknown sensitivity method '{method}'")
+
+    cache = PointCache(cache_dir) if cache_dir is not None else None
+
+    results = evaluate_points(design.to_dict('records'), seed,
+                              base_params=base_params,
+                              number_of_runs=number_of_runs,
+                              sim_duration=sim_duration, cache=cache,
+                              max_workers=max_workers, executor=executor)
+
+    df_outputs = results_to_df(results)[output_names]
+
+    if method == 'sobol':
+        df_indices = sobol_indices(df_outputs, ranges, n)
+    else:
+        df_indices = morris_indices(design, df_outputs, ranges, levels)
+
+    return pd.concat([design, df_outputs], axis=1), df_indices
+
+if __name__ == '__main__':
+    # quick screening study over the default ranges, cached so it can be
+    # stopped and restarted
+    df_design, df_indices = run_study(method='morris', n=10,
+                                      number_of_runs=3, sim_duration=52,
+                                      cache_dir='sensitivity_cache')
+    pd.set_option('display.max_rows', 1000)
+    print(df_indices.sort_values(['Output','mu_star'], ascending=False))
@@ -0,0 +1,165 @@
+from collections import OrderedDict
+
+from des_classes_v5 import g, pathway_stages
+
+# Memoisation of the earlier stages of the pathway. The pathway only flows
+# forward (referral -> triage, pack & obs -> MDT -> assessment) and every
+# patient's random draws are made when they are created, so with the same
+# seed a stage plays out exactly the same way as long as the inputs for it and
+# the stages before it are the same. The cache keeps the patients arriving at
+# each stage (and when they arrived) along with the results of the stages
+# before it. A run then only needs to simulate from the first stage whose
+# inputs have changed, e.g. changing the assessment slots only reruns the
+# assessment queue.
+#
+# Replayed arrivals come in at exactly the same times and in the same order as
+# before. Every stage takes some time (see stage_duration), so nobody arrives
+# at a stage at the same instant as something else happens there and a
+# replayed run gives exactly the same results as running every stage.
+
+# g parameters that each stage depends on
+stage_params = {
+    'referral':['sim_duration','std_dev','mean_referrals_pw',
+                'referral_profile','referral_rejection_rate',
+                'referral_screen_time','referral_ages','age_out_age',
+                'urgent_referral_rate','lac_referral_rate',
+                'near_18_referral_rate','near_18_years','daily_slots',
+                'working_weekdays','bank_holidays'],
+    'triage':['priority_stages','triage_resource','triage_rejection_rate',
+              'triage_clin_time','triage_admin_time','triage_discharge_time',
+              'target_triage_wait',
+              'pack_rejection_rate','pack_admin_time','pack_reject_time',
+              'obs_rejection_rate','school_obs_time','obs_reject_time'],
+    'mdt':['mdt_resource','mdt_rejection_rate','mdt_prep_time',
+           'mdt_meet_time','mdt_reject_time','mdt_batched',
+           'mdt_outcome_time','target_mdt_wait'],
+    'asst':['asst_resource','asst_rejection_rate','asst_clin_time',
+            'asst_admin_time','diag_time_disch','diag_time_accept',
+            'clinician_caseload','titration_weeks','number_staff_b6_prac',
+            'target_asst_wait'],
+    }
+
+# columns of Model.results_df filled in by each stage
+stage_results_cols = {
+    'referral':['Week Number','Run Number','Priority','Age',
+                'Referral Time Screen','Referral Rejected'],
+    'triage':['Triage WL Posn','Q Time Triage','Time to Triage',
+              'Triage Mins Clin','Triage Mins Admin','Total Triage Time',
+              'Triage Rejected','Triage Time Reject','Time Pack Send',
+              'Return Time Pack','Pack Rejected','Time Pack Reject',
+              'Time Obs Visit','Return Time Obs','Obs Rejected',
+              'Time Obs Reject'],
+    'mdt':['Time Prep MDT','Time Meet MDT','MDT WL Posn','Q Time MDT',
+           'Time to MDT','Total MDT Time','MDT Rejected','MDT Time Reject'],
+    'asst':['Asst WL Posn','Q Time Asst','Time to Asst','Asst Mins Clin',
+            'Asst Mins Admin','Total Asst Time','Asst Rejected',
+            'Diag Rejected Time','Diag Accepted Time','Q Time Caseload',
+            'Clinician','Titration Weeks'],
+    }
+
+# weekly stats columns worked out from each stage's results
+stage_weekly_cols = {
+    'referral':['Referral Screen Mins'],
+    'triage':['Triage WL','Triage Rejects','Triage Wait','Triage Wait P90',
+              'Triage Breach %','Triage Clin Mins','Triage Admin Mins',
+              'Triage Reject Mins','Pack Send Mins','Pack Rejects',
+              'Pack Reject Mins','Obs Visit Mins','Obs Rejects',
+              'Obs Reject Mins','Triage Queue','Triage Slots Left',
+              'Triage In Progress','Triage Avg Queue',
+              'Triage Utilisation %','Triage Aged Out'],
+    'mdt':['MDT Prep Mins','MDT Meet Mins','MDT WL','MDT Rejects',
+           'MDT Reject Mins','MDT Wait','MDT Wait P90','MDT Breach %',
+           'MDT Queue','MDT Slots Left','MDT In Progress','MDT Avg Queue',
+           'MDT Utilisation %','MDT Aged Out'],
+    'asst':['Asst WL','Asst Rejects','Asst Wait','Asst Wait P90',
+            'Asst Breach %','Asst Clin Mins','Asst Admin Mins',
+            'Diag Reject Mins','Diag Accept Mins','Asst Queue',
+            'Asst Slots Left','Asst In Progress','Asst Avg Queue',
+            'Asst Utilisation %','Asst Aged Out','Caseload',
+            'Caseload Queue','In Titration'],
+    }
+
+# waiting list counters in g that belong to each stage
+stage_counters = {
+    'referral':[],
+    'triage':['number_on_triage_wl'],
+    'mdt':['number_on_mdt_wl'],
+    'asst':['number_on_asst_wl'],
+    }
+
+# parameter value as something that can go in a key (profiles are lists and
+# referral ages a dict)
+def param_key(value):
+    if isinstance(value, list):
+        return tuple(value)
+    if isinstance(value, dict):
+        return tuple(sorted(value.items()))
+    return value
+
+# Class representing the cache of stage arrivals. The least recently used
+# entries are dropped once there are more than max_entries (each run stores
+# one entry per stage after the one it started from).
+class StageCache:
+    def __init__(self, max_entries=100):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+        # number of runs that did / didn't find any cached stages
+        self.hits = 0
+        self.misses = 0
+
+    # key for the arrivals into a stage - the run, its seed (and whether it
+    # uses antithetic draws) and the values of every parameter the stages
+    # before it depend on
+    def key(self, stage, model):
+        upstream = pathway_stages[:pathway_stages.index(stage)]
+        return (stage, model.run_number, model.seed, model.antithetic,
+                tuple(param_key(getattr(g, name)) for upstream_stage in upstream
+                      for name in stage_params[upstream_stage]))
+
+    # find the latest stage a model can start from. Returns the stage and its
+    # cache entry, or ('referral', None) if it has to be run from the start
+    def lookup(self, model):
+        for stage in reversed(pathway_stages[1:]):
+            key = self.key(stage, model)
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return stage, self.entries[key]
+
+        self.misses += 1
+        return 'referral', None
+
+    # store the arrivals into every stage after the one a finished model
+    # started from
+    def store(self, model):
+        start = pathway_stages.index(model.start_stage)
+
+        for i in range(start + 1, len(pathway_stages)):
+            stage = pathway_stages[i]
+            upstream = pathway_stages[:i]
+
+            results_cols = [col for upstream_stage in upstream
+                            for col in stage_results_cols[upstream_stage]]
+            weekly_cols = [col for upstream_stage in upstream
+                           for col in stage_weekly_cols[upstream_stage]]
+            counters = [name for upstream_stage in upstream
+                        for name in stage_counters[upstream_stage]]
+
+            key = self.key(stage, model)
+            self.entries[key] = {
+                'stream':list(model.stage_streams[stage]),
+                'results':model.results_df[results_cols].copy(),
+                'weekly':[{col:week_stats[col] for col in weekly_cols}
+                          for week_stats in model.df_weekly_stats],
+                'counters':{name:model.saved_state[name] for name in counters},
+                'patient_counter':model.patient_counter,
+                'referrals_per_week':list(model.referrals_per_week),
+                }
+            self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
@@ -0,0 +1,145 @@
+import numpy as np
+
+# Small statistics helpers shared by the trial summary and the scenario
+# comparison (so scipy isn't needed just for confidence intervals)
+
+# two sided 95% critical values of the t distribution by degrees of freedom
+t_critical_95 = {1:12.706, 2:4.303, 3:3.182, 4:2.776, 5:2.571, 6:2.447,
+                 7:2.365, 8:2.306, 9:2.262, 10:2.228, 11:2.201, 12:2.179,
+                 13:2.160, 14:2.145, 15:2.131, 16:2.120, 17:2.110, 18:2.101,
+                 19:2.093, 20:2.086, 25:2.060, 30:2.042, 40:2.021, 60:2.000,
+                 120:1.980}
+
+# t critical value for the degrees of freedom, using the nearest tabulated
+# value below (so the interval is never too narrow)
+def t_critical(dof):
+    if dof < 1:
+        return np.nan
+    if dof > 120:
+        return 1.96
+    return t_critical_95[max(d for d in t_critical_95 if d <= dof)]
+
+# mean and 95% confidence interval half width of a set of values
+def mean_ci(values):
+    values = np.asarray(values, dtype=float)
+    values = values[~np.isnan(values)]
+    if len(values) < 2:
+        return (values.mean() if len(values) else np.nan), np.nan
+    half_width = (t_critical(len(values) - 1) * values.std(ddof=1)
+                  / np.sqrt(len(values)))
+    return values.mean(), half_width
+
+# two sample Kolmogorov-Smirnov test of whether two sets of values come from
+# the same distribution. Returns the statistic (largest gap between the two
+# empirical CDFs) and its p-value from the asymptotic distribution, with
+# Stephens' correction so it holds up for small samples.
+def ks_2samp(a, b):
+    a = np.sort(np.asarray(a, dtype=float))
+    b = np.sort(np.asarray(b, dtype=float))
+    n, m = len(a), len(b)
+    if n == 0 or m == 0:
+        return np.nan, np.nan
+
+    values = np.concatenate([a, b])
+    cdf_a = np.searchsorted(a, values, side='right') / n
+    cdf_b = np.searchsorted(b, values, side='right') / m
+    statistic = np.abs(cdf_a - cdf_b).max()
+
+    en = np.sqrt(n * m / (n + m))
+    lam = (en + 0.12 + 0.11 / en) * statistic
+    if lam < 1e-3:
+        return statistic, 1.0
+    k = np.arange(1, 101)
+    pvalue = 2 * np.sum((-1.0) ** (k - 1) * np.exp(-2 * k**2 * lam**2))
+
+    return statistic, float(np.clip(pvalue, 0, 1))
+
+# Streaming estimate of a quantile with the P-squared algorithm (Jain &
+# Chlamtac, 1985), which keeps 5 markers rather than every value so each new
+# value is added in constant time and memory. The state is an array from
+# p2_state - the number of values so far, then the marker heights, their
+# positions and their desired positions - so the functions can also be
+# compiled with Numba (see des_kernel.py).
+
+# number of values and the offsets of the heights, positions and desired
+# positions in the state
+P2_COUNT, P2_HEIGHTS, P2_POSITIONS, P2_DESIRED = 0, 1, 6, 11
+
+def p2_state():
+    return np.zeros(16)
+
+# add a value to the estimate of quantile p
+def p2_add(state, x, p):
+    count = int(state[P2_COUNT])
+    q = state[P2_HEIGHTS:P2_HEIGHTS + 5]
+    n = state[P2_POSITIONS:P2_POSITIONS + 5]
+    desired = state[P2_DESIRED:P2_DESIRED + 5]
+
+    # the first 5 values are kept as they are, then become the markers
+    if count < 5:
+        q[count] = x
+        state[P2_COUNT] = count + 1
+        if count == 4:
+            q.sort()
+            for i in range(5):
+                n[i] = i + 1
+            desired[0] = 1
+            desired[1] = 1 + 2 * p
+            desired[2] = 1 + 4 * p
+            desired[3] = 3 + 2 * p
+            desired[4] = 5
+        return
+
+    # find the cell the value falls in, moving the end markers out if needed
+    if x < q[0]:
+        q[0] = x
+        k = 0
+    elif x >= q[4]:
+        q[4] = x
+        k = 3
+    else:
+        k = 0
+        while x >= q[k + 1]:
+            k += 1
+
+    for i in range(k + 1, 5):
+        n[i] += 1
+    desired[1] += p / 2
+    desired[2] += p
+    desired[3] += (1 + p) / 2
+    desired[4] += 1
+    state[P2_COUNT] = count + 1
+
+    # move the middle markers towards where they should be, adjusting their
+    # heights with the piecewise parabolic formula (or linearly if that would
+    # put them out of order)
+    for i in range(1, 4):
+        d = desired[i] - n[i]
+        if ((d >= 1 and n[i + 1] - n[i] > 1)
+                or (d <= -1 and n[i - 1] - n[i] < -1)):
+            d = 1.0 if d > 0 else -1.0
+            height = q[i] + d / (n[i + 1] - n[i - 1]) * (
+                (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+                + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1])
+                / (n[i] - n[i - 1]))
+            if not q[i - 1] < height < q[i + 1]:
+                j = i + int(d)
+                height = q[i] + d * (q[j] - q[i]) / (n[j] - n[i])
+            q[i] = height
+            n[i] += d
+
+# the estimate of quantile p so far (worked out exactly from the values kept
+# while there are fewer than 5, nan if there are none)
+def p2_quantile(state, p):
+    count = int(state[P2_COUNT])
+    if count == 0:
+        return np.nan
+    if count >= 5:
+        return state[P2_HEIGHTS + 2]
+
+    values = np.sort(state[P2_HEIGHTS:P2_HEIGHTS + count])
+    position = p * (count - 1)
+    below = int(np.floor(position))
+    above = min(below + 1, count - 1)
+    return values[below] + (position - below) * (values[above]
+                                                 - values[below])
@@ -0,0 +1,222 @@
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from des_classes_v5 import g
+from des_experiments import (PointCache, changed_settings, evaluate_points,
+                             point_settings, trajectory_cols)
+
+# Surrogate (emulator) of the simulation. A Gaussian process is trained on the
+# weekly waiting list and wait trajectories from trials that have already been
+# run (e.g. from a sensitivity study cache) or from a sweep over the parameter
+# space, and can then give an instant estimate of the trajectories, with an
+# uncertainty band, for any set of inputs.
+
+# parameter ranges swept if none are given - the inputs on the des.py sidebar
+# that the emulator is most often asked about
+default_ranges = {
+    'mean_referrals_pw':(20, 100),
+    'triage_resource':(20, 100),
+    'mdt_resource':(5, 100),
+    'asst_resource':(10, 100),
+    'triage_rejection_rate':(0.0, 0.2),
+    'mdt_rejection_rate':(0.0, 0.2),
+    }
+
+# Class representing a Gaussian process emulator with one input per g
+# parameter and one output per week of each trajectory column. All outputs
+# share the same kernel, so the uncertainty (as a share of each output's
+# spread) is the same for every week and column.
+class Emulator:
+    def __init__(self, length_scales=(0.1, 0.2, 0.4, 0.8, 1.6),
+                 noise_levels=(1e-4, 1e-3, 1e-2, 1e-1)):
+        # the kernel settings are picked from these by maximising the
+        # marginal likelihood when the emulator is fitted
+        self.length_scales = length_scales
+        self.noise_levels = noise_levels
+
+    # squared exponential kernel between two sets of (scaled) inputs
+    def kernel(self, x1, x2):
+        sq_dist = ((x1[:, None, :] - x2[None, :, :]) ** 2).sum(axis=2)
+        return np.exp(-0.5 * sq_dist / self.length_scale**2)
+
+    # scale the inputs to 0-1 using the range seen in training
+    def scale(self, df_params):
+        x = df_params[self.param_names].to_numpy(dtype=float)
+        return (x - self.x_low) / self.x_span
+
+    # fit the emulator. df_params has one row per training point and a column
+    # per parameter, trajectories is a list of weekly trajectory DataFrames
+    # (indexed by week) in the same order
+    def fit(self, df_params, trajectories):
+        self.param_names = list(df_params.columns)
+        self.weeks = trajectories[0].index
+        self.output_cols = list(trajectories[0].columns)
+
+        x_low = df_params.min().to_numpy(dtype=float)
+        x_span = df_params.max().to_numpy(dtype=float) - x_low
+        self.x_low = x_low
+        self.x_span = np.where(x_span > 0, x_span, 1.0)
+        self.x_train = self.scale(df_params)
+
+        # one row per point of every week for every column
+        y = np.array([trajectory.loc[self.weeks, self.output_cols]
+                      .to_numpy(dtype=float).ravel(order='F')
+                      for trajectory in trajectories])
+        y = np.nan_to_num(y)
+        self.y_mean = y.mean(axis=0)
+        self.y_std = y.std(axis=0)
+        self.y_std[self.y_std == 0] = 1.0
+        y = (y - self.y_mean) / self.y_std
+
+        n = len(y)
+        best_log_lik = -np.inf
+        best = None
+        for length_scale in self.length_scales:
+            self.length_scale = length_scale
+            k = self.kernel(self.x_train, self.x_train)
+            for noise in self.noise_levels:
+                try:
+                    chol = np.linalg.cholesky(k + noise * np.eye(n))
+                except np.linalg.LinAlgError:
+                    continue
+                alpha = np.linalg.solve(chol.T, np.linalg.solve(chol, y))
+                log_lik = (-0.5 * (y * alpha).sum()
+                           - y.shape[1] * np.log(np.diag(chol)).sum())
+                if log_lik > best_log_lik:
+                    best_log_lik = log_lik
+                    best = (length_scale, noise, chol, alpha)
+
+        if best is None:
+            raise ValueError('The emulator could not be fitted with any of the '
+                             'length scales and noise levels, try larger '
+                             'noise levels')
+
+        self.length_scale, self.noise, self.chol, self.alpha = best
+
+        # the rest of the g parameters the training runs used, which the
+        # emulator knows nothing about changing
+        self.settings = point_settings({})
+        for name in self.param_names:
+            self.settings.pop(name, None)
+
+        return self
+
+    # predict the weekly trajectories for a dictionary of parameter values.
+    # Returns the mean and standard deviation trajectories, and the overall
+    # uncertainty as a share of the spread seen in training (0 = at a training
+    # point, 1 = no better than knowing nothing)
+    def predict(self, params):
+        x = self.scale(pd.DataFrame([params]))
+        k_star = self.kernel(x, self.x_train)
+
+        mean = k_star @ self.alpha
+        v = np.linalg.solve(self.chol, k_star.T)
+        variance = max(0.0, 1.0 - (v**2).sum())
+        uncertainty = np.sqrt(variance)
+
+        df_mean = self.to_trajectories(mean[0] * self.y_std + self.y_mean)
+        df_sd = self.to_trajectories(uncertainty * self.y_std)
+
+        return df_mean, df_sd, uncertainty
+
+    # turn one value per week of each output back into a DataFrame
+    def to_trajectories(self, values):
+        shape = (len(self.weeks), len(self.output_cols))
+        return pd.DataFrame(values.reshape(shape, order='F'),
+                            index=self.weeks, columns=self.output_cols)
+
+    # g parameters, other than the ones the emulator takes as inputs, whose
+    # current values are different to the ones it was trained with (or None
+    # if it was saved without its training settings)
+    def changed_settings(self):
+        if not hasattr(self, 'settings'):
+            return None
+        return changed_settings(self.settings, point_settings({}),
+                                ignore=self.param_names)
+
+    # predict using the current values in g. If any other parameter is
+    # different to the training runs the emulator is predicting a set up it
+    # has never seen, so the uncertainty is 1 (no better than knowing nothing)
+    def predict_current(self):
+        df_mean, df_sd, uncertainty = self.predict(
+                        {name:getattr(g, name) for name in self.param_names})
+
+        if self.changed_settings() != []:
+            uncertainty = 1.0
+            df_sd = self.to_trajectories(self.y_std)
+
+        return df_mean, df_sd, uncertainty
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump(self, f)
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+# get training data from the points saved in a PointCache. Only points with
+# all of the named parameters and the given number of weeks, that were run
+# with the same values as g for every other parameter, are used.
+def training_data_from_cache(cache_dir, param_names, sim_duration=None):
+    params = []
+    trajectories = []
+    settings = point_settings({})
+
+    for result in PointCache(cache_dir).load_all():
+        if not all(name in result['params'] for name in param_names):
+            continue
+        if 'settings' not in result or changed_settings(
+                settings, result['settings'], ignore=param_names):
+            continue
+        trajectory = result['trajectory']
+        if sim_duration is not None and trajectory.index.max() != sim_duration - 1:
+            continue
+        params.append({name:result['params'][name] for name in param_names})
+        trajectories.append(trajectory[trajectory_cols])
+
+    return pd.DataFrame(params, columns=param_names), trajectories
+
+# Latin hypercube sample of n points over the parameter ranges
+def latin_hypercube(ranges, n, seed=None):
+    rng = np.random.default_rng(seed)
+    unit = np.column_stack([(rng.permutation(n) + rng.random(n)) / n
+                            for _ in ranges])
+    low = np.array([low for low, high in ranges.values()], dtype=float)
+    high = np.array([high for low, high in ranges.values()], dtype=float)
+    return pd.DataFrame(low + unit * (high - low), columns=list(ranges))
+
+# sweep the parameter space with a Latin hypercube, run a trial at each point
+# (cached, so the sweep can be resumed or added to) and fit an emulator
+def train_emulator(ranges=None, n=60, seed=42, number_of_runs=None,
+                   sim_duration=None, cache_dir=None, max_workers=None,
+                   executor=None):
+    if ranges is None:
+        ranges = default_ranges
+
+    design = latin_hypercube(ranges, n, seed)
+    cache = PointCache(cache_dir) if cache_dir is not None else None
+    results = evaluate_points(design.to_dict('records'), seed,
+                              number_of_runs=number_of_runs,
+                              sim_duration=sim_duration, cache=cache,
+                              max_workers=max_workers, executor=executor)
+
+    trajectories = [result['trajectory'] for result in results]
+
+    return Emulator().fit(design, trajectories)
+
+if __name__ == '__main__':
+    # build the emulator used for the instant preview on the des.py page
+    # (imported so the saved emulator can be loaded from outside this file)
+    import des_surrogate
+    emulator = des_surrogate.train_emulator(number_of_runs=5,
+                                            sim_duration=52,
+                                            cache_dir='emulator_cache')
+    emulator.save(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               'emulator.pkl'))
+    print(f'Emulator trained on {len(emulator.x_train)} points '
+          f'(length scale {emulator.length_scale}, noise {emulator.noise})')
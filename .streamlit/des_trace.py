@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+
+# Structured trace of what happens in a run, used for debugging in place of
+# printing to the screen. Events are written as fixed size records into a
+# preallocated NumPy ring buffer (once it is full the oldest events are
+# overwritten), so recording an event never allocates or formats a string and
+# big runs can be traced without slowing to a crawl.
+
+# stages of the pathway - patient_id is -1 for events that aren't about a
+# single patient (e.g. the start of a week)
+stage_names = ['week','referral','triage','pack','obs','mdt','asst','diagnosis']
+STAGE_WEEK, STAGE_REFERRAL, STAGE_TRIAGE, STAGE_PACK, STAGE_OBS, STAGE_MDT, \
+    STAGE_ASST, STAGE_DIAGNOSIS = range(len(stage_names))
+
+# kinds of event
+kind_names = ['week_start','referrals_generated','carried_over','replenished',
+              'accepted','rejected','joined_queue','started','aged_out']
+KIND_WEEK_START, KIND_REFERRALS_GENERATED, KIND_CARRIED_OVER, KIND_REPLENISHED, \
+    KIND_ACCEPTED, KIND_REJECTED, KIND_JOINED_QUEUE, KIND_STARTED, \
+    KIND_AGED_OUT = range(len(kind_names))
+
+trace_dtype = np.dtype([
+    ('patient_id', np.int64),
+    ('stage', np.int8),
+    ('kind', np.int8),
+    ('sim_time', np.float64),
+    ('queue_length', np.int64), # length of the relevant queue at the time
+    ('value', np.float64), # anything else, e.g. number of slots put back
+    ])
+
+# Class representing the trace buffer for a single run
+class TraceBuffer:
+    # capacity - number of events kept (the most recent are kept)
+    # sample_rate - share of patients whose events are recorded. Patients are
+    #   picked by their id so every event for a sampled patient is kept
+    # stages - list of stage names to record (None = all stages)
+    # patient_events - whether to record events for individual patients as
+    #   well as the weekly events
+    def __init__(self, capacity=100000, sample_rate=1.0, stages=None,
+                 patient_events=True):
+        self.capacity = capacity
+        self.records = np.zeros(capacity, dtype=trace_dtype)
+        self.count = 0 # number of events recorded, including overwritten ones
+
+        self.patient_events = patient_events
+        # patients are sampled by hashing their id into 0 - 2**32
+        self.sample_threshold = int(sample_rate * 2**32)
+
+        if stages is None:
+            self.stage_on = [True] * len(stage_names)
+        else:
+            self.stage_on = [name in stages for name in stage_names]
+
+    # record a single event
+    def record(self, patient_id, stage, kind, sim_time, queue_length=0,
+               value=0.0):
+        if not self.stage_on[stage]:
+            return
+        if patient_id >= 0:
+            if not self.patient_events:
+                return
+            if (patient_id * 2654435761) % 2**32 >= self.sample_threshold:
+                return
+
+        self.records[self.count % self.capacity] = (patient_id, stage, kind,
+                                                    sim_time, queue_length,
+                                                    value)
+        self.count += 1
+
+    # number of events that have been overwritten as the buffer was full
+    def dropped(self):
+        return max(0, self.count - self.capacity)
+
+    # the recorded events, oldest first, as a DataFrame
+    def to_dataframe(self):
+        if self.count <= self.capacity:
+            records = self.records[:self.count]
+        else:
+            records = np.roll(self.records, -(self.count % self.capacity))
+
+        df_trace = pd.DataFrame(records)
+        df_trace['stage'] = pd.Categorical.from_codes(df_trace['stage'],
+                                                      stage_names)
+        df_trace['kind'] = pd.Categorical.from_codes(df_trace['kind'],
+                                                     kind_names)
+        return df_trace
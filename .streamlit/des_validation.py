@@ -0,0 +1,124 @@
+import sys
+from statistics import NormalDist
+
+import numpy as np
+import pandas as pd
+
+from des_arrivals import school_term_profile
+from des_classes_v5 import Model
+from des_experiments import b6_mins_cols, b4_mins_cols, run_point
+from des_stats import ks_2samp
+
+# Statistical equivalence checks for a faster engine (a rewrite of Model, a
+# different data structure for the queues etc.) against the reference Model.
+# Both are run over a matrix of scenarios and every weekly stats column that
+# matters - the waiting lists, waits and staff minutes - is compared week by
+# week in two ways:
+#
+# - tolerance: the mean over runs has to be within rel_tol of the reference
+#   mean, relative to the size of the column (its largest weekly mean) so
+#   small early weeks don't blow the relative difference up. As the means are
+#   from a limited number of runs, the difference can also be out by chance,
+#   so the tolerance is widened by the standard error of the difference
+#   times the normal critical value at alpha
+# - distribution: a two sample KS test of the runs' values in each week
+#
+# With a test every week some would fail by chance, so both use alpha divided
+# by the number of weeks (Bonferroni).
+#
+# The candidate is run with different seeds to the reference by default, so
+# an engine that uses its random numbers differently can still pass - the
+# test is that the results are statistically the same, not identical.
+
+# weekly stats columns compared between the engines
+validation_cols = (['Triage WL','MDT WL','Asst WL','Triage Wait','MDT Wait',
+                    'Asst Wait'] + b6_mins_cols + b4_mins_cols)
+
+# scenarios the engines are compared over, as changes to the default g
+# parameters - the default set up, a busier service, a service short of
+# slots (long queues) and seasonal referrals
+scenario_matrix = {
+    'Default':{},
+    'High Referrals':{'mean_referrals_pw':90},
+    'Few Slots':{'triage_resource':30, 'mdt_resource':4, 'asst_resource':40},
+    'School Terms':{'referral_profile':school_term_profile(0.5)},
+    }
+
+# compare the weekly stats of the reference and candidate runs for one
+# scenario, returning a row per column
+def compare_weekly_stats(df_reference, df_candidate, rel_tol, alpha):
+    rows = []
+
+    for col in validation_cols:
+        reference_weeks = df_reference.groupby('Week Number')[col]
+        candidate_weeks = df_candidate.groupby('Week Number')[col]
+
+        weeks = reference_weeks.ngroups
+        z = NormalDist().inv_cdf(1 - alpha / (2 * weeks))
+
+        reference_mean = reference_weeks.mean()
+        candidate_mean = candidate_weeks.mean()
+        difference = (candidate_mean - reference_mean).abs()
+        standard_error = np.sqrt(reference_weeks.var() / reference_weeks.count()
+                                 + candidate_weeks.var()
+                                 / candidate_weeks.count()).fillna(0)
+
+        scale = max(reference_mean.abs().max(), 1e-9)
+        max_rel_diff = difference.max() / scale
+        tolerance_passed = (difference
+                            <= rel_tol * scale + z * standard_error).all()
+
+        pvalues = [ks_2samp(values, candidate_weeks.get_group(week))[1]
+                   for week, values in reference_weeks]
+        min_pvalue = np.nanmin(pvalues)
+
+        rows.append({
+            'Output':col,
+            'Max Rel Diff':max_rel_diff,
+            'Tolerance Passed':bool(tolerance_passed),
+            'Min KS p':min_pvalue,
+            'KS Weeks Below alpha':int(np.sum(np.array(pvalues) < alpha)),
+            'KS Passed':bool(min_pvalue >= alpha / weeks),
+            })
+
+    return rows
+
+# run the reference and candidate engines (classes taking the same arguments
+# as Model) over the scenarios and compare them. Returns a report with a row
+# per scenario and column, and whether everything passed.
+def validate_engine(candidate_class, reference_class=Model, scenarios=None,
+                    seed=42, candidate_seed=None, number_of_runs=20,
+                    sim_duration=52, rel_tol=0.05, alpha=0.05):
+    if scenarios is None:
+        scenarios = scenario_matrix
+    # independent runs unless the seeds are asked to be the same
+    if candidate_seed is None:
+        candidate_seed = seed + 1000000
+
+    rows = []
+    for scenario, params in scenarios.items():
+        _, df_reference = run_point(params, seed, number_of_runs,
+                                    sim_duration, reference_class)
+        _, df_candidate = run_point(params, candidate_seed, number_of_runs,
+                                    sim_duration, candidate_class)
+
+        for row in compare_weekly_stats(df_reference, df_candidate, rel_tol,
+                                        alpha):
+            rows.append({'Scenario':scenario, **row})
+
+    df_report = pd.DataFrame(rows)
+    df_report['Passed'] = (df_report['Tolerance Passed']
+                           & df_report['KS Passed'])
+
+    return df_report, bool(df_report['Passed'].all())
+
+if __name__ == '__main__':
+    # check the reference against itself (with different seeds) - anything
+    # failing here is down to the tolerances being too tight for the number
+    # of runs rather than a difference between engines
+    df_report, passed = validate_engine(Model, number_of_runs=10)
+    pd.set_option('display.max_rows', 1000)
+    pd.set_option('display.width', 200)
+    print(df_report)
+    print('PASSED' if passed else 'FAILED')
+    sys.exit(0 if passed else 1)
@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+
+from des_classes_v5 import g, Model
+
+# Regression tests for extending a finished run - running for M weeks and then
+# extending to N has to give exactly the same results as running for N weeks.
+
+# run a seeded model for weeks, extending it to extend_to weeks if given, and
+# return its compact results
+def run_model(weeks, extend_to=None, seed=5):
+    old_duration = g.sim_duration
+    g.sim_duration = weeks
+    try:
+        model = Model(0, seed)
+        model.run(print_run_results=False)
+        if extend_to is not None:
+            model.extend(extend_to)
+    finally:
+        g.sim_duration = old_duration
+    return model, model.compact_results()
+
+def check_extended_run(teams):
+    old_teams = g.teams
+    g.teams = teams
+    try:
+        model, results = run_model(20)
+        extended_model, extended_results = run_model(10, extend_to=20)
+    finally:
+        g.teams = old_teams
+
+    assert list(extended_model.arrival_schedule) == list(model.arrival_schedule)
+    for team, extended_team in zip(model.teams, extended_model.teams):
+        assert (list(extended_team.arrival_schedule)
+                == list(team.arrival_schedule))
+
+    np.testing.assert_array_equal(np.array(extended_results['outputs'], float),
+                                  np.array(results['outputs'], float))
+    pd.testing.assert_frame_equal(
+        pd.DataFrame(extended_results['weekly_stats']),
+        pd.DataFrame(results['weekly_stats']), check_dtype=False)
+
+def test_extend_run():
+    check_extended_run(None)
+
+def test_extend_run_with_teams():
+    check_extended_run([{'name':'A'}, {'name':'B', 'mean_referrals_pw':30}])
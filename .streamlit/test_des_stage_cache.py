@@ -0,0 +1,53 @@
+import pandas as pd
+
+from des_classes_v5 import g, Trial
+from des_stage_cache import StageCache
+
+# Regression tests for the stage cache - a run that reuses cached stages has
+# to give exactly the same results as running every stage.
+
+# run a short seeded trial, optionally with a stage cache
+def run_trial(stage_cache=None):
+    return Trial(stage_cache).run_trial()
+
+# change some g parameters for a test, returning their old values
+def set_params(params):
+    old = {name:getattr(g, name) for name in params}
+    for name, value in params.items():
+        setattr(g, name, value)
+    return old
+
+# run with base_params to warm up a cache, change to new_params and check the
+# cached run gives the same results as an uncached one
+def check_cached_run(base_params, new_params):
+    old = set_params({'random_seed':42, 'number_of_runs':2,
+                      'sim_duration':20, **base_params})
+    try:
+        stage_cache = StageCache()
+        run_trial(stage_cache)
+
+        set_params(new_params)
+        cached_results, cached_weekly = run_trial(stage_cache)
+        results, weekly = run_trial()
+    finally:
+        set_params(old)
+
+    pd.testing.assert_frame_equal(cached_results, results)
+    pd.testing.assert_frame_equal(cached_weekly.reset_index(drop=True),
+                                  weekly.reset_index(drop=True),
+                                  check_dtype=False)
+
+def test_target_triage_wait():
+    check_cached_run({}, {'target_triage_wait':1})
+
+def test_target_mdt_wait():
+    check_cached_run({}, {'target_mdt_wait':0.2})
+
+def test_target_asst_wait():
+    check_cached_run({}, {'target_asst_wait':1})
+
+def test_daily_slots():
+    check_cached_run({}, {'daily_slots':True})
+
+def test_bank_holidays():
+    check_cached_run({'daily_slots':True}, {'bank_holidays':[0, 25, 26]})